@@ -0,0 +1,188 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from emotion_entries import DAY_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout changes, stale aggregates get rebuilt. Since
+# version 3 only meta is kept, the daily, weekly and per-emotion buckets of
+# older versions are dropped by the rebuild (see rollups.py for those).
+AGGREGATES_VERSION = 3
+
+# Standard deviation of intensities above which moods count as swinging,
+# in /api/emotions/analysis, its trends and cohort reports alike
+MOOD_SWING_STD = 2.5
+
+# Characters that are not allowed in Realtime Database keys
+_UNSAFE_KEY_CHARS = '%.$#[]/'
+
+
+_ENCODE_TABLE = {ord(char): '%{0:02X}'.format(ord(char)) for char in _UNSAFE_KEY_CHARS}
+
+
+def encode_key(value: str) -> str:
+    return value.translate(_ENCODE_TABLE)
+
+
+def decode_key(value: str) -> str:
+    if '%' not in value:
+        return value
+    for char in reversed(_UNSAFE_KEY_CHARS):
+        value = value.replace('%{0:02X}'.format(ord(char)), char)
+    return value
+
+
+def day_key(value) -> str:
+    return value.strftime('%Y-%m-%d')
+
+
+def week_key(value) -> str:
+    year, week, _ = value.isocalendar()
+    return '{0}-W{1:02d}'.format(year, week)
+
+
+# Population standard deviation from a count, sum and sum of squares
+def intensity_std(count: int, intensity_sum: float, intensity_sq_sum: float) -> float:
+    mean = intensity_sum / count
+    return math.sqrt(max(intensity_sq_sum / count - mean * mean, 0))
+
+
+def mood_swings(std: float) -> bool:
+    return std > MOOD_SWING_STD
+
+
+# Multi-path update that adds the given entries to the aggregates.
+# 'meta/count' counts every entry and serves as the user's data version.
+def build_increments(entries: Iterable[Dict]) -> Dict:
+    return {'meta/count': {'.sv': {'increment': sum(1 for _ in entries)}}}
+
+
+# Full aggregates document computed from scratch, used by rebuilds
+def build_aggregates(entries: Iterable[Dict]) -> Dict:
+    return {
+        'meta': {
+            'version': AGGREGATES_VERSION,
+            'rebuilt_at': datetime.now().isoformat(),
+            'count': sum(1 for _ in entries)
+        }
+    }
+
+
+# Combine rollup buckets into totals per emotion plus overall count, sum,
+# sum of squares, min, max and note count. Emotions are in alphabetical order, so results do
+# not depend on which buckets were compacted or on their storage order.
+def summarize(buckets: Iterable[Dict]) -> Dict:
+    summary = {
+        'count': 0,
+        'intensity_sum': 0,
+        'intensity_sq_sum': 0,
+        'intensity_min': None,
+        'intensity_max': None,
+        'note_count': 0,
+        'emotions': {}
+    }
+
+    intensities = set()
+    for bucket in buckets:
+        summary['count'] += bucket.get('count', 0)
+        summary['intensity_sum'] += bucket.get('intensity_sum', 0)
+        summary['intensity_sq_sum'] += bucket.get('intensity_sq_sum', 0)
+        summary['note_count'] += bucket.get('note_count', 0)
+        for field in ('intensity_min', 'intensity_max'):
+            if bucket.get(field) is not None:
+                intensities.add(bucket[field])
+        for key, data in bucket.get('emotions', {}).items():
+            emotion = summary['emotions'].setdefault(decode_key(key), {'count': 0, 'intensity_sum': 0})
+            emotion['count'] += data.get('count', 0)
+            emotion['intensity_sum'] += data.get('intensity_sum', 0)
+
+    if intensities:
+        summary['intensity_min'] = min(intensities)
+        summary['intensity_max'] = max(intensities)
+    summary['emotions'] = dict(sorted(summary['emotions'].items()))
+    return summary
+
+
+# Dominant emotion, per-emotion distribution, average intensity per day of
+# the week and the mood swings flag of daily buckets keyed by day, as in
+# /api/emotions/analysis. Also used per user by cohort reports.
+def analyze_buckets(buckets: Dict[str, Dict]) -> Dict:
+    summary = summarize(buckets.values())
+    analysis = {
+        'total_entries': summary['count'],
+        'dominant_emotion': None,
+        'daily_mood_pattern': {},
+        'emotion_distribution': {},
+        'mood_swings': False
+    }
+    if not summary['count']:
+        return analysis
+
+    # Ties go to the emotion that comes first alphabetically
+    max_count = 0
+    for emotion, data in summary['emotions'].items():
+        analysis['emotion_distribution'][emotion] = {
+            'frequency': data['count'],
+            'average_intensity': round(data['intensity_sum'] / data['count'], 2),
+            'percentage': round((data['count'] / summary['count']) * 100, 2)
+        }
+        if data['count'] > max_count:
+            max_count = data['count']
+            analysis['dominant_emotion'] = emotion
+
+    daily_intensities = {i: [0, 0] for i in range(7)}
+    for day, bucket in buckets.items():
+        if bucket.get('count'):
+            day_of_week = datetime.strptime(day, '%Y-%m-%d').weekday()
+            daily_intensities[day_of_week][0] += bucket['intensity_sum']
+            daily_intensities[day_of_week][1] += bucket['count']
+    for day, (total, count) in daily_intensities.items():
+        if count:
+            analysis['daily_mood_pattern'][DAY_NAMES[day]] = round(total / count, 2)
+
+    analysis['mood_swings'] = mood_swings(
+        intensity_std(summary['count'], summary['intensity_sum'], summary['intensity_sq_sum']))
+    return analysis
+
+
+def rebuild_user(store, user_id: str) -> Dict:
+    entries = [data for _, data in store.all_emotions(user_id)]
+    aggregates = build_aggregates(entries)
+    store.set_aggregates(user_id, aggregates)
+    return aggregates
+
+
+# Called after entries are written. A failed update leaves the aggregates
+# behind the raw data, so they are marked stale and rebuilt on the next read.
+def record_entries(store, user_id: str, entries: List[Dict]):
+    try:
+        store.increment_aggregates(user_id, build_increments(entries))
+    except Exception:
+        logger.exception('Failed to update aggregates for %s', user_id)
+        try:
+            store.clear_aggregates_meta(user_id)
+        except Exception:
+            logger.exception('Failed to mark aggregates stale for %s', user_id)
+
+
+# False when the aggregates are missing or were built with an older layout
+def is_current(meta: Optional[Dict]) -> bool:
+    return bool(meta) and meta.get('version') == AGGREGATES_VERSION
+
+
+# Changes whenever an entry is added. A rebuild recomputes the same count
+# for the same entries, so cached responses stay valid across rebuilds.
+# None when the aggregates are missing or stale.
+def data_version(store, user_id: str) -> Optional[int]:
+    meta = store.get_aggregates_meta(user_id)
+    return meta.get('count', 0) if is_current(meta) else None
+
+
+def day_range(days: int, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    now = now or datetime.now()
+    end_date = datetime.combine(now.date(), datetime.max.time())
+    start_date = datetime.combine(now.date() - timedelta(days=days - 1), datetime.min.time())
+    return start_date, end_date
@@ -0,0 +1,182 @@
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+import aggregates
+from emotion_entries import DAY_NAMES, SECONDS_PER_DAY, EmotionEntry
+from storage import local_seconds
+
+# Days in the rolling intensity average
+ROLLING_WINDOW = 7
+
+
+# A user's entries as columns: timestamps as int64 seconds (server local time,
+# as stored), emotions as int16 codes into `emotions` and intensities as int8
+# (int64 when some stored value does not fit).
+class EmotionColumns:
+    def __init__(self, timestamps: np.ndarray, codes: np.ndarray, intensities: np.ndarray,
+                 emotions: List[str]):
+        self.timestamps = timestamps
+        self.codes = codes
+        self.intensities = intensities
+        self.emotions = emotions
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+
+# Writes only accept the 1-10 scale, entries stored before that was checked
+# may hold any 64-bit value and keep the wide column
+def _intensity_column(intensities: np.ndarray) -> np.ndarray:
+    if len(intensities) and intensities.min() >= -128 and intensities.max() <= 127:
+        return intensities.astype(np.int8)
+    return intensities
+
+
+def load_columns(entries: Iterable[Tuple[str, Dict]]) -> EmotionColumns:
+    timestamps = []
+    legacy = []
+    intensities = []
+    codes = []
+    index = {}
+    for _, data in entries:
+        if 'ts' in data:
+            timestamps.append(int(local_seconds(data)))
+        else:
+            # ISO strings are parsed by numpy, all at once
+            legacy.append(len(timestamps))
+            timestamps.append(data['timestamp'])
+        intensities.append(data['intensity'])
+        codes.append(index.setdefault(data['emotion'], len(index)))
+
+    if legacy:
+        parsed = np.array([timestamps[i] for i in legacy], dtype='datetime64[s]').astype(np.int64)
+        for i, value in zip(legacy, parsed.tolist()):
+            timestamps[i] = value
+    seconds = np.array(timestamps, dtype=np.int64)
+    intensity_array = _intensity_column(np.array(intensities, dtype=np.int64))
+
+    # Entries usually arrive sorted already, stable sort keeps it cheap then
+    order = np.argsort(seconds, kind='stable')
+    return EmotionColumns(seconds[order], np.array(codes, dtype=np.int16)[order],
+                          intensity_array[order], list(index))
+
+
+# Same columns from compact entries, no timestamp parsing
+def load_entries(entries: Sequence[EmotionEntry]) -> EmotionColumns:
+    index = {}
+    seconds = np.fromiter((entry.seconds for entry in entries), dtype=np.float64, count=len(entries))
+    codes = np.fromiter((index.setdefault(entry.emotion, len(index)) for entry in entries),
+                        dtype=np.int16, count=len(entries))
+    intensity_array = _intensity_column(
+        np.fromiter((entry.intensity for entry in entries), dtype=np.int64, count=len(entries)))
+
+    seconds = np.floor(seconds).astype(np.int64)
+    order = np.argsort(seconds, kind='stable')
+    return EmotionColumns(seconds[order], codes[order], intensity_array[order], list(index))
+
+
+def _day_number(value: date) -> int:
+    return (value - date(1970, 1, 1)).days
+
+
+def _round(values: np.ndarray) -> List:
+    return [None if np.isnan(value) else round(float(value), 2) for value in values]
+
+
+# Long-range statistics for the days start_day..end_day (inclusive)
+def analyze(columns: EmotionColumns, start_day: date, end_day: date,
+            window: int = ROLLING_WINDOW) -> Dict:
+    first_day = _day_number(start_day)
+    n_days = _day_number(end_day) - first_day + 1
+
+    days = columns.timestamps // SECONDS_PER_DAY - first_day
+    in_range = (days >= 0) & (days < n_days)
+    days = days[in_range]
+    codes = columns.codes[in_range]
+    intensities = columns.intensities[in_range].astype(np.float64)
+    n_emotions = len(columns.emotions)
+
+    result = {
+        'total_entries': int(len(days)),
+        'average_intensity': None,
+        'intensity_std': None,
+        'mood_swings': False,
+        'volatile_days': [],
+        'daily': [],
+        'weekday_pattern': {},
+        'emotion_distribution': {},
+        'transitions': {'emotions': [], 'matrix': []}
+    }
+    if not len(days):
+        return result
+
+    result['average_intensity'] = round(float(intensities.mean()), 2)
+    result['intensity_std'] = round(float(intensities.std()), 2)
+    result['mood_swings'] = aggregates.mood_swings(float(intensities.std()))
+
+    # Per-day count, sum and sum of squares over every calendar day
+    counts = np.bincount(days, minlength=n_days)
+    sums = np.bincount(days, weights=intensities, minlength=n_days)
+    squares = np.bincount(days, weights=intensities ** 2, minlength=n_days)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        daily_mean = sums / counts
+        daily_std = np.sqrt(np.maximum(squares / counts - daily_mean ** 2, 0))
+
+    # Rolling average over the last `window` calendar days
+    count_cumsum = np.concatenate(([0], np.cumsum(counts)))
+    sum_cumsum = np.concatenate(([0.0], np.cumsum(sums)))
+    lower = np.maximum(np.arange(n_days) + 1 - window, 0)
+    rolling_counts = count_cumsum[1:] - count_cumsum[lower]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rolling_mean = (sum_cumsum[1:] - sum_cumsum[lower]) / rolling_counts
+
+    active = np.nonzero(counts)[0]
+    means = _round(daily_mean[active])
+    stds = _round(daily_std[active])
+    rolling = _round(rolling_mean[active])
+    volatile = daily_std[active].tolist()
+    for i, day in enumerate(active):
+        result['daily'].append({
+            'date': (start_day + timedelta(days=int(day))).isoformat(),
+            'entries': int(counts[day]),
+            'average_intensity': means[i],
+            'intensity_std': stds[i],
+            'rolling_average': rolling[i]
+        })
+        # Days that swing on their own
+        if aggregates.mood_swings(volatile[i]):
+            result['volatile_days'].append(result['daily'][-1]['date'])
+
+    # 1970-01-01 was a Thursday
+    weekdays = (days + first_day + 3) % 7
+    weekday_counts = np.bincount(weekdays, minlength=7)
+    weekday_sums = np.bincount(weekdays, weights=intensities, minlength=7)
+    for weekday in np.nonzero(weekday_counts)[0]:
+        result['weekday_pattern'][DAY_NAMES[weekday]] = round(float(weekday_sums[weekday] / weekday_counts[weekday]), 2)
+
+    emotion_counts = np.bincount(codes, minlength=n_emotions)
+    emotion_sums = np.bincount(codes, weights=intensities, minlength=n_emotions)
+    present = np.nonzero(emotion_counts)[0]
+    for code in present:
+        result['emotion_distribution'][columns.emotions[code]] = {
+            'frequency': int(emotion_counts[code]),
+            'average_intensity': round(float(emotion_sums[code] / emotion_counts[code]), 2),
+            'percentage': round(float(emotion_counts[code] / len(codes) * 100), 2)
+        }
+
+    # Counts of each (previous emotion, next emotion) pair, in time order
+    transitions = np.bincount(codes[:-1].astype(np.int64) * n_emotions + codes[1:],
+                              minlength=n_emotions * n_emotions).reshape(n_emotions, n_emotions)
+    transitions = transitions[np.ix_(present, present)]
+    result['transitions'] = {
+        'emotions': [columns.emotions[code] for code in present],
+        'matrix': transitions.tolist()
+    }
+    return result
+
+
+def analyze_entries(entries: Sequence[EmotionEntry], start_date: datetime,
+                    end_date: datetime) -> Dict:
+    return analyze(load_entries(entries), start_date.date(), end_date.date())
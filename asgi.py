@@ -0,0 +1,514 @@
+"""Async entry point for I/O-bound serving.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Serves the auth, profile and emotion routes of main.py with async handlers.
+Realtime Database and sign-in calls use non-blocking HTTP, so one process
+keeps many requests in flight while they wait on Firebase. Admin SDK calls
+(register, profile lookups and updates) and non-Firebase storage backends run
+in worker threads. Validation and response bodies are shared with main.py.
+"""
+import asyncio
+import os
+from datetime import datetime
+from functools import wraps
+
+import httpx
+from quart import Quart, Response, g, jsonify, request
+
+import aggregates
+import async_store
+import clients
+import emotion_entries
+import events
+import main
+import metrics
+import rollups
+import snapshots
+from ratelimit import AsyncSingleFlight, RateLimited, client_ip, flight_key
+from storage import entry_json, position
+
+app = Quart(__name__)
+metrics.instrument_quart(app)
+
+# Created when the server starts, in the worker process
+emotion_store = None
+
+# Identity Toolkit calls for login
+auth_client = None
+
+# Identical concurrent sign-in and registration attempts share one call
+auth_flights = AsyncSingleFlight()
+
+
+@app.before_serving
+async def open_clients():
+    global emotion_store, auth_client
+    emotion_store = async_store.create_async_store(clients.emotion_store(),
+                                                   clients.firebase_config()['databaseURL'])
+    emotion_store.open()
+    auth_client = httpx.AsyncClient(timeout=async_store.TIMEOUT)
+
+
+@app.after_serving
+async def close_clients():
+    await emotion_store.close()
+    await auth_client.aclose()
+
+
+def require_auth(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return jsonify({'error': 'No authorization header'}), 401
+
+        try:
+            token = auth_header.split(' ')[1]
+            # In a worker thread, a signing key refresh blocks on the certificate fetch
+            with metrics.phase('auth'):
+                request.user = await asyncio.to_thread(clients.token_verifier().verify, token)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 401
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+# See main.cached_response
+def cached_response(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        user_id = request.user['uid']
+        try:
+            version = await async_store.data_version(emotion_store, user_id)
+            if version is None:
+                rebuilt = await asyncio.to_thread(aggregates.rebuild_user, clients.emotion_store(), user_id)
+                version = rebuilt['meta']['count']
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+        g.data_version = version
+
+        etag = main.response_etag(user_id, version, request.endpoint, request.args)
+        headers = {'ETag': '"{0}"'.format(etag), 'Cache-Control': 'private, no-cache'}
+        if request.if_none_match.contains(etag):
+            main.response_cache.not_modified += 1
+            return Response('', status=304, headers=headers)
+
+        body = main.response_cache.get(etag)
+        if body is not None:
+            return Response(body, mimetype='application/json', headers=headers)
+
+        response = await app.make_response(await f(*args, **kwargs))
+        if response.status_code == 200:
+            main.response_cache.set(etag, await response.get_data())
+            response.headers.extend(headers)
+        return response
+    return decorated_function
+
+
+# Local buckets are checked inline, the shared backend in a worker thread
+async def check_rate(email):
+    limiter = clients.auth_limiter()
+    ip = client_ip(request.access_route, request.remote_addr)
+    if limiter.buckets.shared:
+        await asyncio.to_thread(limiter.check, ip=ip, email=email)
+    else:
+        limiter.check(ip=ip, email=email)
+
+
+@app.route('/api/register', methods=['POST'])
+async def register():
+    try:
+        data = await request.get_json()
+        email = data.get('email')
+        password = data.get('password')
+        name = data.get('name')
+        photo_url = data.get('photo_url', main.DEFAULT_PROFILE_IMAGE)
+
+        if not email or not password or not name:
+            return jsonify({'error': 'Missing required fields'}), 400
+
+        await check_rate(email)
+
+        async def create_user():
+            with metrics.upstream('auth', 'create_user'):
+                return await asyncio.to_thread(
+                    clients.auth().create_user,
+                    email=email,
+                    password=password,
+                    display_name=name,
+                    photo_url=photo_url
+                )
+
+        user = await auth_flights.do(flight_key('register', email, password, name, photo_url), create_user)
+
+        return jsonify({
+            'message': 'Successfully registered',
+            'user_id': user.uid,
+            'email': user.email,
+            'name': user.display_name,
+            'photo_url': user.photo_url
+        }), 201
+
+    except RateLimited as e:
+        return jsonify({'error': str(e)}), 429, e.headers()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/login', methods=['POST'])
+async def login():
+    try:
+        data = await request.get_json()
+        email = data.get('email')
+        password = data.get('password')
+
+        if not email or not password:
+            return jsonify({'error': 'Missing email or password'}), 400
+
+        await check_rate(email)
+
+        async def sign_in():
+            with metrics.upstream('auth', 'sign_in'):
+                response = await auth_client.post(
+                    clients.sign_in_url(),
+                    json={'email': email, 'password': password, 'returnSecureToken': True})
+                if response.is_error:
+                    raise Exception(response.text)
+            user = response.json()
+            return user, await asyncio.to_thread(main.user_cache.get_user, user['localId'])
+
+        user, user_info = await auth_flights.do(flight_key('login', email, password), sign_in)
+
+        return jsonify({
+            'message': 'Successfully logged in',
+            'user_id': user_info['uid'],
+            'email': user_info['email'],
+            'name': user_info['display_name'],
+            'id_token': user['idToken']
+        })
+
+    except RateLimited as e:
+        return jsonify({'error': str(e)}), 429, e.headers()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 401
+
+
+@app.route('/api/logout', methods=['POST'])
+@require_auth
+async def logout():
+    return jsonify({'message': 'Successfully logged out'})
+
+
+@app.route('/api/protected', methods=['GET'])
+@require_auth
+async def protected_route():
+    return jsonify({
+        'message': 'Access granted',
+        'user_id': request.user['uid']
+    })
+
+
+@app.route('/user/profile/', methods=['GET'])
+@require_auth
+async def get_profile():
+    try:
+        user = await asyncio.to_thread(main.user_cache.get_profile, request.user)
+
+        return jsonify({
+            'user_id': user['uid'],
+            'email': user['email'],
+            'name': user['display_name'],
+            'photo_url': user['photo_url'],
+            'email_verified': user['email_verified']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/user/profile/', methods=['PUT'])
+@require_auth
+async def update_profile():
+    try:
+        user_id = request.user['uid']
+        data = await request.get_json()
+
+        update_params = {}
+        if 'display_name' in data:
+            update_params['display_name'] = data['display_name']
+        if 'photo_url' in data:
+            update_params['photo_url'] = data.get('photo_url', main.DEFAULT_PROFILE_IMAGE)
+
+        user = await asyncio.to_thread(main.user_cache.update_user, user_id, **update_params)
+
+        return jsonify({
+            'message': 'Profile updated successfully',
+            'user_id': user['uid'],
+            'email': user['email'],
+            'name': user['display_name'],
+            'photo_url': user['photo_url']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# See main.publish_entries. The shared broker publishes from a worker thread.
+async def publish_entries(user_id, keys, entries):
+    try:
+        broker = clients.event_broker()
+        if broker.shared:
+            await asyncio.to_thread(broker.publish, user_id, keys, entries)
+        else:
+            broker.publish(user_id, keys, entries)
+    except Exception:
+        app.logger.exception('Failed to publish entries of %s', user_id)
+
+
+@app.route('/api/emotions', methods=['POST'])
+@require_auth
+async def save_emotion():
+    try:
+        user_id = request.user['uid']
+        data = await request.get_json()
+
+        emotion_data = main.build_emotion_entry(data, user_id, datetime.now())
+
+        write_queue = clients.write_queue()
+        if write_queue is not None:
+            key = emotion_store.new_key(emotion_data['ts'])
+            try:
+                await asyncio.to_thread(write_queue.enqueue, user_id, key, emotion_data)
+            except main.QueueFull as e:
+                return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+
+            # Streams get the entry from the flusher, once it is stored
+            return jsonify({
+                'message': 'Emotion queued',
+                'id': key,
+                'data': entry_json(emotion_data)
+            }), 202
+
+        key = await emotion_store.add_emotion(user_id, emotion_data)
+        await async_store.record_entries(emotion_store, user_id, [emotion_data])
+        main.snapshot_refresher.schedule(user_id)
+        await publish_entries(user_id, [key], [emotion_data])
+
+        return jsonify({
+            'message': 'Emotion saved successfully',
+            'data': entry_json(emotion_data)
+        }), 201
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/emotions/batch', methods=['POST'])
+@require_auth
+async def save_emotions_batch():
+    try:
+        user_id = request.user['uid']
+        data = await request.get_json()
+
+        items = data.get('entries') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'A non-empty list of entries is required'}), 400
+        if len(items) > main.MAX_BATCH_SIZE:
+            return jsonify({'error': 'At most {0} entries per batch'.format(main.MAX_BATCH_SIZE)}), 400
+
+        entries, results = main.validate_batch(items, user_id)
+        if not entries:
+            return jsonify({'error': 'No valid entries', 'results': results}), 400
+
+        keys = await emotion_store.add_emotions(user_id, entries)
+        await async_store.record_entries(emotion_store, user_id, entries)
+        main.snapshot_refresher.schedule(user_id)
+        await publish_entries(user_id, keys, entries)
+        keys = iter(keys)
+        for result in results:
+            if result['status'] == 'created':
+                result['id'] = next(keys)
+
+        created = len(entries)
+        return jsonify({
+            'message': '{0} of {1} emotions saved'.format(created, len(items)),
+            'results': results
+        }), 201 if created == len(items) else 207
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+# See main.stream_emotions. An idle stream is a suspended coroutine and its
+# queue, it wakes up for new frames and heartbeats only.
+@app.route('/api/emotions/stream', methods=['GET'])
+@require_auth
+async def stream_emotions():
+    user_id = request.user['uid']
+    clients.event_broker()
+    subscription = events.AsyncSubscription(user_id)
+    if not events.hub.subscribe(subscription):
+        return jsonify({'error': 'Too many open streams'}), 503, {'Retry-After': '30'}
+
+    async def generate():
+        async for chunk in events.astream(subscription):
+            yield chunk.encode('utf-8')
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Open until the client goes away
+    response.timeout = None
+    return response
+
+
+# Entries and rollup buckets of one period. The entries and the rollups meta
+# are read concurrently, open days are built from the entries.
+async def _period_data(user_id, start_date, end_date, weekly=False):
+    rollups.active_users.add(user_id)
+    rows, meta = await asyncio.gather(emotion_store.query_emotions(user_id, start_date, end_date),
+                                      emotion_store.get_rollups_meta(user_id))
+    plan = rollups.read_plan(meta, start_date.date(), end_date.date(), weekly)
+    return rows, await async_store.plan_buckets(emotion_store, user_id, plan, rows)
+
+
+@app.route('/api/emotions/history', methods=['GET'])
+@require_auth
+@cached_response
+async def get_emotion_history():
+    try:
+        user_id = request.user['uid']
+        period = request.args.get('period', 'week')
+
+        if period not in main.PERIOD_DAYS:
+            return jsonify({'error': 'Invalid period'}), 400
+        start_date, end_date = aggregates.day_range(main.PERIOD_DAYS[period])
+
+        page = main.parse_page_args(request.args)
+        if page is not None:
+            # The statistics still cover the whole period, fetched alongside
+            limit, after = page
+            emotions, buckets = await asyncio.gather(
+                emotion_store.page_emotions(user_id, start_date, end_date, limit + 1, after),
+                async_store.rollup_buckets(emotion_store, user_id, start_date.date(), end_date.date(), True))
+            emotions, next_cursor = main.split_page(emotions, limit)
+        else:
+            emotions, buckets = await _period_data(user_id, start_date, end_date, weekly=True)
+        emotions = emotion_entries.from_rows(emotions)
+        result = main.history_payload(period, start_date, end_date, emotions, buckets)
+        if page is not None:
+            result['next_cursor'] = next_cursor
+        return jsonify(result)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/emotions/export', methods=['GET'])
+@require_auth
+async def export_emotions():
+    try:
+        user_id = request.user['uid']
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in main.EXPORT_FORMATS:
+            return jsonify({'error': 'Invalid format'}), 400
+
+        period = request.args.get('period')
+        if period is None:
+            start_date, end_date = datetime.min, datetime.max
+        elif period in main.PERIOD_DAYS:
+            start_date, end_date = aggregates.day_range(main.PERIOD_DAYS[period])
+        else:
+            return jsonify({'error': 'Invalid period'}), 400
+
+        # First page before answering so that errors still get a 400
+        page_size = 500
+        page = await emotion_store.page_emotions(user_id, start_date, end_date, page_size)
+
+        async def generate():
+            header, serialize, _ = main.EXPORT_FORMATS[export_format]
+            current = page
+            try:
+                if header:
+                    yield header.encode('utf-8')
+                while True:
+                    for row in main.export_rows(current):
+                        yield serialize(row).encode('utf-8')
+                    if len(current) < page_size:
+                        return
+                    current = await emotion_store.page_emotions(
+                        user_id, start_date, end_date, page_size, position(current[-1]))
+            except Exception:
+                app.logger.exception('Emotion export for %s failed', user_id)
+
+        filename = 'emotions.{0}'.format(export_format)
+        return Response(generate(), mimetype=main.EXPORT_FORMATS[export_format][2],
+                        headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/api/emotions/analysis', methods=['GET'])
+@require_auth
+@cached_response
+async def analyze_emotions():
+    try:
+        user_id = request.user['uid']
+        period = request.args.get('period', 'week')
+
+        if period not in main.PERIOD_DAYS:
+            return jsonify({'error': 'Invalid period'}), 400
+
+        now = datetime.now()
+        version = snapshots.version(g.data_version, now.date(), main.mood_engine.catalog_version)
+        body = main.snapshot_refresher.fresh_body(await emotion_store.get_snapshot(user_id, 'analysis_' + period),
+                                                  version)
+        if body is None:
+            start_date, end_date = aggregates.day_range(main.PERIOD_DAYS[period], now)
+            rollups.active_users.add(user_id)
+            meta, rows = await asyncio.gather(emotion_store.get_rollups_meta(user_id),
+                                              emotion_store.query_emotions(user_id, start_date, end_date))
+            plan = rollups.read_plan(meta, start_date.date(), end_date.date())
+            buckets = await async_store.plan_buckets(emotion_store, user_id, plan, rows)
+            body = main.analysis_bodies([period], now, rows, buckets)[period]
+            del rows
+            try:
+                await emotion_store.set_snapshots(user_id, {'analysis_' + period: snapshots.snapshot(version, body)})
+            except Exception:
+                app.logger.exception('Failed to store the analysis snapshot of %s', user_id)
+        return Response(body, mimetype='application/json')
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/', methods=['GET'])
+async def home():
+    return jsonify(main.api_index())
+
+
+@app.route('/metrics/db-pool', methods=['GET'])
+async def db_pool_metrics():
+    return jsonify(clients.db_pool().stats())
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    return Response(metrics.render(main.metric_stats(auth_flights)), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/response-cache', methods=['GET'])
+async def response_cache_metrics():
+    return jsonify(main.response_cache.stats())
+
+
+@app.route('/test', methods=['GET'])
+async def test():
+    return jsonify({
+        'status': 'success',
+        'message': 'API is working correctly'
+    })
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', 10000)))
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+import aggregates
+import metrics
+import rollups
+import storage
+from storage import FirebaseEmotionStore, format_timestamp, position, push_keys
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to the Realtime Database by one async worker. Async
+# workers keep many requests in flight, so this is larger than the sync pool.
+POOL_SIZE = int(os.getenv('FIREBASE_ASYNC_POOL_SIZE', 100))
+TIMEOUT = float(os.getenv('FIREBASE_DB_TIMEOUT', 10))
+
+
+# Realtime Database REST calls over a non-blocking keep-alive client, same
+# paths and queries as FirebaseEmotionStore. The client is bound to the
+# event loop it is used on, open() and close() run with the server.
+class AsyncFirebaseEmotionStore:
+    def __init__(self, database_url: str, pool_size: int = POOL_SIZE, timeout: float = TIMEOUT,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.database_url = database_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.transport = transport
+        self.client = None
+
+    def open(self):
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size,
+                                max_keepalive_connections=self.pool_size),
+            timeout=self.timeout,
+            transport=self.transport)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def new_key(self, ms: Optional[int] = None) -> str:
+        return push_keys.generate(ms)
+
+    async def _request(self, method: str, path: str, params: Optional[Dict] = None, body=None):
+        with metrics.upstream('database', method):
+            response = await self.client.request(
+                method, '{0}/{1}.json'.format(self.database_url, path), params=params,
+                content=None if body is None else json.dumps(body))
+            response.raise_for_status()
+        return response.json()
+
+    async def _query(self, path: str, order_by: str, start: str, end: str,
+                     limit: Optional[int] = None) -> Dict:
+        params = {
+            'orderBy': json.dumps(order_by),
+            'startAt': json.dumps(start),
+            'endAt': json.dumps(end)
+        }
+        if limit is not None:
+            params['limitToFirst'] = limit
+        return await self._request('GET', path, params) or {}
+
+    async def add_emotion(self, user_id: str, emotion_data: Dict) -> str:
+        key = self.new_key(storage.entry_ms(emotion_data))
+        await self.put_emotions(user_id, {key: emotion_data})
+        return key
+
+    async def add_emotions(self, user_id: str, entries: List[Dict]) -> List[str]:
+        keys = [self.new_key(storage.entry_ms(entry)) for entry in entries]
+        await self.put_emotions(user_id, dict(zip(keys, entries)))
+        return keys
+
+    async def put_emotions(self, user_id: str, entries: Dict[str, Dict]):
+        await self._request('PATCH', 'users/{0}/emotions'.format(user_id), body=entries)
+
+    async def replace_emotions(self, user_id: str, entries: Dict[str, Dict], removed: List[str]):
+        updates = dict.fromkeys(removed)
+        updates.update(entries)
+        await self._request('PATCH', 'users/{0}/emotions'.format(user_id), body=updates)
+
+    async def all_emotions(self, user_id: str) -> List[Tuple[str, Dict]]:
+        emotions = await self._request('GET', 'users/{0}/emotions'.format(user_id)) or {}
+        return list(emotions.items())
+
+    # See FirebaseEmotionStore._key_range
+    async def _key_range(self, user_id: str, start_key: str, end_key: str,
+                         limit: Optional[int] = None) -> Tuple[List[Tuple[str, Dict]], bool]:
+        emotions = await self._query('users/{0}/emotions'.format(user_id), '$key', start_key, end_key, limit)
+        rows = sorted(emotions.items())
+        return [row for row in rows if 'ts' in row[1]], limit is None or len(rows) < limit
+
+    async def _scan_emotions(self, user_id: str, start_date: datetime,
+                             end_date: datetime) -> List[Tuple[str, Dict]]:
+        rows = []
+        for key, data in await self.all_emotions(user_id):
+            if storage.is_legacy(data) and start_date <= datetime.fromisoformat(data['timestamp']) <= end_date:
+                rows.append((key, data))
+        return sorted(rows, key=position)
+
+    async def _indexed(self, user_id: str, start: str, end_date: datetime,
+                       limit: Optional[int] = None) -> Optional[List[Tuple[str, Dict]]]:
+        try:
+            emotions = await self._query('users/{0}/emotions'.format(user_id), 'timestamp',
+                                         start, format_timestamp(end_date), limit)
+        except httpx.HTTPStatusError as e:
+            # No '.indexOn' rule yet, see migrate_emotions.py
+            if 'Index not defined' not in e.response.text:
+                raise
+            return None
+        return sorted(emotions.items(), key=position)
+
+    # See FirebaseEmotionStore.query_emotions, both queries run concurrently
+    async def query_emotions(self, user_id: str, start_date: datetime,
+                             end_date: datetime) -> List[Tuple[str, Dict]]:
+        if not storage.LEGACY_READS:
+            rows, _ = await self._key_range(user_id, *storage.key_range(start_date, end_date))
+            return rows
+        (rows, _), legacy = await asyncio.gather(
+            self._key_range(user_id, *storage.key_range(start_date, end_date)),
+            self._legacy_query(user_id, start_date, end_date))
+        return storage.merge_rows(rows, legacy)
+
+    async def _legacy_query(self, user_id: str, start_date: datetime,
+                            end_date: datetime) -> List[Tuple[str, Dict]]:
+        rows = await self._indexed(user_id, format_timestamp(start_date), end_date)
+        if rows is None:
+            return await self._scan_emotions(user_id, start_date, end_date)
+        return rows
+
+    async def page_emotions(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                            after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        if not storage.LEGACY_READS:
+            return await self._page_keys(user_id, start_date, end_date, limit, after)
+        rows, legacy = await asyncio.gather(
+            self._page_keys(user_id, start_date, end_date, limit, after),
+            self._legacy_page(user_id, start_date, end_date, limit, after))
+        return storage.merge_rows(rows, legacy)[:limit]
+
+    # See FirebaseEmotionStore._page_keys
+    async def _page_keys(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                         after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        start_key, end_key = storage.key_range(start_date, end_date)
+        if after is not None:
+            start_key = max(start_key, storage.key_floor(after[0]))
+        fetch = limit + 1
+        while True:
+            rows, complete = await self._key_range(user_id, start_key, end_key, fetch)
+            if after is not None:
+                rows = [row for row in rows if position(row) > after]
+            if len(rows) >= limit or complete:
+                return rows[:limit]
+            fetch *= 2
+
+    # See FirebaseEmotionStore._legacy_page
+    async def _legacy_page(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                           after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        start = format_timestamp(start_date)
+        if after is not None:
+            start = max(start, storage.legacy_floor(after[0]))
+        fetch = limit + 1
+        while True:
+            rows = await self._indexed(user_id, start, end_date, fetch)
+            complete = rows is None or len(rows) < fetch
+            if rows is None:
+                rows = await self._scan_emotions(user_id, start_date, end_date)
+            if after is not None:
+                rows = [row for row in rows if position(row) > after]
+            if len(rows) >= limit or complete:
+                return rows[:limit]
+            fetch *= 2
+
+    async def increment_aggregates(self, user_id: str, increments: Dict):
+        await self._request('PATCH', 'users/{0}/aggregates'.format(user_id), body=increments)
+
+    async def get_aggregates_meta(self, user_id: str) -> Optional[Dict]:
+        return await self._request('GET', 'users/{0}/aggregates/meta'.format(user_id))
+
+    async def clear_aggregates_meta(self, user_id: str):
+        await self._request('DELETE', 'users/{0}/aggregates/meta'.format(user_id))
+
+    async def update_rollups(self, user_id: str, updates: Dict):
+        await self._request('PATCH', 'users/{0}/rollups'.format(user_id), body=updates)
+
+    async def get_rollups_meta(self, user_id: str) -> Optional[Dict]:
+        return await self._request('GET', 'users/{0}/rollups/meta'.format(user_id))
+
+    async def get_rollups(self, user_id: str, kind: str, start_key: str, end_key: str) -> Dict[str, Dict]:
+        return await self._query('users/{0}/rollups/{1}'.format(user_id, kind), '$key', start_key, end_key)
+
+    async def set_snapshots(self, user_id: str, snapshots: Dict[str, Dict]):
+        await self._request('PATCH', 'users/{0}/snapshots'.format(user_id), body=snapshots)
+
+    async def get_snapshot(self, user_id: str, name: str) -> Optional[Dict]:
+        return await self._request('GET', 'users/{0}/snapshots/{1}'.format(user_id, name))
+
+
+# Any other EmotionStore, each call run in a worker thread
+class ThreadedEmotionStore:
+    def __init__(self, store):
+        self.store = store
+
+    def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def new_key(self, ms: Optional[int] = None) -> str:
+        return self.store.new_key(ms)
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+def create_async_store(store, database_url: str):
+    if isinstance(store, FirebaseEmotionStore):
+        return AsyncFirebaseEmotionStore(database_url)
+    return ThreadedEmotionStore(store)
+
+
+# Async counterparts of rollups.record_entries and buckets and of
+# aggregates.data_version
+async def record_entries(store, user_id: str, entries: List[Dict]):
+    try:
+        await store.increment_aggregates(user_id, aggregates.build_increments(entries))
+    except Exception:
+        logger.exception('Failed to update aggregates for %s', user_id)
+        try:
+            await store.clear_aggregates_meta(user_id)
+        except Exception:
+            logger.exception('Failed to mark aggregates stale for %s', user_id)
+
+    rollups.active_users.add(user_id)
+    marks = rollups.late_entry_marks(entries)
+    if marks:
+        try:
+            await store.update_rollups(user_id, marks)
+        except Exception:
+            logger.exception('Failed to mark rollups dirty for %s', user_id)
+
+
+async def rollup_buckets(store, user_id: str, start_day, end_day, weekly: bool = False) -> Dict[str, Dict]:
+    rollups.active_users.add(user_id)
+    plan = rollups.read_plan(await store.get_rollups_meta(user_id), start_day, end_day, weekly)
+    return await plan_buckets(store, user_id, plan)
+
+
+# Reads of the plan run concurrently. Raw days are built from rows when the
+# caller already read every entry of the range, queried otherwise.
+async def plan_buckets(store, user_id: str, plan: Dict,
+                       rows: Optional[List[Tuple[str, Dict]]] = None) -> Dict[str, Dict]:
+    raw = [] if rows is not None else plan['raw']
+    reads = [store.query_emotions(user_id, start_date, end_date) for start_date, end_date in raw]
+    reads.extend(store.get_rollups(user_id, 'daily', start_key, end_key) for start_key, end_key in plan['daily'])
+    if plan['weeks']:
+        reads.append(store.get_rollups(user_id, 'weekly', plan['weeks'][0], plan['weeks'][-1]))
+    results = await asyncio.gather(*reads)
+
+    result = rollups.raw_buckets(plan, rows) if rows is not None else {}
+    for raw_rows in results[:len(raw)]:
+        result.update(rollups.build_daily(data for _, data in raw_rows))
+    for docs in results[len(raw):len(raw) + len(plan['daily'])]:
+        result.update(docs)
+    if plan['weeks']:
+        result.update((key, doc) for key, doc in results[-1].items() if key in plan['weeks'])
+    return result
+
+
+async def data_version(store, user_id: str) -> Optional[int]:
+    meta = await store.get_aggregates_meta(user_id)
+    return meta.get('count', 0) if aggregates.is_current(meta) else None
@@ -0,0 +1,73 @@
+"""Benchmark the vectorized analytics over synthetic histories.
+
+Usage:
+    python benchmarks/analytics.py [--sizes 10000 100000 1000000]
+
+Reports the time to build the columns from stored entries and the time of
+one full analysis pass, next to a per-entry Python loop computing only the
+weekday pattern and emotion distribution (what the endpoint used to do).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+from storage import format_timestamp  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'calm', 'confused', 'frustrated']
+
+
+def make_entries(count, end):
+    # Spread over ten years at most, oldest first like the range queries return them
+    span = min(count * 600, 10 * 365 * 86400)
+    start = end - timedelta(seconds=span)
+    step = span / count
+    return [('k{0}'.format(i), {
+        'emotion': random.choice(EMOTIONS),
+        'intensity': random.randint(1, 10),
+        'note': '',
+        'timestamp': format_timestamp(start + timedelta(seconds=i * step))
+    }) for i in range(count)]
+
+
+def python_loop(entries):
+    emotion_trends = {}
+    daily_intensities = {i: [] for i in range(7)}
+    for _, data in entries:
+        emotion_date = datetime.fromisoformat(data['timestamp'])
+        daily_intensities[emotion_date.weekday()].append(data['intensity'])
+        trend = emotion_trends.setdefault(data['emotion'], {'count': 0, 'total_intensity': 0})
+        trend['count'] += 1
+        trend['total_intensity'] += data['intensity']
+    return emotion_trends, daily_intensities
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    end = datetime.now()
+    print('{0:>9} {1:>12} {2:>12} {3:>14}'.format('entries', 'columns ms', 'analyze ms', 'python loop ms'))
+    for size in args.sizes:
+        entries = make_entries(size, end)
+        start_date = datetime.fromisoformat(entries[0][1]['timestamp'])
+        columns, load_ms = timed(lambda: analytics.load_columns(entries))
+        _, analyze_ms = timed(lambda: analytics.analyze(columns, start_date.date(), end.date()))
+        _, loop_ms = timed(lambda: python_loop(entries))
+        print('{0:>9} {1:>12.1f} {2:>12.1f} {3:>14.1f}'.format(size, load_ms, analyze_ms, loop_ms))
+
+
+if __name__ == '__main__':
+    main()
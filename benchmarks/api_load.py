@@ -0,0 +1,311 @@
+"""Per-endpoint load test of the API, with a regression check against a stored baseline.
+
+Usage:
+    python benchmarks/api_load.py [--target inprocess gunicorn] [--endpoints history_week login ...]
+        [--users 200] [--duration 5] [--concurrency 16] [--workers 2]
+        [--db-latency 0.005] [--auth-latency 0.02]
+        [--save-baseline FILE | --baseline FILE [--tolerance 0.25] [--min-delta 1]]
+
+Runs fully offline. benchmarks/stub_firebase.py stands in for the Realtime
+Database and Firebase Auth (through FIREBASE_AUTH_EMULATOR_HOST), each call
+delayed by --db-latency or --auth-latency seconds. --users synthetic users
+get a year of history with realistic sizes (log-normal, median 40 entries,
+a few heavy users with thousands) and an account to sign in with. Each
+endpoint is then loaded on its own for --duration seconds by --concurrency
+clients, against the Flask app in this process (test clients on threads)
+and/or gunicorn wsgi:app with --workers processes. The response cache is
+disabled so every GET runs its handler.
+
+Reports requests per second and p50/p95/p99 latency per endpoint.
+--save-baseline writes the results to FILE; --baseline compares against
+FILE and exits with status 1 when an endpoint's p95 grew (by --tolerance, a
+fraction, and at least --min-delta ms), its throughput dropped by more than
+--tolerance or it started returning errors.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from google.auth import crypt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_serving import (KEY_ID, PROJECT_ID, ROOT, free_port, make_key, make_token,  # noqa: E402
+                           percentile, service_account, wait_until_up)
+from storage import build_entry, push_keys  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated', 'calm']
+NOTES = ['', '', '', 'Long day at work', 'Went for a run with friends', 'Slept badly']
+PASSWORD = 'bench-password'
+
+# Each endpoint: (method, path, JSON body or None) for a user, in the order
+# they are loaded. Saves run last since they make the snapshots stale.
+ENDPOINTS = {
+    'protected': lambda user, rng: ('GET', '/api/protected', None),
+    'profile': lambda user, rng: ('GET', '/user/profile/', None),
+    'history_week': lambda user, rng: ('GET', '/api/emotions/history?period=week', None),
+    'history_year': lambda user, rng: ('GET', '/api/emotions/history?period=year', None),
+    'analysis_month': lambda user, rng: ('GET', '/api/emotions/analysis?period=month', None),
+    'login': lambda user, rng: ('POST', '/api/login', {'email': user['email'], 'password': PASSWORD}),
+    'save_emotion': lambda user, rng: ('POST', '/api/emotions', {
+        'emotion': rng.choice(EMOTIONS), 'intensity': rng.randint(1, 10), 'note': rng.choice(NOTES)})
+}
+
+
+def history_size(rng):
+    return min(int(rng.lognormvariate(math.log(40), 1.1)), 5000)
+
+
+def seed_users(stub_url, count, signer, rng):
+    users = []
+    now = datetime.now()
+    auth_url = '{0}/identitytoolkit.googleapis.com/v1/projects/{1}/accounts'.format(stub_url, PROJECT_ID)
+    with httpx.Client(timeout=60) as client:
+        for i in range(count):
+            user_id = 'bench-user-{0:05d}'.format(i)
+            email = '{0}@bench.moodmate'.format(user_id)
+            client.post(auth_url, json={'localId': user_id, 'email': email, 'password': PASSWORD,
+                                        'displayName': 'Bench User {0}'.format(i)}).raise_for_status()
+            entries = [build_entry(rng.choice(EMOTIONS), rng.randint(1, 10), rng.choice(NOTES),
+                                   now - timedelta(seconds=rng.random() * 365 * 86400), user_id)
+                       for _ in range(history_size(rng))]
+            entries = {push_keys.generate(entry['ts']): entry for entry in entries}
+            if entries:
+                client.patch('{0}/users/{1}/emotions.json'.format(stub_url, user_id),
+                             json=entries).raise_for_status()
+            users.append({'id': user_id, 'email': email, 'entries': len(entries),
+                          'headers': {'Authorization': 'Bearer ' + make_token(signer, user_id)}})
+    return users
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    if not latencies:
+        return {'requests': 0, 'rps': 0, 'p50': 0, 'p95': 0, 'p99': 0, 'errors': errors}
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50': round(statistics.median(latencies) * 1000, 2),
+        'p95': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99': round(percentile(latencies, 0.99) * 1000, 2),
+        'errors': errors
+    }
+
+
+# Flask test clients on threads, in this process
+def load_inprocess(app, endpoint, users, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+
+    def client_loop(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            user = rng.choice(users)
+            method, path, body = ENDPOINTS[endpoint](user, rng)
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body, headers=user['headers'])
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop, args=(seed,)) for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, len(errors), time.perf_counter() - start)
+
+
+# HTTP clients on one event loop, against a server
+async def load_server(base_url, endpoint, users, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def client_loop(seed):
+            nonlocal errors
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                user = rng.choice(users)
+                method, path, body = ENDPOINTS[endpoint](user, rng)
+                start = time.perf_counter()
+                response = await client.request(method, path, json=body, headers=user['headers'])
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(seed) for seed in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def run_inprocess(args, users):
+    import main
+
+    app = main.create_app()
+    # Builds every user's aggregates before measuring
+    client = app.test_client()
+    for user in users:
+        client.get('/api/emotions/history?period=year', headers=user['headers'])
+    return {endpoint: load_inprocess(app, endpoint, users, args.concurrency, args.duration)
+            for endpoint in args.endpoints}
+
+
+def run_gunicorn(args, users, env):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'wsgi:app', '--bind', '127.0.0.1:{0}'.format(port),
+                               '--workers', str(args.workers), '--log-level', 'warning'], cwd=ROOT, env=env)
+    try:
+        base_url = 'http://127.0.0.1:{0}'.format(port)
+        wait_until_up(base_url + '/test', server)
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            for user in users:
+                client.get('/api/emotions/history?period=year', headers=user['headers'])
+        return {endpoint: asyncio.run(load_server(base_url, endpoint, users, args.concurrency, args.duration))
+                for endpoint in args.endpoints}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# Regressions of results against baseline, as printable strings. p95 has to
+# grow by min_delta ms as well, sub-millisecond endpoints jitter by more
+# than any sensible tolerance.
+def compare(results, baseline, tolerance, min_delta):
+    regressions = []
+    for target, endpoints in results.items():
+        for endpoint, result in endpoints.items():
+            base = baseline.get('results', {}).get(target, {}).get(endpoint)
+            if not base:
+                continue
+            if result['p95'] > max(base['p95'] * (1 + tolerance), base['p95'] + min_delta):
+                regressions.append('{0} {1}: p95 {2} ms, baseline {3} ms'.format(
+                    target, endpoint, result['p95'], base['p95']))
+            if result['rps'] < base['rps'] * (1 - tolerance):
+                regressions.append('{0} {1}: {2} req/s, baseline {3} req/s'.format(
+                    target, endpoint, result['rps'], base['rps']))
+            if result['errors'] and not base['errors']:
+                regressions.append('{0} {1}: {2} errors'.format(target, endpoint, result['errors']))
+    return regressions
+
+
+def print_results(results, baseline):
+    print('{0:<10} {1:<15} {2:>9} {3:>9} {4:>9} {5:>9} {6:>7} {7:>15}'.format(
+        'target', 'endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'p95 vs base'))
+    for target, endpoints in results.items():
+        for endpoint, result in endpoints.items():
+            base = (baseline or {}).get('results', {}).get(target, {}).get(endpoint)
+            change = '{0:+.0%}'.format(result['p95'] / base['p95'] - 1) if base and base['p95'] else '-'
+            print('{0:<10} {1:<15} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>7} {7:>15}'.format(
+                target, endpoint, result['rps'], result['p50'], result['p95'], result['p99'],
+                result['errors'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', nargs='+', choices=['inprocess', 'gunicorn'], default=['inprocess', 'gunicorn'])
+    parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=5, help='Seconds per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--db-latency', type=float, default=0.005)
+    parser.add_argument('--auth-latency', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-delta', type=float, default=1, help='Smallest p95 regression in ms')
+    args = parser.parse_args()
+    args.endpoints = [endpoint for endpoint in ENDPOINTS if endpoint in args.endpoints]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        private_pem, certs_path = make_key(directory)
+        signer = crypt.RSASigner.from_string(private_pem, key_id=KEY_ID)
+
+        stub_port = free_port()
+        stub_url = 'http://127.0.0.1:{0}'.format(stub_port)
+        env = dict(os.environ,
+                   STUB_LATENCY=str(args.db_latency),
+                   STUB_AUTH_LATENCY=str(args.auth_latency),
+                   STUB_CERTS=certs_path,
+                   GOOGLE_APPLICATION_CREDENTIALS_JSON=service_account(private_pem),
+                   FIREBASE_PROJECT_ID=PROJECT_ID,
+                   FIREBASE_API_KEY='bench',
+                   FIREBASE_DATABASE_URL=stub_url,
+                   FIREBASE_PUBLIC_KEYS_URL=stub_url + '/keys',
+                   FIREBASE_AUTH_EMULATOR_HOST='127.0.0.1:{0}'.format(stub_port),
+                   MOODMATE_STORAGE='firebase',
+                   RESPONSE_CACHE_MAX_BYTES='0',
+                   AUTH_RATE_LIMIT_IP='0',
+                   AUTH_RATE_LIMIT_EMAIL='0')
+        for name in ('EMOTION_WRITE_BEHIND', 'ROLLUP_INTERVAL', 'RATE_LIMIT_REDIS_URL'):
+            env.pop(name, None)
+
+        stub = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'benchmarks.stub_firebase:app',
+                                 '--port', str(stub_port), '--log-level', 'warning'], cwd=ROOT, env=env)
+        try:
+            wait_until_up(stub_url + '/keys', stub)
+            users = seed_users(stub_url, args.users, signer, random.Random(args.seed))
+            sizes = sorted(user['entries'] for user in users)
+            print('{0} users, entries per user p50 {1} / p95 {2} / max {3}; {4} clients, {5}s per endpoint, '
+                  'stub latency {6} ms database / {7} ms auth'.format(
+                      len(users), percentile(sizes, 0.5), percentile(sizes, 0.95), sizes[-1], args.concurrency,
+                      args.duration, args.db_latency * 1000, args.auth_latency * 1000))
+
+            results = {}
+            for target in args.target:
+                if target == 'inprocess':
+                    os.environ.update(env)
+                    results[target] = run_inprocess(args, users)
+                else:
+                    results[target] = run_gunicorn(args, users, env)
+        finally:
+            stub.terminate()
+            stub.wait()
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump({'settings': {key: getattr(args, key) for key in (
+                'users', 'duration', 'concurrency', 'workers', 'db_latency', 'auth_latency', 'seed')},
+                'results': results}, baseline_file, indent=2)
+        print('Baseline written to ' + args.save_baseline)
+
+    if baseline is not None:
+        changed = [key for key, value in baseline.get('settings', {}).items() if getattr(args, key, value) != value]
+        if changed:
+            print('Baseline was recorded with different ' + ', '.join(changed))
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regression beyond {0:.0%} of the baseline'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
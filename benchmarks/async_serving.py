@@ -0,0 +1,203 @@
+"""Load test the sync (gunicorn wsgi:app) and async (uvicorn asgi:app) modes.
+
+Usage:
+    python benchmarks/async_serving.py [--mode sync async] [--workers 1]
+        [--concurrency 100] [--duration 15] [--latency 0.02] [--users 50]
+
+Runs fully offline. benchmarks/stub_firebase.py stands in for the Realtime
+Database with --latency seconds per call, ID tokens are signed with a key
+generated for the run and verified against the stub's /keys endpoint. Each
+mode serves the same mix (70% GET /api/emotions/history, 30% POST
+/api/emotions) from --workers processes with the response cache disabled,
+so every request waits on the stub.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROJECT_ID = 'moodmate-bench'
+KEY_ID = 'bench-key'
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_key(directory):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, PROJECT_ID)])
+    now = datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+
+    certs_path = os.path.join(directory, 'certs.json')
+    with open(certs_path, 'w', encoding='utf-8') as certs_file:
+        json.dump({KEY_ID: cert.public_bytes(serialization.Encoding.PEM).decode()}, certs_file)
+    return private_pem, certs_path
+
+
+def make_token(signer, user_id):
+    now = int(time.time())
+    return jwt.encode(signer, {
+        'iss': 'https://securetoken.google.com/' + PROJECT_ID,
+        'aud': PROJECT_ID,
+        'sub': user_id,
+        'user_id': user_id,
+        'iat': now,
+        'auth_time': now,
+        'exp': now + 3600
+    }).decode()
+
+
+def service_account(private_pem):
+    return json.dumps({
+        'type': 'service_account',
+        'project_id': PROJECT_ID,
+        'private_key_id': KEY_ID,
+        'private_key': private_pem,
+        'client_email': 'bench@{0}.iam.gserviceaccount.com'.format(PROJECT_ID),
+        'client_id': '0',
+        'token_uri': 'https://oauth2.googleapis.com/token'
+    })
+
+
+def wait_until_up(url, process, timeout=30, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{0} exited with {1}'.format(url, process.returncode))
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(interval)
+    raise RuntimeError('{0} did not come up'.format(url))
+
+
+def server_command(mode, port, workers):
+    bind = '127.0.0.1:{0}'.format(port)
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', 'wsgi:app', '--bind', bind, '--workers', str(workers)]
+    return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--workers', str(workers),
+            '--log-level', 'warning']
+
+
+async def run_load(base_url, tokens, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def user_loop():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                headers = {'Authorization': 'Bearer ' + random.choice(tokens)}
+                start = time.perf_counter()
+                if random.random() < 0.7:
+                    response = await client.get('/api/emotions/history', headers=headers)
+                else:
+                    response = await client.post('/api/emotions', headers=headers, json={
+                        'emotion': random.choice(EMOTIONS), 'intensity': random.randint(1, 10)})
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user_loop() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', nargs='+', choices=['sync', 'async'], default=['sync', 'async'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        private_pem, certs_path = make_key(directory)
+        signer = crypt.RSASigner.from_string(private_pem, key_id=KEY_ID)
+        tokens = [make_token(signer, 'bench-user-{0}'.format(i)) for i in range(args.users)]
+
+        stub_port = free_port()
+        stub_url = 'http://127.0.0.1:{0}'.format(stub_port)
+        env = dict(os.environ,
+                   STUB_LATENCY=str(args.latency),
+                   STUB_CERTS=certs_path,
+                   GOOGLE_APPLICATION_CREDENTIALS_JSON=service_account(private_pem),
+                   FIREBASE_PROJECT_ID=PROJECT_ID,
+                   FIREBASE_API_KEY='bench',
+                   FIREBASE_DATABASE_URL=stub_url,
+                   FIREBASE_PUBLIC_KEYS_URL=stub_url + '/keys',
+                   MOODMATE_STORAGE='firebase',
+                   RESPONSE_CACHE_MAX_BYTES='0')
+        env.pop('EMOTION_WRITE_BEHIND', None)
+
+        stub = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'benchmarks.stub_firebase:app',
+                                 '--port', str(stub_port), '--log-level', 'warning'], cwd=ROOT, env=env)
+        try:
+            wait_until_up(stub_url + '/keys', stub)
+            print('{0} workers, {1} concurrent clients, {2}s per mode, {3}ms stub latency'.format(
+                args.workers, args.concurrency, args.duration, args.latency * 1000))
+            print('{0:<6} {1:>9} {2:>9} {3:>9} {4:>9} {5:>7}'.format(
+                'mode', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+
+            for mode in args.mode:
+                port = free_port()
+                server = subprocess.Popen(server_command(mode, port, args.workers), cwd=ROOT, env=env)
+                try:
+                    base_url = 'http://127.0.0.1:{0}'.format(port)
+                    wait_until_up(base_url + '/test', server)
+                    latencies, errors, elapsed = asyncio.run(
+                        run_load(base_url, tokens, args.concurrency, args.duration))
+                finally:
+                    server.terminate()
+                    server.wait()
+
+                latencies.sort()
+                print('{0:<6} {1:>9.1f} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>7}'.format(
+                    mode, len(latencies) / elapsed,
+                    statistics.median(latencies) * 1000,
+                    percentile(latencies, 0.95) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    errors))
+        finally:
+            stub.terminate()
+            stub.wait()
+
+
+if __name__ == '__main__':
+    main()
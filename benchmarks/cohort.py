@@ -0,0 +1,87 @@
+"""Scaling of the cohort report job with the number of worker processes.
+
+Usage:
+    python benchmarks/cohort.py [--users 100000] [--entries 14] [--days 7] [--workers 1 2 4]
+
+Runs cohort.run() over --users synthetic users, each with 0 to 2 * --entries
+entries in the period, generated on the fly from the user id by a stand-in
+store (the storage layer's iter_emotions() interface, no I/O), once per
+--workers value. Reports wall time, users per second and the speedup over
+the first value, and checks that every run produced the same report.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cohort  # noqa: E402
+from storage import format_timestamp  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+NOTES = ['', '', '', 'Long day at work', 'Went for a run with friends']
+
+END_DAY = datetime(2024, 5, 12).date()
+
+
+# Same entries for a user id in every process
+class SyntheticStore:
+    entries = 14
+
+    def iter_emotions(self, user_id, start_date, end_date, page_size=500):
+        rng = random.Random(user_id)
+        span = (end_date - start_date).total_seconds()
+        offsets = sorted(rng.random() * span for _ in range(rng.randint(0, 2 * self.entries)))
+        for i, offset in enumerate(offsets):
+            yield '{0}-{1}'.format(user_id, i), {
+                'emotion': rng.choice(EMOTIONS),
+                'intensity': rng.randint(1, 10),
+                'note': rng.choice(NOTES),
+                'timestamp': format_timestamp(start_date + timedelta(seconds=offset)),
+                'user_id': user_id
+            }
+
+
+def user_ids(count):
+    return ('user-{0:07d}'.format(i) for i in range(count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--entries', type=int, default=14, help='Average entries per user')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--chunk-size', type=int, default=cohort.CHUNK_SIZE)
+    args = parser.parse_args()
+
+    SyntheticStore.entries = args.entries
+    start_day = END_DAY - timedelta(days=args.days - 1)
+    print('{0} users, {1} days, {2} cores'.format(args.users, args.days, os.cpu_count()))
+    print('{0:>8} {1:>10} {2:>12} {3:>8}'.format('workers', 'seconds', 'users/s', 'speedup'))
+
+    baseline = None
+    first = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        partial = cohort.run(SyntheticStore, user_ids(args.users), start_day, END_DAY,
+                             workers=workers, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        report = cohort.report(partial, start_day, END_DAY)
+        if first is None:
+            first, baseline = report, elapsed
+        elif report != first:
+            raise RuntimeError('Report with {0} workers differs from the first run'.format(workers))
+        print('{0:>8} {1:>10.2f} {2:>12.0f} {3:>7.2f}x'.format(
+            workers, elapsed, args.users / elapsed, baseline / elapsed))
+
+    print('{0} active users, {1} entries, {2}% with mood swings, dominant: {3}'.format(
+        first['active_users'], first['total_entries'], first['mood_swings']['percentage'],
+        next(iter(first['dominant_emotions']), None)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Memory of the history and analysis read paths, dict rows vs compact entries.
+
+Usage:
+    python benchmarks/entry_memory.py [--sizes 1000 10000 100000]
+
+Starts from a Realtime Database response body (users/$uid/emotions) and
+builds the /api/emotions/analysis entries and trends, then encodes them,
+once the way the endpoint used to (a copied dict per entry) and once with
+EmotionEntry objects. Reports, from tracemalloc, the blocks and bytes still
+allocated once the payload is built and the peak over the whole request.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+import emotion_entries  # noqa: E402
+from json_provider import FastJSONProvider  # noqa: E402
+from storage import format_timestamp, push_keys  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+NOTES = ['', '', '', 'Long day at work', 'Went for a run with friends']
+
+END = datetime.now()
+START = END - timedelta(days=366)
+
+
+def make_body(count, end):
+    start = end - timedelta(days=365)
+    step = 365 * 86400 / count
+    return json.dumps({push_keys.generate(): {
+        'emotion': random.choice(EMOTIONS),
+        'intensity': random.randint(1, 10),
+        'note': random.choice(NOTES),
+        'timestamp': format_timestamp(start + timedelta(seconds=i * step)),
+        'user_id': 'bench-user-0000000000000000000'
+    } for i in range(count)})
+
+
+def dict_rows(rows):
+    weekly_data = []
+    for key, data in rows:
+        emotion_date = datetime.fromisoformat(data['timestamp'])
+        weekly_data.append({
+            'id': key,
+            'emotion': data['emotion'],
+            'intensity': data['intensity'],
+            'note': data.get('note', ''),
+            'timestamp': data['timestamp'],
+            'day': emotion_date.strftime('%A')
+        })
+    trends = analytics.analyze(analytics.load_columns(rows), START.date(), END.date())
+    return {'weekly_data': weekly_data, 'trends': trends}
+
+
+def compact_entries(rows):
+    emotions = emotion_entries.from_rows(rows, emotion_entries.WeekdayEntry)
+    trends = analytics.analyze_entries(emotions, START, END)
+    return {'weekly_data': emotions, 'trends': trends}
+
+
+def measure(app, body, build):
+    gc.collect()
+    tracemalloc.start()
+    # The decoded response only lives until the payload is built, like in the route
+    payload = build(sorted(json.loads(body).items(), key=lambda row: row[1]['timestamp']))
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot()
+    with app.app_context():
+        app.json.response(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = snapshot.statistics('filename')
+    return sum(stat.count for stat in stats), sum(stat.size for stat in stats), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    app = Flask('bench')
+    app.json = FastJSONProvider(app)
+    print('{0:>8} {1:<8} {2:>10} {3:>12} {4:>10}'.format('entries', 'rows', 'blocks', 'payload KiB', 'peak KiB'))
+    for size in args.sizes:
+        body = make_body(size, END)
+        for name, build in (('dict', dict_rows), ('compact', compact_entries)):
+            blocks, retained, peak = measure(app, body, build)
+            print('{0:>8} {1:<8} {2:>10} {3:>12.0f} {4:>10.0f}'.format(
+                size, name, blocks, retained / 1024, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
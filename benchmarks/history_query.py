@@ -0,0 +1,77 @@
+"""Compare full-node downloads with indexed range queries as history grows.
+
+Usage:
+    python benchmarks/history_query.py [--sizes 100 1000 10000] [--repeat 5]
+
+Runs against the database configured in .env. Entries are written under a
+throw-away user id which is removed again at the end of the run.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import db_pool  # noqa: E402
+from storage import FirebaseEmotionStore, format_timestamp  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+
+
+def seed(db, user_id, size, now):
+    # Spread entries evenly over the past `size` hours, oldest first
+    updates = {}
+    for i in range(size):
+        timestamp = now - timedelta(hours=size - i)
+        updates[db.generate_key()] = {
+            'emotion': EMOTIONS[i % len(EMOTIONS)],
+            'intensity': i % 10 + 1,
+            'note': '',
+            'timestamp': format_timestamp(timestamp),
+            'user_id': user_id
+        }
+        if len(updates) == 1000:
+            db.child('users').child(user_id).child('emotions').update(updates)
+            updates = {}
+    if updates:
+        db.child('users').child(user_id).child('emotions').update(updates)
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    emotion_store = FirebaseEmotionStore(db_pool)
+    db = db_pool.database()
+    print('{0:>8} {1:>14} {2:>14}'.format('entries', 'full scan ms', 'indexed ms'))
+
+    for size in args.sizes:
+        user_id = 'bench-{0}'.format(uuid.uuid4().hex)
+        now = datetime.now()
+        start_date = now - timedelta(days=7)
+        try:
+            seed(db, user_id, size, now)
+            full_scan = timed(lambda: emotion_store._scan_emotions(user_id, start_date, now), args.repeat)
+            indexed = timed(lambda: emotion_store.query_emotions(user_id, start_date, now), args.repeat)
+            print('{0:>8} {1:>14.1f} {2:>14.1f}'.format(size, full_scan, indexed))
+        finally:
+            db.child('users').child(user_id).remove()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compare JSON providers on history and analysis sized payloads.
+
+Usage:
+    python benchmarks/json_provider.py [--per-day 5] [--rounds 200]
+
+Encodes a week, a month and a year of entries shaped like the
+/api/emotions/history and /api/emotions/analysis responses through
+app.json.response(), with Flask's default provider (sorted keys), the
+FastJSONProvider on the stdlib encoder and the FastJSONProvider on orjson.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_provider  # noqa: E402
+from json_provider import FastJSONProvider  # noqa: E402
+from storage import format_timestamp, push_keys  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+NOTES = ['', '', 'Long day at work', 'Went for a run with friends', 'Could not sleep well']
+
+
+def make_payload(days, per_day):
+    now = datetime.now()
+    entries = []
+    for i in range(days * per_day):
+        timestamp = now - timedelta(minutes=i * 24 * 60 // per_day)
+        entries.append({
+            'id': push_keys.generate(),
+            'emotion': random.choice(EMOTIONS),
+            'intensity': random.randint(1, 10),
+            'note': random.choice(NOTES),
+            'timestamp': format_timestamp(timestamp),
+            'day': timestamp.strftime('%A')
+        })
+    return {
+        'period': 'custom',
+        'weekly_data': entries,
+        'analysis': {
+            'total_entries': len(entries),
+            'emotion_distribution': {
+                emotion: {'frequency': 10, 'average_intensity': 5.5, 'percentage': 16.67}
+                for emotion in EMOTIONS
+            },
+            'trends': {
+                'daily': [{
+                    'date': (now - timedelta(days=day)).date().isoformat(),
+                    'entries': per_day,
+                    'average_intensity': 5.2,
+                    'intensity_std': 2.1,
+                    'rolling_average': 5.4
+                } for day in range(days)]
+            }
+        }
+    }
+
+
+def bench(app, payload, rounds):
+    with app.app_context():
+        size = len(app.json.response(payload).get_data())
+        start = time.perf_counter()
+        for _ in range(rounds):
+            app.json.response(payload)
+        return (time.perf_counter() - start) / rounds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--per-day', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    default_app = Flask('default')
+    stdlib_app = Flask('stdlib')
+    fast_app = Flask('fast')
+
+    orjson = json_provider.orjson
+    stdlib_app.json = FastJSONProvider(stdlib_app)
+    fast_app.json = FastJSONProvider(fast_app)
+    providers = [('flask default', default_app), ('stdlib unsorted', stdlib_app)]
+    if orjson is not None:
+        providers.append(('orjson', fast_app))
+
+    print('{0:<8} {1:>9} {2:<16} {3:>10} {4:>8}'.format('period', 'bytes', 'provider', 'ms/resp', 'speedup'))
+    for period, days in (('week', 7), ('month', 30), ('year', 365)):
+        payload = make_payload(days, args.per_day)
+        baseline = None
+        for name, app in providers:
+            # The encoder is picked on every call
+            json_provider.orjson = orjson if app is fast_app else None
+            seconds, size = bench(app, payload, args.rounds)
+            baseline = baseline or seconds
+            print('{0:<8} {1:>9} {2:<16} {3:>10.3f} {4:>7.1f}x'.format(
+                period, size, name, seconds * 1000, baseline / seconds))
+        json_provider.orjson = orjson
+
+
+if __name__ == '__main__':
+    main()
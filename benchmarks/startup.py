@@ -0,0 +1,125 @@
+"""Measure import time and worker startup of the WSGI app.
+
+Usage:
+    python benchmarks/startup.py [--ref HEAD~1] [--workers 2] [--rounds 5] [--preload]
+
+For the working tree (and for --ref, a git revision exported to a temporary
+directory) reports the median over --rounds of:
+- import: time to import wsgi in a fresh interpreter
+- ready: time from starting gunicorn until GET /test answers
+- first: duration of the first authenticated GET /api/emotions/history,
+  which pays for any client initialization left to the first request
+Runs offline against benchmarks/stub_firebase.py, like async_serving.py.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from google.auth import crypt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from async_serving import (KEY_ID, PROJECT_ID, ROOT, free_port, make_key, make_token,  # noqa: E402
+                           service_account, wait_until_up)
+
+IMPORT_SNIPPET = 'import time; start = time.perf_counter(); import wsgi; print(time.perf_counter() - start)'
+
+
+def export_tree(ref, directory):
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT, check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    return directory
+
+
+def import_seconds(tree, env):
+    output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=tree, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def boot_seconds(tree, env, workers, preload, token):
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', 'wsgi:app', '--bind', '127.0.0.1:{0}'.format(port),
+               '--workers', str(workers), '--log-level', 'warning']
+    if preload:
+        command.append('--preload')
+
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=tree, env=env)
+    try:
+        base_url = 'http://127.0.0.1:{0}'.format(port)
+        wait_until_up(base_url + '/test', server, interval=0.01)
+        ready = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = httpx.get(base_url + '/api/emotions/history', timeout=60,
+                             headers={'Authorization': 'Bearer ' + token})
+        first = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError('First request failed: {0} {1}'.format(response.status_code, response.text))
+    finally:
+        server.terminate()
+        server.wait()
+    return ready, first
+
+
+def measure(name, tree, env, args, token):
+    imports, readies, firsts = [], [], []
+    for _ in range(args.rounds):
+        imports.append(import_seconds(tree, env))
+        ready, first = boot_seconds(tree, env, args.workers, args.preload, token)
+        readies.append(ready)
+        firsts.append(first)
+    print('{0:<12} {1:>10.0f} {2:>10.0f} {3:>10.0f}'.format(
+        name, statistics.median(imports) * 1000, statistics.median(readies) * 1000,
+        statistics.median(firsts) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ref', help='git revision to compare against')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--preload', action='store_true', help='start gunicorn with --preload')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        private_pem, certs_path = make_key(directory)
+        token = make_token(crypt.RSASigner.from_string(private_pem, key_id=KEY_ID), 'bench-user')
+
+        stub_port = free_port()
+        stub_url = 'http://127.0.0.1:{0}'.format(stub_port)
+        env = dict(os.environ,
+                   STUB_LATENCY='0',
+                   STUB_CERTS=certs_path,
+                   GOOGLE_APPLICATION_CREDENTIALS_JSON=service_account(private_pem),
+                   FIREBASE_PROJECT_ID=PROJECT_ID,
+                   FIREBASE_API_KEY='bench',
+                   FIREBASE_DATABASE_URL=stub_url,
+                   FIREBASE_PUBLIC_KEYS_URL=stub_url + '/keys',
+                   MOODMATE_STORAGE='firebase')
+        env.pop('EMOTION_WRITE_BEHIND', None)
+
+        stub = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'benchmarks.stub_firebase:app',
+                                 '--port', str(stub_port), '--log-level', 'warning'], cwd=ROOT, env=env)
+        try:
+            wait_until_up(stub_url + '/keys', stub)
+            print('{0} workers{1}, median of {2} rounds'.format(
+                args.workers, ' with --preload' if args.preload else '', args.rounds))
+            print('{0:<12} {1:>10} {2:>10} {3:>10}'.format('tree', 'import ms', 'ready ms', 'first ms'))
+            if args.ref:
+                tree = export_tree(args.ref, tempfile.mkdtemp(dir=directory))
+                measure(args.ref, tree, env, args, token)
+            measure('working', ROOT, env, args, token)
+        finally:
+            stub.terminate()
+            stub.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compare storage backends on append, batch write, range query and rollups.
+
+Usage:
+    python benchmarks/storage_backends.py [--backend sqlite firebase] [--entries 5000]
+
+The SQLite backend runs fully offline in a temporary directory. The Firebase
+backend uses the database configured in .env and a throw-away user id.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregates  # noqa: E402
+import rollups  # noqa: E402
+from storage import SQLiteEmotionStore, format_timestamp  # noqa: E402
+
+EMOTIONS = ['happy', 'sad', 'angry', 'anxious', 'excited', 'frustrated']
+
+
+def make_entries(user_id, count, now):
+    return [{
+        'emotion': random.choice(EMOTIONS),
+        'intensity': random.randint(1, 10),
+        'note': '',
+        'timestamp': format_timestamp(now - timedelta(minutes=37 * i)),
+        'user_id': user_id
+    } for i in range(count)]
+
+
+def timed(fn, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def run(name, store, count):
+    user_id = 'bench-{0}'.format(uuid.uuid4().hex)
+    now = datetime.now()
+    entries = make_entries(user_id, count, now)
+    week_start, week_end = aggregates.day_range(7, now)
+    year_start, year_end = aggregates.day_range(365, now)
+
+    results = {
+        'batch write': timed(lambda: [store.add_emotions(user_id, entries[i:i + 500])
+                                      for i in range(0, count, 500)]),
+        'rebuild aggregates': timed(lambda: aggregates.rebuild_user(store, user_id)),
+        'append x20': timed(lambda: [store.add_emotion(user_id, entry) for entry in entries[:20]]),
+        'increment x20': timed(lambda: [aggregates.record_entries(store, user_id, [entry])
+                                        for entry in entries[:20]]),
+        'query week': timed(lambda: store.query_emotions(user_id, week_start, week_end), 5),
+        'query year': timed(lambda: store.query_emotions(user_id, year_start, year_end), 5),
+        'rollups year': timed(lambda: rollups.buckets(store, user_id, year_start.date(), year_end.date()), 5)
+    }
+    for operation, ms in results.items():
+        print('{0:<10} {1:<20} {2:>10.2f} ms'.format(name, operation, ms))
+    return user_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', nargs='+', default=['sqlite'], choices=['sqlite', 'firebase'])
+    parser.add_argument('--entries', type=int, default=5000)
+    args = parser.parse_args()
+
+    for backend in args.backend:
+        if backend == 'sqlite':
+            with tempfile.TemporaryDirectory() as directory:
+                run(backend, SQLiteEmotionStore(os.path.join(directory, 'bench.db')), args.entries)
+        else:
+            from main import db_pool
+            from storage import FirebaseEmotionStore
+            user_id = run(backend, FirebaseEmotionStore(db_pool), args.entries)
+            db_pool.database().child('users').child(user_id).remove()
+
+
+if __name__ == '__main__':
+    main()
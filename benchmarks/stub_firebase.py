@@ -0,0 +1,190 @@
+"""Local stand-in for the Realtime Database REST API and Firebase Auth, for load tests.
+
+Usage:
+    uvicorn benchmarks.stub_firebase:app --port 9000
+    STUB_LATENCY=0.02 STUB_CERTS=certs.json uvicorn benchmarks.stub_firebase:app --port 9000
+
+Keeps the tree in memory and supports what the storage backends use: GET
+(with orderBy/startAt/endAt/limitToFirst and shallow), PUT, PATCH with
+server-side increments and DELETE. Every response is delayed by
+STUB_LATENCY seconds to stand in for the network round trip. GET /keys
+serves the certificates in STUB_CERTS, point FIREBASE_PUBLIC_KEYS_URL at it
+to verify ID tokens signed by the load test.
+
+With FIREBASE_AUTH_EMULATOR_HOST pointing at it, it also answers the Auth
+emulator API used by the app: password sign-in, and account creation,
+lookup and update from the Admin SDK, delayed by STUB_AUTH_LATENCY seconds
+(STUB_LATENCY by default). Sign-in returns a placeholder ID token.
+"""
+import asyncio
+import json
+import os
+import uuid
+from urllib.parse import parse_qs
+
+LATENCY = float(os.getenv('STUB_LATENCY', 0))
+AUTH_LATENCY = float(os.getenv('STUB_AUTH_LATENCY', LATENCY))
+
+root = {}
+
+# Auth accounts by uid, and uids by email
+accounts = {}
+emails = {}
+
+
+def _node(parts, create=False):
+    node = root
+    for part in parts:
+        if not isinstance(node, dict):
+            return None
+        if part not in node:
+            if not create:
+                return None
+            node[part] = {}
+        node = node[part]
+    return node
+
+
+def _set(parts, value):
+    parent = _node(parts[:-1], create=True)
+    if value is None:
+        parent.pop(parts[-1], None)
+    else:
+        parent[parts[-1]] = value
+
+
+def _query(node, params):
+    order_by = params['orderBy']
+
+    def sort_key(item):
+        key, value = item
+        if order_by == '$key':
+            return key
+        return value.get(order_by) if isinstance(value, dict) else None
+
+    items = [item for item in node.items() if sort_key(item) is not None]
+    items.sort(key=lambda item: (sort_key(item), item[0]))
+    if 'startAt' in params:
+        items = [item for item in items if sort_key(item) >= params['startAt']]
+    if 'endAt' in params:
+        items = [item for item in items if sort_key(item) <= params['endAt']]
+    if 'limitToFirst' in params:
+        items = items[:int(params['limitToFirst'])]
+    return dict(items)
+
+
+def handle(method, path, params, body):
+    parts = [part for part in path[:-len('.json')].split('/') if part]
+    if method == 'GET':
+        node = _node(parts)
+        if isinstance(node, dict) and params.get('shallow'):
+            return {key: True for key in node}
+        if isinstance(node, dict) and 'orderBy' in params:
+            return _query(node, params)
+        return node
+    if method == 'PUT':
+        if parts:
+            _set(parts, body)
+        return body
+    if method == 'PATCH':
+        for key, value in body.items():
+            path_parts = parts + [part for part in key.split('/') if part]
+            if isinstance(value, dict) and '.sv' in value:
+                current = _node(path_parts)
+                value = (current if isinstance(current, (int, float)) else 0) + value['.sv']['increment']
+            _set(path_parts, value)
+        return body
+    if method == 'DELETE':
+        if parts:
+            _set(parts, None)
+        return None
+    raise ValueError('Unsupported method ' + method)
+
+
+def _auth_error(message):
+    return 400, {'error': {'code': 400, 'message': message}}
+
+
+def _user_info(account):
+    return {
+        'localId': account['localId'],
+        'email': account.get('email'),
+        'displayName': account.get('displayName'),
+        'photoUrl': account.get('photoUrl'),
+        'emailVerified': False,
+        'disabled': False,
+        'createdAt': '0',
+        'lastLoginAt': '0'
+    }
+
+
+def handle_auth(path, body):
+    if path.endswith('/verifyPassword'):
+        account = accounts.get(emails.get(body.get('email')))
+        if account is None:
+            return _auth_error('EMAIL_NOT_FOUND')
+        if account.get('password') != body.get('password'):
+            return _auth_error('INVALID_PASSWORD')
+        return 200, dict(_user_info(account), idToken='stub-id-token', refreshToken='stub-refresh-token',
+                         expiresIn='3600', registered=True)
+    if path.endswith('/accounts:lookup'):
+        users = [_user_info(accounts[uid]) for uid in body.get('localId', []) if uid in accounts]
+        return 200, {'users': users} if users else {}
+    if path.endswith('/accounts:update'):
+        account = accounts.get(body.get('localId'))
+        if account is None:
+            return _auth_error('USER_NOT_FOUND')
+        account.update((key, body[key]) for key in ('displayName', 'photoUrl', 'password') if key in body)
+        return 200, {'localId': account['localId']}
+    if path.endswith('/accounts'):
+        if body.get('email') in emails:
+            return _auth_error('EMAIL_EXISTS')
+        account = dict(body, localId=body.get('localId') or uuid.uuid4().hex[:28])
+        accounts[account['localId']] = account
+        emails[account.get('email')] = account['localId']
+        return 200, {'localId': account['localId']}
+    return 404, {'error': 'Not found'}
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            await send({'type': message['type'] + '.complete'})
+            if message['type'] == 'lifespan.shutdown':
+                return
+
+    body = await _read_body(receive)
+    is_auth = scope['path'].startswith(('/identitytoolkit.googleapis.com/', '/www.googleapis.com/'))
+    latency = AUTH_LATENCY if is_auth else LATENCY
+    if latency:
+        await asyncio.sleep(latency)
+
+    status = 200
+    if is_auth:
+        status, result = handle_auth(scope['path'], json.loads(body) if body else {})
+    elif scope['path'] == '/keys':
+        with open(os.environ['STUB_CERTS'], encoding='utf-8') as certs_file:
+            result = json.load(certs_file)
+    elif scope['path'].endswith('.json'):
+        params = {key: values[0] for key, values in parse_qs(scope['query_string'].decode()).items()}
+        params = {key: json.loads(value) if key != 'shallow' else value.lower() == 'true'
+                  for key, value in params.items()}
+        result = handle(scope['method'], scope['path'], params, json.loads(body) if body else None)
+    else:
+        status, result = 404, {'error': 'Not found'}
+
+    payload = json.dumps(result).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'cache-control', b'public, max-age=3600')]})
+    await send({'type': 'http.response.body', 'body': payload})
@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+# Firebase clients and the objects built on them, created on first use and
+# shared by every thread of the process. Each one remembers the process that
+# created it and is created again after a fork, so a gunicorn --preload
+# master never hands its sockets, threads or SQLite connections to workers.
+# The heavy Firebase modules are only imported here, on first use.
+_lock = threading.RLock()
+_clients = {}
+
+
+def _shared(name: str, factory: Callable):
+    pid = os.getpid()
+    entry = _clients.get(name)
+    if entry is None or entry[0] != pid:
+        with _lock:
+            entry = _clients.get(name)
+            if entry is None or entry[0] != pid:
+                entry = _clients[name] = (pid, factory())
+    return entry[1]
+
+
+# The client if this process already created it, None otherwise
+def peek(name: str):
+    entry = _clients.get(name)
+    if entry is None or entry[0] != os.getpid():
+        return None
+    return entry[1]
+
+
+def firebase_config() -> Dict:
+    return _shared('firebase_config', lambda: {
+        "apiKey": os.getenv("FIREBASE_API_KEY"),
+        "authDomain": os.getenv("FIREBASE_AUTH_DOMAIN"),
+        "projectId": os.getenv("FIREBASE_PROJECT_ID"),
+        "storageBucket": os.getenv("FIREBASE_STORAGE_BUCKET"),
+        "messagingSenderId": os.getenv("FIREBASE_MESSAGING_SENDER_ID"),
+        "appId": os.getenv("FIREBASE_APP_ID"),
+        "databaseURL": os.getenv("FIREBASE_DATABASE_URL")
+    })
+
+
+def _load_credentials():
+    from firebase_admin import credentials
+
+    if os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'):
+        google_creds = json.loads(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'))
+        return credentials.Certificate(google_creds)
+    return credentials.Certificate("config/serviceAccountKey.json")
+
+
+def cred():
+    return _shared('cred', _load_credentials)
+
+
+def _initialize_admin():
+    import firebase_admin
+
+    # An app inherited from the parent process holds its HTTP sessions
+    try:
+        firebase_admin.delete_app(firebase_admin.get_app())
+    except ValueError:
+        pass
+    return firebase_admin.initialize_app(cred())
+
+
+def admin_app():
+    return _shared('admin_app', _initialize_admin)
+
+
+# firebase_admin.auth, once the Admin SDK is initialized
+def auth():
+    admin_app()
+    from firebase_admin import auth as firebase_auth
+    return firebase_auth
+
+
+def _create_token_verifier():
+    from token_verifier import FirebaseTokenVerifier
+
+    # ID tokens are verified locally against cached Google signing keys
+    return FirebaseTokenVerifier(firebase_config()['projectId'] or cred().project_id)
+
+
+def token_verifier():
+    return _shared('token_verifier', _create_token_verifier)
+
+
+def _initialize_pyrebase():
+    import pyrebase
+    return pyrebase.initialize_app(firebase_config())
+
+
+def firebase():
+    return _shared('firebase', _initialize_pyrebase)
+
+
+# Identity Toolkit sign-in endpoint. Sent to the Firebase Auth emulator (or
+# a stand-in) when FIREBASE_AUTH_EMULATOR_HOST is set, like the Admin SDK
+SIGN_IN_URL = 'https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}'
+
+
+def sign_in_url() -> str:
+    url = SIGN_IN_URL.format(firebase_config()['apiKey'])
+    emulator_host = os.getenv('FIREBASE_AUTH_EMULATOR_HOST')
+    if emulator_host:
+        return 'http://{0}/{1}'.format(emulator_host, url[len('https://'):])
+    return url
+
+
+def _create_pb_auth():
+    pb_auth = firebase().auth()
+    if os.getenv('FIREBASE_AUTH_EMULATOR_HOST'):
+        from pyrebase.pyrebase import raise_detailed_error
+
+        # pyrebase has the production URL built in
+        def sign_in_with_email_and_password(email, password):
+            response = pb_auth.requests.post(sign_in_url(), json={
+                'email': email, 'password': password, 'returnSecureToken': True})
+            raise_detailed_error(response)
+            return response.json()
+        pb_auth.sign_in_with_email_and_password = sign_in_with_email_and_password
+    return pb_auth
+
+
+def pb_auth():
+    return _shared('pb_auth', _create_pb_auth)
+
+
+def _create_db_pool():
+    from db_pool import DatabasePool
+
+    # Realtime Database access goes through one pooled keep-alive session
+    return DatabasePool(firebase())
+
+
+def db_pool():
+    return _shared('db_pool', _create_db_pool)
+
+
+def _create_emotion_store():
+    from rollups import create_compactor
+    from storage import create_store
+
+    # Firebase unless MOODMATE_STORAGE says otherwise
+    store = create_store(db_pool)
+    # In-process rollup compaction unless ROLLUP_INTERVAL=0, see peek('compactor')
+    _clients['compactor'] = (os.getpid(), create_compactor(store))
+    return store
+
+
+def emotion_store():
+    return _shared('emotion_store', _create_emotion_store)
+
+
+def _create_write_queue():
+    if os.getenv('EMOTION_WRITE_BEHIND') != '1':
+        return None
+    from write_queue import create_queue
+    return create_queue(emotion_store(), _publish_entries)
+
+
+# Flushed write-behind entries go to the streams once they are stored, and
+# the user's analysis snapshots are refreshed like after a direct save
+def _publish_entries(user_id, keys, entries):
+    from main import snapshot_refresher
+
+    snapshot_refresher.schedule(user_id)
+    event_broker().publish(user_id, keys, entries)
+
+
+# Optional write-behind queue, None unless EMOTION_WRITE_BEHIND=1
+def write_queue() -> Optional[object]:
+    return _shared('write_queue', _create_write_queue)
+
+
+def _create_auth_limiter():
+    from ratelimit import create_limiter
+    return create_limiter()
+
+
+# Token buckets of the login and register endpoints, shared through Redis
+# when RATE_LIMIT_REDIS_URL is set
+def auth_limiter():
+    return _shared('auth_limiter', _create_auth_limiter)
+
+
+def _create_event_broker():
+    from events import create_broker
+    return create_broker()
+
+
+# Publishes saved entries to the open /api/emotions/stream connections, of
+# every worker through Redis when EVENTS_REDIS_URL is set
+def event_broker():
+    return _shared('event_broker', _create_event_broker)
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+from datetime import date, datetime, timedelta
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import aggregates
+import rollups
+
+# Users per task handed to a worker process
+CHUNK_SIZE = 256
+
+
+# Cohort statistics of a set of users over start_day..end_day, built per
+# chunk of users in the worker processes and merged in the parent. Every
+# field is a sum, so partials merge in any order:
+#   users, active_users (users with entries), entries, intensity_sum,
+#   mood_swings (active users flagged like /api/emotions/analysis does),
+#   dominant_emotions/$emotion (users), emotions/$emotion (entries) and
+#   days/$day with entries, intensity_sum and users
+def empty_partial() -> Dict:
+    return {
+        'users': 0,
+        'active_users': 0,
+        'entries': 0,
+        'intensity_sum': 0,
+        'mood_swings': 0,
+        'dominant_emotions': {},
+        'emotions': {},
+        'days': {}
+    }
+
+
+# Adds the counts of source into target, nested dicts included
+def _add_counts(target: Dict, source: Dict):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            _add_counts(target.setdefault(key, {}), value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+# Adds one user, from the daily buckets of their entries in the period
+def add_user(partial: Dict, buckets: Dict[str, Dict]):
+    partial['users'] += 1
+    # Same per-user analysis as the endpoint
+    analysis = aggregates.analyze_buckets(buckets)
+    if not analysis['total_entries']:
+        return
+
+    partial['active_users'] += 1
+    partial['mood_swings'] += int(analysis['mood_swings'])
+    dominant = analysis['dominant_emotion']
+    partial['dominant_emotions'][dominant] = partial['dominant_emotions'].get(dominant, 0) + 1
+    for emotion, data in analysis['emotion_distribution'].items():
+        partial['emotions'][emotion] = partial['emotions'].get(emotion, 0) + data['frequency']
+    for day, bucket in buckets.items():
+        partial['entries'] += bucket['count']
+        partial['intensity_sum'] += bucket['intensity_sum']
+        _add_counts(partial['days'].setdefault(day, {}), {
+            'entries': bucket['count'],
+            'intensity_sum': bucket['intensity_sum'],
+            'users': 1
+        })
+
+
+def analyze_users(store, user_ids: List[str], start_day: date, end_day: date) -> Dict:
+    start_date = datetime.combine(start_day, datetime.min.time())
+    end_date = datetime.combine(end_day, datetime.max.time())
+    partial = empty_partial()
+    for user_id in user_ids:
+        entries = (data for _, data in store.iter_emotions(user_id, start_date, end_date))
+        add_user(partial, rollups.build_daily(entries))
+    return partial
+
+
+# Store of the worker process, created by _init_worker
+_store = None
+
+
+def _init_worker(store_factory: Callable):
+    global _store
+    _store = store_factory()
+
+
+def _analyze_chunk(task) -> Dict:
+    user_ids, start_day, end_day = task
+    return analyze_users(_store, user_ids, start_day, end_day)
+
+
+def _chunks(user_ids: Iterable[str], start_day: date, end_day: date, size: int) -> Iterator:
+    user_ids = iter(user_ids)
+    while True:
+        chunk = list(islice(user_ids, size))
+        if not chunk:
+            return
+        yield chunk, start_day, end_day
+
+
+# Cohort partial of every user in user_ids (any iterable, consumed as the
+# workers ask for chunks). Each worker process reads through its own store
+# from store_factory, a picklable callable; workers=1 runs in this process.
+# Partials are merged as chunks complete, so memory does not grow with the
+# number of users.
+def run(store_factory: Callable, user_ids: Iterable[str], start_day: date, end_day: date,
+        workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE) -> Dict:
+    workers = workers or os.cpu_count() or 1
+    tasks = _chunks(user_ids, start_day, end_day, chunk_size)
+    result = empty_partial()
+    if workers == 1:
+        store = store_factory()
+        for chunk, _, _ in tasks:
+            _add_counts(result, analyze_users(store, chunk, start_day, end_day))
+        return result
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(store_factory,)) as pool:
+        for partial in pool.imap_unordered(_analyze_chunk, tasks):
+            _add_counts(result, partial)
+    return result
+
+
+def _percentage(count: int, total: int) -> float:
+    return round(count / total * 100, 2) if total else 0
+
+
+# Report of a merged partial: dominant emotion distribution across users,
+# share of users with mood swings and the daily intensity trend
+def report(partial: Dict, start_day: date, end_day: date) -> Dict:
+    active = partial['active_users']
+    dominant = sorted(partial['dominant_emotions'].items(), key=lambda item: (-item[1], item[0]))
+    trend = []
+    for day in (start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)):
+        data = partial['days'].get(aggregates.day_key(day))
+        trend.append({
+            'date': aggregates.day_key(day),
+            'entries': data['entries'] if data else 0,
+            'users': data['users'] if data else 0,
+            'average_intensity': round(data['intensity_sum'] / data['entries'], 2) if data else None
+        })
+    return {
+        'start': start_day.isoformat(),
+        'end': end_day.isoformat(),
+        'users': partial['users'],
+        'active_users': active,
+        'total_entries': partial['entries'],
+        'average_intensity': round(partial['intensity_sum'] / partial['entries'], 2) if partial['entries'] else 0,
+        'dominant_emotions': {emotion: {'users': count, 'percentage': _percentage(count, active)}
+                              for emotion, count in dominant},
+        'mood_swings': {'users': partial['mood_swings'], 'percentage': _percentage(partial['mood_swings'], active)},
+        'emotion_frequency': dict(sorted(partial['emotions'].items(), key=lambda item: (-item[1], item[0]))),
+        'intensity_trend': trend
+    }
@@ -0,0 +1,45 @@
+"""Weekly cohort report across every user.
+
+Usage:
+    python cohort_report.py [--days 7] [--end YYYY-MM-DD] [--workers N] [--output report.json]
+
+Streams each user's entries of the period from the storage layer in a pool
+of worker processes (one per core by default), runs the per-user analysis
+of /api/emotions/analysis on them and merges the per-chunk partials into
+one report: dominant emotions across users, the share of users with mood
+swings, emotion frequencies and the daily intensity trend. The period ends
+with the last closed day by default.
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+import clients
+import cohort
+import rollups
+from main import emotion_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cohort report across every user')
+    parser.add_argument('--days', type=int, default=7, help='Length of the period in days')
+    parser.add_argument('--end', help='Last day of the period (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=cohort.CHUNK_SIZE, help='Users per task')
+    parser.add_argument('--output', help='Write the report to this file instead of stdout')
+    args = parser.parse_args()
+
+    end_day = datetime.strptime(args.end, '%Y-%m-%d').date() if args.end else rollups.last_closed_day()
+    start_day = end_day - timedelta(days=args.days - 1)
+
+    partial = cohort.run(clients.emotion_store, emotion_store.list_users(), start_day, end_day,
+                         workers=args.workers, chunk_size=args.chunk_size)
+    report = cohort.report(partial, start_day, end_day)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
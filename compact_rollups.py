@@ -0,0 +1,34 @@
+"""Write the daily and weekly rollups of closed days from the raw entries.
+
+Usage:
+    python compact_rollups.py [--user UID ...] [--full]
+
+Compacts every user when no user id is given. Each run picks up after the
+last compacted day and redoes days that received late entries, --full
+recomputes all days. Each worker also compacts the users it serves every
+ROLLUP_INTERVAL seconds (300 by default); with ROLLUP_INTERVAL=0 run this
+daily (cron) instead.
+"""
+import argparse
+
+import rollups
+from main import emotion_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact emotion entries into daily and weekly rollups')
+    parser.add_argument('--user', action='append', dest='users', help='User id to compact (repeatable)')
+    parser.add_argument('--full', action='store_true', help='Recompute every day')
+    args = parser.parse_args()
+
+    users = args.users
+    if not users:
+        users = emotion_store.list_users()
+
+    for user_id in users:
+        updates = rollups.compact_user(emotion_store, user_id, full=args.full)
+        print('{0}: {1} days, {2} weeks, through {3}'.format(
+            user_id,
+            sum(1 for path, doc in updates.items() if path.startswith('daily/') and doc is not None),
+            sum(1 for path, doc in updates.items() if path.startswith('weekly/') and doc is not None),
+            updates['meta/through']))
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from typing import Dict
+
+import requests
+from pyrebase.pyrebase import Database
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+import metrics
+
+# Pool settings, overridable per deployment
+POOL_SIZE = int(os.getenv('FIREBASE_DB_POOL_SIZE', 10))
+TIMEOUT = float(os.getenv('FIREBASE_DB_TIMEOUT', 10))
+RETRIES = int(os.getenv('FIREBASE_DB_RETRIES', 3))
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+    def record(self, opened=0, acquired=0, waited=0, wait_seconds=0.0):
+        with self._lock:
+            self.opened += opened
+            self.acquired += acquired
+            self.waited += waited
+            self.wait_seconds += wait_seconds
+
+    def as_dict(self) -> Dict:
+        return {
+            'connections_opened': self.opened,
+            'connections_reused': self.acquired - self.opened,
+            'requests_waited': self.waited,
+            'wait_seconds': round(self.wait_seconds, 6)
+        }
+
+
+stats = PoolStats()
+
+
+class _CountingPoolMixin:
+    def _new_conn(self):
+        stats.record(opened=1)
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        if self.pool is not None and self.pool.empty():
+            # Every connection is checked out, this request has to wait
+            start = time.perf_counter()
+            conn = super()._get_conn(timeout=timeout)
+            stats.record(acquired=1, waited=1, wait_seconds=time.perf_counter() - start)
+            return conn
+        stats.record(acquired=1)
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+# Keep-alive adapter with a bounded, blocking pool and a default timeout.
+# Only idempotent requests are retried on errors and 5xx responses, since a
+# repeated push or increment would write the entry twice.
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, pool_size: int = POOL_SIZE, timeout: float = TIMEOUT, retries: int = RETRIES):
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'PUT', 'DELETE']),
+            raise_on_status=False
+        )
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        with metrics.upstream('database', request.method):
+            response = super().send(request, timeout=timeout or self.timeout, **kwargs)
+        if response.status_code >= 400:
+            metrics.upstream_errors.inc('database', request.method)
+        return response
+
+
+# Per-process access to the Realtime Database over one pooled session. The
+# session is created lazily and again after a fork, so workers never share
+# sockets opened by a --preload master. Database objects carry per-query
+# state, so a new (cheap) one is handed out for every call.
+class DatabasePool:
+    def __init__(self, firebase, pool_size: int = POOL_SIZE, timeout: float = TIMEOUT,
+                 retries: int = RETRIES):
+        self.firebase = firebase
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def requests(self) -> requests.Session:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = PooledAdapter(self.pool_size, self.timeout, self.retries)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def database(self) -> Database:
+        return Database(self.firebase.credentials, self.firebase.api_key,
+                        self.firebase.database_url, self.requests)
+
+    def stats(self) -> Dict:
+        result = stats.as_dict()
+        result['pool_size'] = self.pool_size
+        return result
@@ -0,0 +1,79 @@
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from storage import format_timestamp, local_seconds
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+EPOCH = datetime(1970, 1, 1)
+
+SECONDS_PER_DAY = 86400
+
+
+# Seconds since 1970-01-01 of a stored timestamp, taken as is (server local
+# time). Floats keep microseconds exactly for any date this app will see.
+def to_seconds(timestamp: str) -> float:
+    return (datetime.fromisoformat(timestamp) - EPOCH).total_seconds()
+
+
+def from_seconds(seconds: float) -> datetime:
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def _intern(emotion):
+    return sys.intern(emotion) if isinstance(emotion, str) else emotion
+
+
+# One stored emotion entry for the read paths. Slots instead of a dict, one
+# float for the timestamp, emotion names shared between entries and small
+# intensities taken from the interpreter's int cache. Serializes to the API
+# shape through to_json(), one entry at a time.
+class EmotionEntry:
+    __slots__ = ('key', 'emotion', 'intensity', 'note', 'seconds')
+
+    def __init__(self, key: str, emotion: str, intensity: int, note: str, seconds: float):
+        self.key = key
+        self.emotion = emotion
+        self.intensity = intensity
+        self.note = note
+        self.seconds = seconds
+
+    @classmethod
+    def from_row(cls, row: Tuple[str, Dict]) -> 'EmotionEntry':
+        key, data = row
+        return cls(key, _intern(data['emotion']), data['intensity'], data.get('note', ''),
+                   local_seconds(data))
+
+    @property
+    def timestamp(self) -> str:
+        return format_timestamp(from_seconds(self.seconds))
+
+    @property
+    def weekday(self) -> int:
+        # 1970-01-01 was a Thursday
+        return (int(self.seconds // SECONDS_PER_DAY) + 3) % 7
+
+    def to_json(self) -> Dict:
+        return {
+            'id': self.key,
+            'emotion': self.emotion,
+            'intensity': self.intensity,
+            'note': self.note,
+            'timestamp': self.timestamp
+        }
+
+
+# Entries of /api/emotions/analysis also name their day of the week
+class WeekdayEntry(EmotionEntry):
+    __slots__ = ()
+
+    def to_json(self) -> Dict:
+        data = super().to_json()
+        data['day'] = DAY_NAMES[self.weekday]
+        return data
+
+
+# Rows as returned by the stores, the rows can be dropped afterwards
+def from_rows(rows: Iterable[Tuple[str, Dict]], entry_type=EmotionEntry) -> List[EmotionEntry]:
+    return [entry_type.from_row(row) for row in rows]
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Dict, Iterator, List
+
+import aggregates
+import rollups
+from storage import entry_json
+
+logger = logging.getLogger(__name__)
+
+# Frames queued for one stream before it counts as a slow consumer
+QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 64))
+
+# Open streams per user and per worker, more are refused with 503
+MAX_PER_USER = int(os.getenv('STREAM_MAX_PER_USER', 5))
+MAX_STREAMS = int(os.getenv('STREAM_MAX_STREAMS', 1000))
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT = float(os.getenv('STREAM_HEARTBEAT', 15))
+
+# Shared broker across workers and instances, delivery within the worker
+# when unset
+REDIS_URL = os.getenv('EVENTS_REDIS_URL')
+
+
+# Server-Sent Events frames of /api/emotions/stream:
+#   entry: {"id", "data"} for every stored entry, queued entries once they
+#   are flushed
+#   stats: {"days": {"2024-05-01": ...}} after the entries of one save, the
+#   daily buckets they add in the rollup layout (count, intensity_sum,
+#   intensity_sq_sum, intensity_min, intensity_max, note_count,
+#   emotions/$emotion)
+#   reset: the stream fell behind and is closed, refetch the history
+# Frames are encoded once per save and shared by every stream.
+def frame(event: str, data: Dict) -> str:
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data, separators=(',', ':')))
+
+
+RETRY_FRAME = 'retry: 5000\n\n'
+HEARTBEAT_FRAME = ': keep-alive\n\n'
+RESET_FRAME = frame('reset', {'reason': 'slow consumer'})
+
+
+def entry_frames(keys: List[str], entries: List[Dict]) -> List[str]:
+    frames = [frame('entry', {'id': key, 'data': entry_json(data)}) for key, data in zip(keys, entries)]
+    days = rollups.build_daily(entries)
+    for doc in days.values():
+        doc['emotions'] = {aggregates.decode_key(key): value for key, value in doc['emotions'].items()}
+    frames.append(frame('stats', {'days': days}))
+    return frames
+
+
+# Bounded queue of frames for one open stream. Publishers never wait: a
+# stream that falls QUEUE_SIZE frames behind is flagged as lagged, its queue
+# is dropped and it ends with a reset frame.
+class Subscription:
+    def __init__(self, user_id: str, maxsize: int = QUEUE_SIZE):
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.lagged = False
+        self._frames = deque()
+        self._ready = threading.Event()
+
+    def push(self, frames: List[str]):
+        if self.lagged:
+            return
+        if len(self._frames) + len(frames) > self.maxsize:
+            self.lagged = True
+            self._frames.clear()
+        else:
+            self._frames.extend(frames)
+        self._notify()
+
+    def _notify(self):
+        self._ready.set()
+
+    def drain(self) -> List[str]:
+        frames = []
+        while self._frames:
+            frames.append(self._frames.popleft())
+        return frames
+
+    # Frames published since the last call, empty after timeout seconds
+    def wait(self, timeout: float) -> List[str]:
+        self._ready.wait(timeout)
+        self._ready.clear()
+        return self.drain()
+
+
+# Subscription of a stream served on an event loop. Publishers on other
+# threads wake it through the loop, an idle stream is a suspended coroutine.
+class AsyncSubscription(Subscription):
+    def __init__(self, user_id: str, maxsize: int = QUEUE_SIZE):
+        super().__init__(user_id, maxsize)
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def _notify(self):
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The loop is closed, the stream is gone
+            pass
+
+    async def wait(self, timeout: float) -> List[str]:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._ready.clear()
+        return self.drain()
+
+
+# Open streams of this worker by user
+class Hub:
+    def __init__(self, max_per_user: int = MAX_PER_USER, max_streams: int = MAX_STREAMS):
+        self.max_per_user = max_per_user
+        self.max_streams = max_streams
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self.open = 0
+        self.refused = 0
+        self.delivered = 0
+        self.lagged = 0
+
+    # False when the user or the worker has too many open streams
+    def subscribe(self, subscription: Subscription) -> bool:
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(subscription.user_id, set())
+            if len(subscriptions) >= self.max_per_user or self.open >= self.max_streams:
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+                self.refused += 1
+                return False
+            subscriptions.add(subscription)
+            self.open += 1
+            return True
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+            self.open -= 1
+
+    def has_subscribers(self, user_id: str) -> bool:
+        return user_id in self._subscriptions
+
+    def deliver(self, user_id: str, frames: List[str]):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            was_lagged = subscription.lagged
+            subscription.push(frames)
+            if subscription.lagged and not was_lagged:
+                self.lagged += 1
+            else:
+                self.delivered += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'open': self.open,
+            'refused': self.refused,
+            'delivered': self.delivered,
+            'lagged': self.lagged
+        }
+
+
+# Streams of this worker
+hub = Hub()
+
+
+# Frames of one stream: events as they are published, keep-alive comments
+# while idle. Ends after a reset frame when the stream fell behind.
+def stream(subscription: Subscription, heartbeat: float = HEARTBEAT) -> Iterator[str]:
+    try:
+        yield RETRY_FRAME
+        while True:
+            frames = subscription.wait(heartbeat)
+            if subscription.lagged:
+                yield RESET_FRAME
+                return
+            yield ''.join(frames) if frames else HEARTBEAT_FRAME
+    finally:
+        hub.unsubscribe(subscription)
+
+
+async def astream(subscription: AsyncSubscription, heartbeat: float = HEARTBEAT) -> AsyncIterator[str]:
+    try:
+        yield RETRY_FRAME
+        while True:
+            frames = await subscription.wait(heartbeat)
+            if subscription.lagged:
+                yield RESET_FRAME
+                return
+            yield ''.join(frames) if frames else HEARTBEAT_FRAME
+    finally:
+        hub.unsubscribe(subscription)
+
+
+# Delivers saved entries to the streams of this worker. Nothing is encoded
+# when the user has no open stream.
+class LocalBroker:
+    shared = False
+
+    def __init__(self, hub: Hub):
+        self.hub = hub
+
+    def publish(self, user_id: str, keys: List[str], entries: List[Dict]):
+        if self.hub.has_subscribers(user_id):
+            self.hub.deliver(user_id, entry_frames(keys, entries))
+
+
+# Delivers saved entries to the streams of every worker and instance through
+# Redis pub/sub. Streams of this worker get them directly, so they keep
+# working while Redis is unreachable. One listener thread per worker
+# receives the events of other workers. The redis package is optional,
+# only needed with EVENTS_REDIS_URL.
+class RedisBroker:
+    shared = True
+
+    def __init__(self, hub: Hub, url: str, prefix: str = 'moodmate:events:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('EVENTS_REDIS_URL is set but the redis package is not installed '
+                              '(pip install redis)') from None
+
+        self.hub = hub
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        # No read timeout, the listener blocks until a message arrives
+        self.listener = redis.Redis.from_url(url, socket_connect_timeout=0.5, health_check_interval=30)
+        self.origin = uuid.uuid4().hex
+        self.errors = 0
+        threading.Thread(target=self._listen, name='event-listener', daemon=True).start()
+
+    def publish(self, user_id: str, keys: List[str], entries: List[Dict]):
+        frames = entry_frames(keys, entries)
+        self.hub.deliver(user_id, frames)
+        try:
+            self.client.publish(self.prefix + user_id, json.dumps({'origin': self.origin, 'frames': frames}))
+        except Exception:
+            self.errors += 1
+            logger.exception('Event broker failed, delivered to this worker only')
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.listener.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    user_id = message['channel'].decode('utf-8')[len(self.prefix):]
+                    if not self.hub.has_subscribers(user_id):
+                        continue
+                    payload = json.loads(message['data'])
+                    if payload['origin'] != self.origin:
+                        self.hub.deliver(user_id, payload['frames'])
+            except Exception:
+                self.errors += 1
+                logger.exception('Event listener failed, reconnecting')
+                time.sleep(1)
+
+
+def create_broker():
+    return RedisBroker(hub, REDIS_URL) if REDIS_URL else LocalBroker(hub)
@@ -0,0 +1,49 @@
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+# Non-string dict keys are converted like the stdlib does, dates and other
+# unknown types go through the provider's default() for identical output
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+
+# Compact UTF-8 JSON like the app's responses, for documents built outside
+# of a request such as the analysis snapshots
+def dumps_bytes(obj) -> bytes:
+    if orjson is None:
+        return json.dumps(obj, separators=(',', ':'), default=FastJSONProvider.default).encode('utf-8')
+    return orjson.dumps(obj, default=FastJSONProvider.default, option=ORJSON_OPTIONS)
+
+
+# JSON provider for the app. Keys keep their insertion order and output is
+# compact. Encodes with orjson when it is installed, straight to bytes for
+# responses, and with the stdlib json module otherwise. Debug mode still
+# pretty-prints through the stdlib. Objects with a to_json() method (compact
+# emotion entries) are encoded as what it returns.
+class FastJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        to_json = getattr(o, 'to_json', None)
+        if to_json is not None:
+            return to_json()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
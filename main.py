@@ -1,46 +1,80 @@
-from flask import Flask, request, jsonify
-import firebase_admin
-from firebase_admin import credentials, auth
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, stream_with_context
 from functools import wraps
-import pyrebase
 from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
 import os
+import io
+import csv
 import json
+import base64
+import itertools
 from datetime import datetime, timedelta
-from mood_recommendations import MoodRecommendationEngine
-
-app = Flask(__name__)
 
-# Load environment variables from .env file
+# Load environment variables from .env file, before the modules below read them
 load_dotenv()
 
-# Firebase configuration
-firebase_config = {
-    "apiKey": os.getenv("FIREBASE_API_KEY"),
-    "authDomain": os.getenv("FIREBASE_AUTH_DOMAIN"),
-    "projectId": os.getenv("FIREBASE_PROJECT_ID"),
-    "storageBucket": os.getenv("FIREBASE_STORAGE_BUCKET"),
-    "messagingSenderId": os.getenv("FIREBASE_MESSAGING_SENDER_ID"),
-    "appId": os.getenv("FIREBASE_APP_ID"),
-    "databaseURL": os.getenv("FIREBASE_DATABASE_URL")
-}
+import aggregates
+import clients
+import emotion_entries
+import events
+import metrics
+import rollups
+import snapshots
+from json_provider import dumps_bytes
+from ratelimit import RateLimited, SingleFlight, client_ip, flight_key
+from mood_recommendations import MoodRecommendationEngine
+from response_cache import ResponseCache
+from storage import build_entry, entry_json, entry_timestamp, position, timestamp_ms
+from user_cache import UserCache
+from write_queue import QueueFull
 
-# Initialize Firebase Admin SDK
-if os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'):
-    google_creds = json.loads(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'))
-    cred = credentials.Certificate(google_creds)
-else:
-    cred = credentials.Certificate("config/serviceAccountKey.json")
-firebase_admin.initialize_app(cred)
+# Routes of the API, registered on the app by create_app()
+api = Blueprint('api', __name__)
 
-# Initialize Pyrebase
-firebase = pyrebase.initialize_app(firebase_config)
-pb_auth = firebase.auth()
+# Firebase clients, the emotion store and the write-behind queue are created
+# on first use in each process, see clients.py. Importing this module does no
+# network or disk I/O, so gunicorn --preload masters fork clean workers.
+
+# Cache of user records for the profile and login paths
+user_cache = UserCache(auth=clients.auth)
 
 # Initialize the recommendation engine
 mood_engine = MoodRecommendationEngine()
 
+# Serialized history and analysis responses, validated with ETags
+response_cache = ResponseCache()
+
+# Identical concurrent sign-in and registration attempts share one upstream
+# call, see ratelimit.py
+auth_flights = SingleFlight()
+
+# Names this module used to create at import time, still importable by the
+# scripts and benchmarks (from main import db_pool)
+_CLIENTS = {
+    'firebase_config': clients.firebase_config,
+    'cred': clients.cred,
+    'token_verifier': clients.token_verifier,
+    'firebase': clients.firebase,
+    'pb_auth': clients.pb_auth,
+    'db_pool': clients.db_pool,
+    'emotion_store': clients.emotion_store,
+    'write_queue': clients.write_queue
+}
+
+def __getattr__(name):
+    if name in _CLIENTS:
+        return _CLIENTS[name]()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+def create_app():
+    app = Flask(__name__)
+    
+    # Per-phase request timings and Firebase call metrics, see GET /metrics
+    metrics.instrument_flask(app)
+    
+    app.register_blueprint(api)
+    return app
+
 # Authentication decorator
 def require_auth(f):
     @wraps(f)
@@ -53,7 +87,8 @@ def require_auth(f):
             # Extract token from Bearer token
             token = auth_header.split(' ')[1]
             # Verify Firebase token
-            decoded_token = auth.verify_id_token(token)
+            with metrics.phase('auth'):
+                decoded_token = clients.token_verifier().verify(token)
             request.user = decoded_token
             return f(*args, **kwargs)
         except Exception as e:
@@ -63,7 +98,139 @@ def require_auth(f):
 
 DEFAULT_PROFILE_IMAGE = "https://iili.io/FJknc9R.png"
 
-@app.route('/api/register', methods=['POST'])
+# Number of days covered by each history period
+PERIOD_DAYS = {'week': 7, 'month': 30, 'year': 365}
+
+# Covers everything a cached body depends on besides the stored entries
+def response_etag(user_id, version, endpoint, args):
+    return response_cache.etag(user_id, version, endpoint, sorted(args.items(multi=True)),
+                               datetime.now().date(), mood_engine.catalog_version)
+
+# Serves GET responses from the response cache and answers If-None-Match
+# with 304. Must be applied below require_auth. Missing or stale aggregates
+# are rebuilt first, the rebuild sets the data version. The version is kept
+# in g.data_version for the view.
+def cached_response(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = request.user['uid']
+        try:
+            emotion_store = clients.emotion_store()
+            version = aggregates.data_version(emotion_store, user_id)
+            if version is None:
+                version = aggregates.rebuild_user(emotion_store, user_id)['meta']['count']
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+        g.data_version = version
+        
+        etag = response_etag(user_id, version, request.endpoint, request.args)
+        headers = {'ETag': '"{0}"'.format(etag), 'Cache-Control': 'private, no-cache'}
+        if request.if_none_match.contains(etag):
+            response_cache.not_modified += 1
+            return Response(status=304, headers=headers)
+        
+        body = response_cache.get(etag)
+        if body is not None:
+            return Response(body, mimetype='application/json', headers=headers)
+        
+        response = current_app.make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            response_cache.set(etag, response.get_data())
+            response.headers.extend(headers)
+        return response
+    return decorated_function
+
+# Largest page of /api/emotions/history
+MAX_PAGE_SIZE = 1000
+
+# Cursors are the position (UTC milliseconds, key) of the last entry
+# returned, base64 encoded. Cursors issued before hold its local timestamp.
+def encode_cursor(key, data):
+    after = json.dumps(list(position((key, data))), separators=(',', ':'))
+    return base64.urlsafe_b64encode(after.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        ms, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(ms, str):
+            ms = timestamp_ms(datetime.fromisoformat(ms))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(ms, int) or isinstance(ms, bool) or not isinstance(key, str):
+        raise ValueError('Invalid cursor')
+    return ms, key
+
+# (limit, after) of a paginated history request, None without limit and cursor
+def parse_page_args(args):
+    if 'limit' not in args and 'cursor' not in args:
+        return None
+    limit = args.get('limit', 100, type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError('Limit must be between 1 and {0}'.format(MAX_PAGE_SIZE))
+    cursor = args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+# Pages are fetched with one extra entry to know whether another page follows
+def split_page(emotions, limit):
+    if len(emotions) <= limit:
+        return emotions, None
+    emotions = emotions[:limit]
+    return emotions, encode_cursor(*emotions[-1])
+
+# Limits for /api/emotions/batch
+MAX_BATCH_SIZE = 500
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+# Intensities are rated on a 1-10 scale
+MIN_INTENSITY = 1
+MAX_INTENSITY = 10
+
+# Shared validation for single and batch emotion writes, entries are
+# stored in the current format (see storage.py)
+def build_emotion_entry(data, user_id, timestamp):
+    if not data.get('emotion') or not data.get('intensity'):
+        raise ValueError('Emotion and intensity are required')
+    
+    try:
+        intensity = int(data['intensity'])
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Intensity must be a number')
+    if not MIN_INTENSITY <= intensity <= MAX_INTENSITY:
+        raise ValueError('Intensity must be between {0} and {1}'.format(MIN_INTENSITY, MAX_INTENSITY))
+    
+    return build_entry(data['emotion'], intensity, data.get('note', ''), timestamp, user_id)
+
+# Client timestamps are ISO 8601, aware ones are converted to server local time
+def parse_client_timestamp(value, now):
+    if not value:
+        return now
+    if not isinstance(value, str):
+        raise ValueError('Timestamp must be an ISO 8601 string')
+    
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    if timestamp > now + MAX_CLOCK_SKEW:
+        raise ValueError('Timestamp is in the future')
+    return timestamp
+
+# Valid entries of a batch and one result per item, in order
+def validate_batch(items, user_id):
+    now = datetime.now()
+    results = []
+    entries = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('Entry must be an object')
+            timestamp = parse_client_timestamp(item.get('timestamp'), now)
+            entries.append(build_emotion_entry(item, user_id, timestamp))
+            results.append({'index': index, 'status': 'created'})
+        except (TypeError, ValueError) as e:
+            results.append({'index': index, 'status': 'error', 'error': str(e)})
+    return entries, results
+
+@api.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.get_json()
@@ -75,13 +242,19 @@ def register():
         if not email or not password or not name:
             return jsonify({'error': 'Missing required fields'}), 400
         
+        clients.auth_limiter().check(ip=client_ip(request.access_route, request.remote_addr), email=email)
+        
         # Create user in Firebase with default photo
-        user = auth.create_user(
-            email=email,
-            password=password,
-            display_name=name,
-            photo_url=photo_url
-        )
+        def create_user():
+            with metrics.upstream('auth', 'create_user'):
+                return clients.auth().create_user(
+                    email=email,
+                    password=password,
+                    display_name=name,
+                    photo_url=photo_url
+                )
+        
+        user = auth_flights.do(flight_key('register', email, password, name, photo_url), create_user)
         
         return jsonify({
             'message': 'Successfully registered',
@@ -91,11 +264,13 @@ def register():
             'photo_url': user.photo_url
         }), 201
     
+    except RateLimited as e:
+        return jsonify({'error': str(e)}), 429, e.headers()
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 # Login endpoint
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     try:
         data = request.get_json()
@@ -105,24 +280,32 @@ def login():
         if not email or not password:
             return jsonify({'error': 'Missing email or password'}), 400
         
-        # Sign in with email and password
-        user = pb_auth.sign_in_with_email_and_password(email, password)
+        clients.auth_limiter().check(ip=client_ip(request.access_route, request.remote_addr), email=email)
         
-        # Get user info
-        user_info = auth.get_user(user['localId'])
+        def sign_in():
+            # Sign in with email and password
+            with metrics.upstream('auth', 'sign_in'):
+                user = clients.pb_auth().sign_in_with_email_and_password(email, password)
+            
+            # Get user info
+            return user, user_cache.get_user(user['localId'])
+        
+        user, user_info = auth_flights.do(flight_key('login', email, password), sign_in)
         
         return jsonify({
             'message': 'Successfully logged in',
-            'user_id': user_info.uid,
-            'email': user_info.email,
-            'name': user_info.display_name,
+            'user_id': user_info['uid'],
+            'email': user_info['email'],
+            'name': user_info['display_name'],
             'id_token': user['idToken']
         })
     
+    except RateLimited as e:
+        return jsonify({'error': str(e)}), 429, e.headers()
     except Exception as e:
         return jsonify({'error': str(e)}), 401
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/logout', methods=['POST'])
 @require_auth
 def logout():
     try:
@@ -133,7 +316,7 @@ def logout():
         return jsonify({'error': str(e)}), 400
 
 # Protected route example
-@app.route('/api/protected', methods=['GET'])
+@api.route('/api/protected', methods=['GET'])
 @require_auth
 def protected_route():
     user_id = request.user['uid']
@@ -142,24 +325,24 @@ def protected_route():
         'user_id': user_id
     })
 
-@app.route('/user/profile/', methods=['GET'])
+@api.route('/user/profile/', methods=['GET'])
 @require_auth
 def get_profile():
     try:
-        user_id = request.user['uid']
-        user = auth.get_user(user_id)
+        # Served from the token claims or the user cache when possible
+        user = user_cache.get_profile(request.user)
         
         return jsonify({
-            'user_id': user.uid,
-            'email': user.email,
-            'name': user.display_name,
-            'photo_url': user.photo_url,
-            'email_verified': user.email_verified
+            'user_id': user['uid'],
+            'email': user['email'],
+            'name': user['display_name'],
+            'photo_url': user['photo_url'],
+            'email_verified': user['email_verified']
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/user/profile/', methods=['PUT'])
+@api.route('/user/profile/', methods=['PUT'])
 @require_auth
 def update_profile():
     try:
@@ -172,241 +355,384 @@ def update_profile():
         if 'photo_url' in data:
             update_params['photo_url'] = data.get('photo_url', DEFAULT_PROFILE_IMAGE)
         
-        # Update user in Firebase
-        user = auth.update_user(
+        # Update user in Firebase, writing through the user cache
+        user = user_cache.update_user(
             user_id,
             **update_params
         )
         
         return jsonify({
             'message': 'Profile updated successfully',
-            'user_id': user.uid,
-            'email': user.email,
-            'name': user.display_name,
-            'photo_url': user.photo_url
+            'user_id': user['uid'],
+            'email': user['email'],
+            'name': user['display_name'],
+            'photo_url': user['photo_url']
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/api/emotions', methods=['POST'])
+# Pushes saved entries to the user's open streams. The entries are stored
+# already, a failure here never fails the save.
+def publish_entries(user_id, keys, entries):
+    try:
+        clients.event_broker().publish(user_id, keys, entries)
+    except Exception:
+        current_app.logger.exception('Failed to publish entries of %s', user_id)
+
+@api.route('/api/emotions', methods=['POST'])
 @require_auth
 def save_emotion():
     try:
         user_id = request.user['uid']
         data = request.get_json()
         
-        # Validate required fields
-        if not data.get('emotion') or not data.get('intensity'):
-            return jsonify({'error': 'Emotion and intensity are required'}), 400
+        # Validate and create emotion data with timestamp for querying
+        emotion_data = build_emotion_entry(data, user_id, datetime.now())
+        
+        emotion_store = clients.emotion_store()
+        write_queue = clients.write_queue()
+        if write_queue is not None:
+            # Written to the database by the background flusher
+            key = emotion_store.new_key(emotion_data['ts'])
+            try:
+                write_queue.enqueue(user_id, key, emotion_data)
+            except QueueFull as e:
+                return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
             
-        # Get Firebase Realtime Database reference
-        db = firebase.database()
-        
-        # Create emotion data with timestamp as key for better querying
-        emotion_data = {
-            'emotion': data['emotion'],
-            'intensity': int(data['intensity']),  # Ensure integer
-            'note': data.get('note', ''),
-            'timestamp': datetime.now().isoformat(),
-            'user_id': user_id
-        }
-        
-        # Save to Firebase using timestamp as part of the path
-        db.child('users').child(user_id).child('emotions').push(emotion_data)
+            # Streams get the entry from the flusher, once it is stored
+            return jsonify({
+                'message': 'Emotion queued',
+                'id': key,
+                'data': entry_json(emotion_data)
+            }), 202
+        
+        # Save to Firebase, the timestamp child is indexed for range queries
+        key = emotion_store.add_emotion(user_id, emotion_data)
+        rollups.record_entries(emotion_store, user_id, [emotion_data])
+        snapshot_refresher.schedule(user_id)
+        publish_entries(user_id, [key], [emotion_data])
         
         return jsonify({
             'message': 'Emotion saved successfully',
-            'data': emotion_data
+            'data': entry_json(emotion_data)
         }), 201
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/api/emotions/history', methods=['GET'])
+@api.route('/api/emotions/batch', methods=['POST'])
+@require_auth
+def save_emotions_batch():
+    try:
+        user_id = request.user['uid']
+        data = request.get_json()
+        
+        # Accept a bare array or {"entries": [...]}
+        items = data.get('entries') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'A non-empty list of entries is required'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': 'At most {0} entries per batch'.format(MAX_BATCH_SIZE)}), 400
+        
+        # Validate everything first, invalid entries are reported and skipped
+        entries, results = validate_batch(items, user_id)
+        
+        if not entries:
+            return jsonify({'error': 'No valid entries', 'results': results}), 400
+        
+        # Write all valid entries with a single multi-path update
+        emotion_store = clients.emotion_store()
+        keys = emotion_store.add_emotions(user_id, entries)
+        rollups.record_entries(emotion_store, user_id, entries)
+        snapshot_refresher.schedule(user_id)
+        publish_entries(user_id, keys, entries)
+        keys = iter(keys)
+        for result in results:
+            if result['status'] == 'created':
+                result['id'] = next(keys)
+        
+        created = len(entries)
+        return jsonify({
+            'message': '{0} of {1} emotions saved'.format(created, len(items)),
+            'results': results
+        }), 201 if created == len(items) else 207
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+# Server-Sent Events stream of the user's new entries and statistics deltas,
+# see events.py. Each open stream holds a thread here, serve streams from
+# asgi.py where an idle one is a suspended coroutine.
+@api.route('/api/emotions/stream', methods=['GET'])
 @require_auth
+def stream_emotions():
+    user_id = request.user['uid']
+    # Starts the shared broker's listener in this worker
+    clients.event_broker()
+    subscription = events.Subscription(user_id)
+    if not events.hub.subscribe(subscription):
+        return jsonify({'error': 'Too many open streams'}), 503, {'Retry-After': '30'}
+    return Response(events.stream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Response body of /api/emotions/history, statistics come from the rollups.
+# emotions are EmotionEntry objects, encoded by the JSON provider.
+def history_payload(period, start_date, end_date, emotions, buckets):
+    # Calculate statistics from the daily and weekly rollups
+    summary = aggregates.summarize(buckets.values())
+    
+    stats = {
+        'total_entries': summary['count'],
+        'emotion_frequency': {},
+        'average_intensity': 0
+    }
+    
+    if summary['count']:
+        for emotion, data in summary['emotions'].items():
+            stats['emotion_frequency'][emotion] = data['count']
+        stats['average_intensity'] = round(summary['intensity_sum'] / summary['count'], 2)
+    
+    return {
+        'period': period,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'emotions': emotions,
+        'statistics': stats
+    }
+
+# analysis field of /api/emotions/analysis, emotions are WeekdayEntry objects
+def build_analysis(start_date, end_date, emotions, buckets):
+    # numpy is only loaded by the workers that serve an analysis
+    import analytics
+    
+    # Calculate analysis
+    analysis = {
+        'total_entries': 0,
+        'date_range': {
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat()
+        },
+        'dominant_emotion': None,
+        'average_intensity': 0,
+        'daily_mood_pattern': {},
+        'emotion_distribution': {},
+        'mood_swings': False
+    }
+    
+    # Dominant emotion, distribution, daily patterns and mood swings come
+    # from the daily rollups. Recommendations are added by analysis_json().
+    analysis.update(aggregates.analyze_buckets(buckets))
+    
+    # Rolling averages, weekday patterns, volatility and transitions
+    analysis['trends'] = analytics.analyze_entries(emotions, start_date, end_date)
+    return analysis
+
+# Serialized analysis. The recommendations for the dominant emotion and its
+# average intensity are the catalog's pre-encoded fragment, spliced in
+# before the trends.
+def analysis_json(analysis):
+    recommendations = b'"recommendations":[]'
+    if analysis['dominant_emotion']:
+        dominant_data = analysis['emotion_distribution'][analysis['dominant_emotion']]
+        recommendations = mood_engine.get_recommendations_json(
+            analysis['dominant_emotion'],
+            dominant_data['average_intensity']
+        )
+    head = dumps_bytes({key: value for key, value in analysis.items() if key != 'trends'})
+    return head[:-1] + b',' + recommendations + b',"trends":' + dumps_bytes(analysis['trends']) + b'}'
+
+# Response body of /api/emotions/analysis around the serialized analysis
+def analysis_body(period, emotions, analysis):
+    head = b'{"period":' + dumps_bytes(period) + b',"weekly_data":' + dumps_bytes(emotions)
+    return head + b',"analysis":' + analysis + b'}\n'
+
+# Response bodies of /api/emotions/analysis for the given periods, from the
+# entries of the longest one and their buckets
+def analysis_bodies(periods, now, rows, buckets):
+    emotions = emotion_entries.from_rows(rows, emotion_entries.WeekdayEntry)
+    bodies = {}
+    for period in periods:
+        start_date, end_date = aggregates.day_range(PERIOD_DAYS[period], now)
+        start_seconds = emotion_entries.to_seconds(start_date.isoformat())
+        start_key = aggregates.day_key(start_date)
+        period_emotions = [entry for entry in emotions if entry.seconds >= start_seconds]
+        analysis = build_analysis(start_date, end_date, period_emotions,
+                                  {day: bucket for day, bucket in buckets.items() if day >= start_key})
+        with metrics.phase('serialization'):
+            bodies[period] = analysis_body(period, period_emotions, analysis_json(analysis))
+    return bodies
+
+@api.route('/api/emotions/history', methods=['GET'])
+@require_auth
+@cached_response
 def get_emotion_history():
     try:
         user_id = request.user['uid']
         period = request.args.get('period', 'week')  # Default to week
         
-        # Get Firebase Realtime Database reference
-        db = firebase.database()
-        
-        # Calculate date range
-        end_date = datetime.now()
-        if period == 'week':
-            start_date = end_date - timedelta(days=7)
-        elif period == 'month':
-            start_date = end_date - timedelta(days=30)
-        elif period == 'year':
-            start_date = end_date - timedelta(days=365)
-        else:
+        # Calculate date range, whole days including today
+        if period not in PERIOD_DAYS:
             return jsonify({'error': 'Invalid period'}), 400
+        start_date, end_date = aggregates.day_range(PERIOD_DAYS[period])
             
-        # Query emotions for the user within date range
-        emotions = db.child('users').child(user_id).child('emotions').get()
-        
-        emotion_history = []
-        if emotions.each():
-            for emotion in emotions.each():
-                data = emotion.val()
-                emotion_date = datetime.fromisoformat(data['timestamp'])
-                
-                if start_date <= emotion_date <= end_date:
-                    emotion_history.append({
-                        'id': emotion.key(),
-                        'emotion': data['emotion'],
-                        'intensity': data['intensity'],
-                        'note': data.get('note', ''),
-                        'timestamp': data['timestamp']
-                    })
-        
-        # Calculate statistics
-        stats = {
-            'total_entries': len(emotion_history),
-            'emotion_frequency': {},
-            'average_intensity': 0
-        }
+        # Query emotions for the user within date range, one page of them
+        # when a limit or cursor is given. Open days of the statistics come
+        # from the entries of a full read, a page has to query them.
+        emotion_store = clients.emotion_store()
+        page = parse_page_args(request.args)
+        if page is not None:
+            limit, after = page
+            emotions = emotion_store.page_emotions(user_id, start_date, end_date, limit + 1, after)
+            emotions, next_cursor = split_page(emotions, limit)
+            buckets = rollups.buckets(emotion_store, user_id, start_date.date(), end_date.date(), weekly=True)
+        else:
+            emotions = emotion_store.query_emotions(user_id, start_date, end_date)
+            buckets = rollups.buckets(emotion_store, user_id, start_date.date(), end_date.date(), weekly=True,
+                                      rows=emotions)
+        # Compact entries from here on, the stored rows are released
+        emotions = emotion_entries.from_rows(emotions)
         
-        if emotion_history:
-            # Calculate emotion frequency
-            for entry in emotion_history:
-                stats['emotion_frequency'][entry['emotion']] = \
-                    stats['emotion_frequency'].get(entry['emotion'], 0) + 1
-            
-            # Calculate average intensity
-            total_intensity = sum(entry['intensity'] for entry in emotion_history)
-            stats['average_intensity'] = round(total_intensity / len(emotion_history), 2)
+        result = history_payload(period, start_date, end_date, emotions, buckets)
+        if page is not None:
+            result['next_cursor'] = next_cursor
+        return jsonify(result)
         
-        return jsonify({
-            'period': period,
-            'start_date': start_date.isoformat(),
-            'end_date': end_date.isoformat(),
-            'emotions': emotion_history,
-            'statistics': stats
-        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+EXPORT_FIELDS = ['id', 'emotion', 'intensity', 'note', 'timestamp']
+
+def export_rows(emotions):
+    for key, data in emotions:
+        yield [key, data['emotion'], data['intensity'], data.get('note', ''), entry_timestamp(data)]
+
+def ndjson_line(row):
+    return json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+def csv_line(row):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue()
+
+# Header line and line serializer per export format
+EXPORT_FORMATS = {
+    'ndjson': ('', ndjson_line, 'application/x-ndjson'),
+    'csv': (csv_line(EXPORT_FIELDS), csv_line, 'text/csv')
+}
+
+# Streams every entry (or those of one period) page by page, memory use
+# does not depend on the size of the history
+@api.route('/api/emotions/export', methods=['GET'])
+@require_auth
+def export_emotions():
+    try:
+        user_id = request.user['uid']
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'error': 'Invalid format'}), 400
+        
+        period = request.args.get('period')
+        if period is None:
+            start_date, end_date = datetime.min, datetime.max
+        elif period in PERIOD_DAYS:
+            start_date, end_date = aggregates.day_range(PERIOD_DAYS[period])
+        else:
+            return jsonify({'error': 'Invalid period'}), 400
+        
+        # Fetch the first page before answering so that errors still get a 400
+        emotions = clients.emotion_store().iter_emotions(user_id, start_date, end_date)
+        first = next(emotions, None)
+        if first is not None:
+            emotions = itertools.chain([first], emotions)
+        
+        def generate():
+            header, serialize, _ = EXPORT_FORMATS[export_format]
+            try:
+                if header:
+                    yield header
+                for row in export_rows(emotions):
+                    yield serialize(row)
+            except Exception:
+                # Headers are gone already, the client sees a truncated body
+                current_app.logger.exception('Emotion export for %s failed', user_id)
+        
+        filename = 'emotions.{0}'.format(export_format)
+        return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format][2],
+                        headers={'Content-Disposition': 'attachment; filename=' + filename})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/api/emotions/analysis', methods=['GET'])
+# Analysis response bodies of the periods the user requested before (those
+# with a stored snapshot), rebuilt after the user's entries change, see
+# snapshot_refresher. The entries are read once, for the longest period.
+# Other periods get their snapshot on their first request.
+def analysis_snapshots(user_id):
+    emotion_store = clients.emotion_store()
+    names = set(emotion_store.snapshot_names(user_id))
+    periods = [period for period in PERIOD_DAYS if 'analysis_' + period in names]
+    if not periods:
+        return {}
+    now = datetime.now()
+    # Read before the entries, a write in between leaves the snapshots stale
+    data_version = aggregates.data_version(emotion_store, user_id)
+    if data_version is None:
+        data_version = aggregates.rebuild_user(emotion_store, user_id)['meta']['count']
+    version = snapshots.version(data_version, now.date(), mood_engine.catalog_version)
+    
+    start_date, end_date = aggregates.day_range(max(PERIOD_DAYS[period] for period in periods), now)
+    rows = emotion_store.query_emotions(user_id, start_date, end_date)
+    buckets = rollups.buckets(emotion_store, user_id, start_date.date(), end_date.date(), rows=rows)
+    bodies = analysis_bodies(periods, now, rows, buckets)
+    return {'analysis_' + period: snapshots.snapshot(version, body) for period, body in bodies.items()}
+
+# Rebuilds the analysis snapshots in the background after each save
+snapshot_refresher = snapshots.Refresher(clients.emotion_store, analysis_snapshots)
+
+@api.route('/api/emotions/analysis', methods=['GET'])
 @require_auth
+@cached_response
 def analyze_emotions():
     try:
         user_id = request.user['uid']
-        db = firebase.database()
-        
-        # Get last week's data
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=7)
-        
-        # Get emotions from database
-        emotions = db.child('users').child(user_id).child('emotions').get()
-        
-        # Process emotions
-        weekly_data = []
-        emotion_trends = {}
-        daily_intensities = {i: [] for i in range(7)}  # 0-6 for days of week
-        
-        if emotions.each():
-            for emotion in emotions.each():
-                data = emotion.val()
-                emotion_date = datetime.fromisoformat(data['timestamp'])
-                
-                if start_date <= emotion_date <= end_date:
-                    day_of_week = emotion_date.weekday()
-                    
-                    entry = {
-                        'id': emotion.key(),
-                        'emotion': data['emotion'],
-                        'intensity': data['intensity'],
-                        'note': data.get('note', ''),
-                        'timestamp': data['timestamp'],
-                        'day': emotion_date.strftime('%A')
-                    }
-                    
-                    weekly_data.append(entry)
-                    daily_intensities[day_of_week].append(data['intensity'])
-                    
-                    # Track emotion trends
-                    if data['emotion'] not in emotion_trends:
-                        emotion_trends[data['emotion']] = {
-                            'count': 0,
-                            'total_intensity': 0,
-                            'notes': []
-                        }
-                    
-                    emotion_trends[data['emotion']]['count'] += 1
-                    emotion_trends[data['emotion']]['total_intensity'] += data['intensity']
-                    if data.get('note'):
-                        emotion_trends[data['emotion']]['notes'].append(data['note'])
-        
-        # Calculate analysis
-        analysis = {
-            'total_entries': len(weekly_data),
-            'date_range': {
-                'start': start_date.isoformat(),
-                'end': end_date.isoformat()
-            },
-            'dominant_emotion': None,
-            'average_intensity': 0,
-            'daily_mood_pattern': {},
-            'emotion_distribution': {},
-            'mood_swings': False,
-            'recommendations': []
-        }
+        period = request.args.get('period', 'week')  # Default to week
         
-        if weekly_data:
-            # Calculate dominant emotion
-            max_count = 0
-            for emotion, data in emotion_trends.items():
-                avg_intensity = data['total_intensity'] / data['count']
-                analysis['emotion_distribution'][emotion] = {
-                    'frequency': data['count'],
-                    'average_intensity': round(avg_intensity, 2),
-                    'percentage': round((data['count'] / len(weekly_data)) * 100, 2)
-                }
-                
-                if data['count'] > max_count:
-                    max_count = data['count']
-                    analysis['dominant_emotion'] = emotion
-            
-            # Calculate daily mood patterns
-            for day, intensities in daily_intensities.items():
-                if intensities:
-                    day_name = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'][day]
-                    analysis['daily_mood_pattern'][day_name] = round(sum(intensities) / len(intensities), 2)
-            
-            # Check for mood swings
-            intensity_values = [entry['intensity'] for entry in weekly_data]
-            intensity_variance = max(intensity_values) - min(intensity_values)
-            analysis['mood_swings'] = intensity_variance > 5
-            
-            # Generate recommendations
-            if analysis['dominant_emotion']:
-                # Get average intensity for dominant emotion
-                dominant_data = analysis['emotion_distribution'][analysis['dominant_emotion']]
-                recommendations = mood_engine.get_recommendations(
-                    analysis['dominant_emotion'], 
-                    dominant_data['average_intensity']
-                )
-                
-                analysis['recommendations'] = recommendations['actions']
-                analysis['chatbot_suggestion'] = recommendations['chatbot_response']
-                analysis['specific_recommendations'] = recommendations['intensity_specific']
+        if period not in PERIOD_DAYS:
+            return jsonify({'error': 'Invalid period'}), 400
         
-        return jsonify({
-            'weekly_data': weekly_data,
-            'analysis': analysis
-        })
+        # The whole body comes from the snapshot written after the last save
+        # when it is still current, the only read besides the data version
+        emotion_store = clients.emotion_store()
+        now = datetime.now()
+        version = snapshots.version(g.data_version, now.date(), mood_engine.catalog_version)
+        body = snapshot_refresher.fresh_body(emotion_store.get_snapshot(user_id, 'analysis_' + period), version)
+        
+        if body is None:
+            # Whole days including today, open days of the buckets are
+            # built from the entries
+            start_date, end_date = aggregates.day_range(PERIOD_DAYS[period], now)
+            rows = emotion_store.query_emotions(user_id, start_date, end_date)
+            buckets = rollups.buckets(emotion_store, user_id, start_date.date(), end_date.date(), rows=rows)
+            body = analysis_bodies([period], now, rows, buckets)[period]
+            del rows
+            # Stored for the next request
+            try:
+                emotion_store.set_snapshots(user_id, {'analysis_' + period: snapshots.snapshot(version, body)})
+            except Exception:
+                current_app.logger.exception('Failed to store the analysis snapshot of %s', user_id)
+        return Response(body, mimetype='application/json')
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 # Update the home endpoint to include new routes
-@app.route('/', methods=['GET'])
+@api.route('/', methods=['GET'])
 def home():
-    return jsonify({
+    return jsonify(api_index())
+
+# Also served by asgi.py
+def api_index():
+    return {
         'message': 'Welcome to MoodMate API',
         'version': '1.0',
         'endpoints': {
@@ -417,18 +743,64 @@ def home():
             'get_profile': '/user/profile/ [GET]',
             'update_profile': '/user/profile/ [PUT]',
             'save_emotion': '/api/emotions [POST]',
-            'get_emotion_history': '/api/emotions/history?period={week|month|year} [GET]',
-            'analyze_emotions': '/api/emotions/analysis [GET]'
+            'save_emotions_batch': '/api/emotions/batch [POST]',
+            'get_emotion_history': '/api/emotions/history?period={week|month|year}&limit=&cursor= [GET]',
+            'export_emotions': '/api/emotions/export?format={ndjson|csv}&period= [GET]',
+            'stream_emotions': '/api/emotions/stream [GET]',
+            'analyze_emotions': '/api/emotions/analysis?period={week|month|year} [GET]'
         }
-    })
+    }
+
+@api.route('/metrics/db-pool', methods=['GET'])
+def db_pool_metrics():
+    return jsonify(clients.db_pool().stats())
+
+# Prometheus text format, per worker process
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(metric_stats()), mimetype='text/plain; version=0.0.4')
 
-@app.route('/test', methods=['GET'])
+# Clients this process has not created yet are left out. asgi.py passes its
+# own auth flights.
+def metric_stats(flights=None):
+    stats = [
+        ('moodmate_response_cache', response_cache.stats(), 'Response cache counter.'),
+        ('moodmate_user_cache', user_cache.stats(), 'User record cache counter.')
+    ]
+    db_pool = clients.peek('db_pool')
+    if db_pool is not None:
+        stats.append(('moodmate_db_pool', db_pool.stats(), 'Realtime Database connection pool counter.'))
+    token_verifier = clients.peek('token_verifier')
+    if token_verifier is not None:
+        stats.append(('moodmate_token_cache', token_verifier.stats(), 'ID token verification cache counter.'))
+    auth_limiter = clients.peek('auth_limiter')
+    if auth_limiter is not None:
+        stats.append(('moodmate_auth_rate_limit', auth_limiter.stats(), 'Login and register rate limit counter.'))
+    stats.append(('moodmate_auth_flights', (flights or auth_flights).stats(), 'Coalesced sign-in and registration calls.'))
+    stats.append(('moodmate_analysis_snapshots', snapshot_refresher.stats(), 'Analysis snapshot counter.'))
+    stream_stats = events.hub.stats()
+    event_broker = clients.peek('event_broker')
+    if event_broker is not None:
+        stream_stats['broker_errors'] = getattr(event_broker, 'errors', 0)
+    stats.append(('moodmate_event_streams', stream_stats, 'Event stream counter.'))
+    compactor = clients.peek('compactor')
+    if compactor is not None:
+        stats.append(('moodmate_rollup_compactor', compactor.stats(), 'In-process rollup compaction counter.'))
+    return stats
+
+@api.route('/metrics/response-cache', methods=['GET'])
+def response_cache_metrics():
+    return jsonify(response_cache.stats())
+
+@api.route('/test', methods=['GET'])
 def test():
     return jsonify({
         'status': 'success',
         'message': 'API is working correctly'
     })
 
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 10000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,257 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from json_provider import FastJSONProvider
+
+# Seconds, from cache hits to slow upstream calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request phases, compute is whatever is left of the request time
+PHASES = ('auth', 'upstream', 'compute', 'serialization')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus histogram with one series per label combination. Observations
+# only take a lock and bump two numbers, buckets are cumulated on render.
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} histogram'.format(self.name)]
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{0}"'.format('+Inf' if bound == float('inf') else bound)
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _format_labels(self.labelnames, labels, le), cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append('{0}_sum{1} {2!r}'.format(self.name, label_text, total))
+            lines.append('{0}_count{1} {2}'.format(self.name, label_text, cumulative))
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: int = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+request_duration = Histogram(
+    'moodmate_request_duration_seconds', 'Time spent handling requests.',
+    ('endpoint', 'method', 'status'))
+phase_duration = Histogram(
+    'moodmate_request_phase_seconds', 'Time spent in each phase of a request.',
+    ('endpoint', 'phase'))
+upstream_duration = Histogram(
+    'moodmate_upstream_duration_seconds', 'Duration of calls to Firebase.',
+    ('service', 'operation'))
+upstream_errors = Counter(
+    'moodmate_upstream_errors_total', 'Calls to Firebase that raised.',
+    ('service', 'operation'))
+
+
+# Phase totals of the request being handled. Phases of the same name that
+# overlap (concurrent upstream calls in the async app) count once, a phase
+# nested in another one is taken out of the outer phase.
+class RequestTimings:
+    __slots__ = ('start', 'phases', '_open')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self._open = {}
+
+    def enter(self, name: str, now: float):
+        entry = self._open.get(name)
+        if entry is None:
+            self._open[name] = [1, now]
+        else:
+            entry[0] += 1
+
+    def exit(self, name: str, now: float):
+        entry = self._open[name]
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self._open[name]
+            self.phases[name] += now - entry[1]
+
+    def finish(self) -> Tuple[float, Dict[str, float]]:
+        total = time.perf_counter() - self.start
+        phases = dict(self.phases)
+        phases['compute'] = max(total - sum(phases.values()), 0.0)
+        return total, phases
+
+
+_timings = contextvars.ContextVar('request_timings', default=None)
+_phase = contextvars.ContextVar('request_phase', default=None)
+
+
+@contextmanager
+def phase(name: str):
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    outer = _phase.get()
+    token = _phase.set(name)
+    start = time.perf_counter()
+    timings.enter(name, start)
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        timings.exit(name, end)
+        _phase.reset(token)
+        if outer is not None and outer != name:
+            timings.phases[outer] -= end - start
+
+
+# Times one call to Firebase ('database', 'auth') and counts it in the
+# upstream phase of the current request, if any
+@contextmanager
+def upstream(service: str, operation: str):
+    start = time.perf_counter()
+    try:
+        with phase('upstream'):
+            yield
+    except BaseException:
+        upstream_errors.inc(service, operation)
+        raise
+    finally:
+        upstream_duration.observe(time.perf_counter() - start, service, operation)
+
+
+def start_request():
+    _timings.set(RequestTimings())
+
+
+# Records the request and returns a Server-Timing header value
+def finish_request(endpoint: Optional[str], method: str, status: int) -> Optional[str]:
+    timings = _timings.get()
+    if timings is None:
+        return None
+    _timings.set(None)
+    endpoint = endpoint or 'unmatched'
+    total, phases = timings.finish()
+    request_duration.observe(total, endpoint, method, str(status))
+    for name, seconds in phases.items():
+        phase_duration.observe(seconds, endpoint, name)
+    return ', '.join('{0};dur={1:.2f}'.format(name, seconds * 1000) for name, seconds in phases.items())
+
+
+# JSON encoding is timed as the serialization phase
+class TimedJSONProvider(FastJSONProvider):
+    def dumps(self, obj, **kwargs) -> str:
+        with phase('serialization'):
+            return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        with phase('serialization'):
+            return super().response(*args, **kwargs)
+
+
+def instrument_flask(app):
+    from flask import request
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timing():
+        start_request()
+
+    @app.after_request
+    def finish_timing(response):
+        server_timing = finish_request(request.endpoint, request.method, response.status_code)
+        if server_timing:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+
+# Quart runs synchronous hooks in a thread, where the timings would be lost
+def instrument_quart(app):
+    from quart import request
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    async def start_timing():
+        start_request()
+
+    @app.after_request
+    async def finish_timing(response):
+        server_timing = finish_request(request.endpoint, request.method, response.status_code)
+        if server_timing:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+
+# Plain numbers from the components' stats() as untyped series prefix_key
+def render_stats(prefix: str, stats: Dict, help_text: str) -> List[str]:
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = '{0}_{1}'.format(prefix, key)
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} untyped'.format(name))
+        lines.append('{0} {1}'.format(name, _format_value(value)))
+    return lines
+
+
+# Text exposition format, stats are (prefix, stats dict, help text)
+def render(stats: Iterable[Tuple[str, Dict, str]] = ()) -> str:
+    lines = []
+    for metric in (request_duration, phase_duration, upstream_duration, upstream_errors):
+        lines.extend(metric.render())
+    for prefix, values, help_text in stats:
+        lines.extend(render_stats(prefix, values, help_text))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,81 @@
+"""Prepare existing emotion data for timestamp range queries.
+
+Usage:
+    python migrate_emotions.py [--dry-run] [--skip-rules]
+
+1. Adds '.indexOn: ["timestamp"]' for users/$uid/emotions to the database rules,
+   keeping every other rule as it is.
+2. Rewrites legacy timestamps (written without a fixed precision) into the
+   canonical format so that string order matches chronological order.
+"""
+import argparse
+import json
+from datetime import datetime
+
+from main import cred, db_pool, firebase_config
+from storage import format_timestamp
+
+
+def ensure_timestamp_index(session, database_url, dry_run=False):
+    access_token = cred.get_access_token().access_token
+    rules_url = '{0}/.settings/rules.json'.format(database_url.rstrip('/'))
+    params = {'access_token': access_token}
+
+    response = session.get(rules_url, params=params)
+    response.raise_for_status()
+    rules = json.loads(response.text)
+
+    emotions_rules = rules.setdefault('rules', {}) \
+        .setdefault('users', {}) \
+        .setdefault('$uid', {}) \
+        .setdefault('emotions', {})
+    index = emotions_rules.setdefault('.indexOn', [])
+    if isinstance(index, str):
+        index = emotions_rules['.indexOn'] = [index]
+
+    if 'timestamp' in index:
+        print('Index on users/$uid/emotions/timestamp already defined')
+        return
+
+    index.append('timestamp')
+    print('Adding index on users/$uid/emotions/timestamp')
+    if not dry_run:
+        response = session.put(rules_url, params=params, data=json.dumps(rules))
+        response.raise_for_status()
+
+
+def normalize_timestamps(db, dry_run=False):
+    users = db.child('users').shallow().get().val() or []
+
+    migrated = 0
+    for user_id in users:
+        emotions = db.child('users').child(user_id).child('emotions').get()
+
+        updates = {}
+        for emotion in emotions.each() or []:
+            timestamp = emotion.val().get('timestamp')
+            if not timestamp:
+                continue
+            canonical = format_timestamp(datetime.fromisoformat(timestamp))
+            if canonical != timestamp:
+                updates['{0}/timestamp'.format(emotion.key())] = canonical
+
+        if updates:
+            print('{0}: {1} entries to migrate'.format(user_id, len(updates)))
+            migrated += len(updates)
+            if not dry_run:
+                # One multi-path update per user
+                db.child('users').child(user_id).child('emotions').update(updates)
+
+    print('Migrated {0} entries across {1} users'.format(migrated, len(users)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate emotion entries for indexed range queries')
+    parser.add_argument('--dry-run', action='store_true', help='Report changes without writing them')
+    parser.add_argument('--skip-rules', action='store_true', help='Do not touch the database rules')
+    args = parser.parse_args()
+
+    if not args.skip_rules:
+        ensure_timestamp_index(db_pool.requests, firebase_config['databaseURL'], args.dry_run)
+    normalize_timestamps(db_pool.database(), args.dry_run)
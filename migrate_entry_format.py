@@ -0,0 +1,54 @@
+"""Move legacy emotion entries to the current storage format.
+
+Usage:
+    python migrate_entry_format.py [--user UID ...] [--batch-size 500] [--dry-run]
+
+Rewrites the legacy entries (ISO 'timestamp' in server local time, push id
+of the time they were written) of every user, or of the given ones, in
+format 2: 'ts' in UTC milliseconds under a key of that time, see storage.py.
+Each batch writes the new entries and removes the old ones in one atomic
+update. New keys are derived from the old ones, so re-running after an
+interruption is safe. Entry ids change, aggregates and rollups stay valid.
+Cached responses keep the old ids until the user's next save.
+
+Once a run reports no legacy entries left, set EMOTION_LEGACY_READS=0 so
+that reads skip the timestamp index query.
+"""
+import argparse
+
+import storage
+from main import emotion_store
+
+
+def migrate_user(store, user_id, batch_size=500, dry_run=False):
+    legacy = [(key, data) for key, data in store.all_emotions(user_id) if storage.is_legacy(data)]
+    if not dry_run:
+        for i in range(0, len(legacy), batch_size):
+            batch = legacy[i:i + batch_size]
+            store.replace_emotions(user_id, dict(storage.upgrade_entry(key, data) for key, data in batch),
+                                   [key for key, _ in batch])
+    return len(legacy)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move legacy emotion entries to the current storage format')
+    parser.add_argument('--user', action='append', dest='users', help='User id to migrate (repeatable)')
+    parser.add_argument('--batch-size', type=int, default=500, help='Entries per atomic update')
+    parser.add_argument('--dry-run', action='store_true', help='Report changes without writing them')
+    args = parser.parse_args()
+
+    users = args.users
+    if not users:
+        users = emotion_store.list_users()
+
+    migrated = 0
+    for user_id in users:
+        count = migrate_user(emotion_store, user_id, args.batch_size, args.dry_run)
+        if count:
+            print('{0}: {1} legacy entries'.format(user_id, count))
+        migrated += count
+
+    print('{0} {1} legacy entries across {2} users'.format(
+        'Found' if args.dry_run else 'Migrated', migrated, len(users)))
+    if not migrated:
+        print('No legacy entries left, EMOTION_LEGACY_READS=0 is safe')
@@ -1,257 +1,189 @@
-from typing import List, Dict
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.getenv(
+    'MOOD_CATALOG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mood_catalog.json'))
+
+# Seconds between two checks of the catalog file for changes
+CHECK_INTERVAL = float(os.getenv('MOOD_CATALOG_CHECK_INTERVAL', 5))
+
+INTENSITY_LEVELS = ('high', 'medium', 'low')
+
+
+# Read-only dict, recommendation bundles are shared by every request
+class FrozenDict(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Recommendation bundles are read-only')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        return hash(tuple(self.items()))
+
+
+def _build_bundle(mood_data: Dict, intensity_level: str) -> FrozenDict:
+    return FrozenDict({
+        'actions': tuple(mood_data['actions']),
+        'chatbot_response': mood_data['chatbot_responses'][0],  # Get first response for now
+        'intensity_specific': tuple(mood_data['intensity_based_recommendations'][intensity_level])
+    })
+
+
+# The recommendation fields of an /api/emotions/analysis body, as a JSON
+# object member list that is spliced into the serialized analysis
+def _bundle_json(bundle: Dict) -> bytes:
+    return ','.join('"{0}":{1}'.format(field, json.dumps(bundle[key], separators=(',', ':')))
+                    for field, key in (('recommendations', 'actions'),
+                                       ('chatbot_suggestion', 'chatbot_response'),
+                                       ('specific_recommendations', 'intensity_specific'))).encode('utf-8')
+
+
+# Bundles and their serialized JSON for every (mood, intensity level) pair,
+# the fallback bundle is stored under mood None
+class RecommendationTables:
+    def __init__(self, catalog: Dict):
+        self.mood_categories = catalog['moods']
+        self.bundles = {}
+        self.bundles_json = {}
+
+        moods = [(None, catalog['default'])] + list(catalog['moods'].items())
+        for mood, mood_data in moods:
+            for intensity_level in INTENSITY_LEVELS:
+                bundle = _build_bundle(mood_data, intensity_level)
+                self.bundles[(mood, intensity_level)] = bundle
+                self.bundles_json[(mood, intensity_level)] = _bundle_json(bundle)
+
+
+# Raised when the catalog file does not have the expected structure
+class CatalogError(ValueError):
+    pass
+
+
+def _check_strings(value, where: str):
+    if not isinstance(value, list) or not value:
+        raise CatalogError('{0} must be a non-empty list'.format(where))
+    for item in value:
+        if not isinstance(item, str) or not item.strip():
+            raise CatalogError('{0} must only contain non-empty strings'.format(where))
+
+
+def validate_catalog(catalog) -> Dict:
+    if not isinstance(catalog, dict):
+        raise CatalogError('catalog must be an object')
+    if not isinstance(catalog.get('moods'), dict) or not catalog['moods']:
+        raise CatalogError('catalog.moods must be a non-empty object')
+
+    moods = [('default', catalog.get('default'))]
+    moods += [('moods.' + mood, data) for mood, data in catalog['moods'].items()]
+    for where, mood_data in moods:
+        if not isinstance(mood_data, dict):
+            raise CatalogError('{0} must be an object'.format(where))
+        _check_strings(mood_data.get('actions'), where + '.actions')
+        _check_strings(mood_data.get('chatbot_responses'), where + '.chatbot_responses')
+        levels = mood_data.get('intensity_based_recommendations')
+        if not isinstance(levels, dict):
+            raise CatalogError('{0}.intensity_based_recommendations must be an object'.format(where))
+        for intensity_level in INTENSITY_LEVELS:
+            _check_strings(levels.get(intensity_level),
+                           '{0}.intensity_based_recommendations.{1}'.format(where, intensity_level))
+    return catalog
+
+
+# Loads the catalog on first use and reloads it when the file changes. At
+# most one thread per process checks the file every check_interval seconds,
+# the others keep using the current tables, which are replaced in a single
+# assignment once the new catalog is parsed and validated. An invalid file is
+# logged and skipped, the previous catalog stays in use. Every worker checks
+# on its own, so a reload reaches all of them without a restart.
+class CatalogLoader:
+    def __init__(self, path: str, check_interval: float = CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._tables = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+
+    def _signature_of(self) -> Tuple:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, signature: Tuple):
+        with open(self.path, encoding='utf-8') as catalog_file:
+            catalog = validate_catalog(json.load(catalog_file))
+        self._tables = RecommendationTables(catalog)
+        self._signature = signature
+        self.reloads += 1
+
+    def tables(self) -> RecommendationTables:
+        tables = self._tables
+        if tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._checked_at = time.monotonic()
+                    self._load(self._signature_of())
+            return self._tables
+
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and self._lock.acquire(blocking=False):
+            try:
+                self._checked_at = now
+                signature = self._signature_of()
+                if signature != self._signature:
+                    try:
+                        self._load(signature)
+                        logger.info('Reloaded mood catalog from %s', self.path)
+                    except (OSError, ValueError):
+                        # Skip this version of the file until it changes again
+                        self._signature = signature
+                        self.failures += 1
+                        logger.exception('Invalid mood catalog %s, keeping the previous one', self.path)
+            except OSError:
+                logger.exception('Cannot stat mood catalog %s', self.path)
+            finally:
+                self._lock.release()
+        return self._tables
+
+    # Identifies the catalog version currently in use
+    def signature(self) -> Tuple:
+        self.tables()
+        return self._signature
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+# One loader per catalog path and process, shared by every engine
+def get_loader(path: str = CATALOG_PATH) -> CatalogLoader:
+    loader = _loaders.get(path)
+    if loader is None:
+        with _loaders_lock:
+            loader = _loaders.setdefault(path, CatalogLoader(path))
+    return loader
+
 
 class MoodRecommendationEngine:
-    def __init__(self):
-        self.mood_categories = {
-            'happy': {
-                'actions': [
-                    "Share your joy with friends or family",
-                    "Document what made you happy today",
-                    "Express gratitude through journaling",
-                    "Plan a fun activity to maintain momentum",
-                    "Try a new hobby while in good spirits"
-                ],
-                'chatbot_responses': [
-                    "I'm so glad you're feeling happy! Would you like to share what made your day special?",
-                    "Your positive energy is contagious! Let's plan something fun to keep this momentum going.",
-                    "It's wonderful to see you in such good spirits! Have you considered sharing this joy with others?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Channel your positive energy into a creative project",
-                        "Consider mentoring or helping others",
-                        "Start a gratitude journal to remember these moments"
-                    ],
-                    'medium': [
-                        "Share your good mood through small acts of kindness",
-                        "Take photos to capture this happy moment",
-                        "Plan a social activity with friends"
-                    ],
-                    'low': [
-                        "Build on this feeling with some light exercise",
-                        "Listen to upbeat music",
-                        "Call a friend for a quick chat"
-                    ]
-                }
-            },
-            'sad': {
-                'actions': [
-                    "Practice gentle self-care activities",
-                    "Try light exercise or stretching",
-                    "Listen to calming music",
-                    "Reach out to a trusted friend",
-                    "Write down your feelings"
-                ],
-                'chatbot_responses': [
-                    "I hear you're feeling down. Would you like to talk about what's bothering you?",
-                    "It's okay to feel sad. How about we try something gentle to lift your spirits?",
-                    "Remember, this feeling is temporary. Should we explore some calming activities together?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Consider speaking with a mental health professional",
-                        "Practice deep breathing exercises",
-                        "Use grounding techniques to stay present"
-                    ],
-                    'medium': [
-                        "Take a relaxing walk in nature",
-                        "Try journaling your thoughts",
-                        "Do some light stretching exercises"
-                    ],
-                    'low': [
-                        "Watch a comfort movie or show",
-                        "Have a warm, soothing drink",
-                        "Listen to peaceful music"
-                    ]
-                }
-            },
-            'angry': {
-                'actions': [
-                    "Practice deep breathing exercises",
-                    "Go for a brisk walk",
-                    "Write down what's bothering you",
-                    "Find a private space to cool down",
-                    "Try progressive muscle relaxation"
-                ],
-                'chatbot_responses': [
-                    "I understand you're feeling angry. Would you like to talk about what triggered this?",
-                    "Let's take a moment to breathe together. Ready to try some calming exercises?",
-                    "Your feelings are valid. How about we channel this energy into something productive?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Step away from the situation temporarily",
-                        "Practice anger management techniques",
-                        "Consider professional guidance"
-                    ],
-                    'medium': [
-                        "Do physical exercise to release tension",
-                        "Write down your thoughts",
-                        "Practice counting to ten slowly"
-                    ],
-                    'low': [
-                        "Listen to calming music",
-                        "Try simple breathing exercises",
-                        "Change your environment briefly"
-                    ]
-                }
-            },
-            'anxious': {
-                'actions': [
-                    "Try the 5-4-3-2-1 grounding exercise",
-                    "Practice slow, deep breathing",
-                    "Go for a mindful walk",
-                    "Write down your worries",
-                    "Do gentle stretching"
-                ],
-                'chatbot_responses': [
-                    "I notice you're feeling anxious. Would you like to try a quick grounding exercise?",
-                    "Let's take this moment by moment. How about we focus on your breathing together?",
-                    "You're not alone in this. Should we explore some calming techniques?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Use the STOP technique (Stop, Take a breath, Observe, Proceed)",
-                        "Contact a mental health professional",
-                        "Practice progressive muscle relaxation"
-                    ],
-                    'medium': [
-                        "Try mindfulness meditation",
-                        "Make a list of current concerns",
-                        "Do some light physical activity"
-                    ],
-                    'low': [
-                        "Have some herbal tea",
-                        "Listen to nature sounds",
-                        "Practice gentle stretching"
-                    ]
-                }
-            },
-            'excited': {
-                'actions': [
-                    "Channel your energy into creative projects",
-                    "Share your excitement with others",
-                    "Plan something you've been wanting to do",
-                    "Write down your ideas and inspirations",
-                    "Try a new physical activity"
-                ],
-                'chatbot_responses': [
-                    "Your enthusiasm is wonderful! What's got you so excited?",
-                    "I love your energy! Want to brainstorm ways to channel it?",
-                    "It's great to see you so energized! What are you looking forward to?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Focus this energy into achieving a goal",
-                        "Start that project you've been dreaming about",
-                        "Organize a group activity or event"
-                    ],
-                    'medium': [
-                        "Make a vision board or plan",
-                        "Try a new hobby or skill",
-                        "Connect with others who share your interests"
-                    ],
-                    'low': [
-                        "Write down your positive thoughts",
-                        "Listen to upbeat music",
-                        "Take a fun photo or selfie"
-                    ]
-                }
-            },
-            'calm': {
-                'actions': [
-                    "Practice mindful meditation",
-                    "Do gentle yoga or stretching",
-                    "Read a relaxing book",
-                    "Spend time in nature",
-                    "Practice deep breathing"
-                ],
-                'chatbot_responses': [
-                    "You seem peaceful today. Would you like to maintain this tranquility?",
-                    "It's nice to feel calm. What helped you reach this state?",
-                    "Peaceful moments are precious. Shall we explore ways to extend this feeling?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Start a meditation practice",
-                        "Create a peaceful corner in your space",
-                        "Write reflectively about this feeling"
-                    ],
-                    'medium': [
-                        "Take a mindful walk",
-                        "Practice gratitude",
-                        "Listen to calming music"
-                    ],
-                    'low': [
-                        "Take deep breaths",
-                        "Observe your surroundings",
-                        "Enjoy a quiet moment"
-                    ]
-                }
-            },
-            'confused': {
-                'actions': [
-                    "Break tasks into smaller steps",
-                    "Write down your thoughts",
-                    "Talk to someone you trust",
-                    "Take a break to clear your mind",
-                    "Make a pros and cons list"
-                ],
-                'chatbot_responses': [
-                    "It's okay to feel uncertain. Want to talk through what's confusing you?",
-                    "Let's try to break this down together. What's on your mind?",
-                    "Sometimes things can be overwhelming. Should we organize your thoughts?"
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Seek professional guidance",
-                        "Use mind mapping techniques",
-                        "Take a complete break from the situation"
-                    ],
-                    'medium': [
-                        "Write down specific questions",
-                        "Research reliable information",
-                        "Discuss with a mentor or friend"
-                    ],
-                    'low': [
-                        "Take a short walk to clear your head",
-                        "Focus on what you know for sure",
-                        "Make a simple action plan"
-                    ]
-                }
-            },
-            'frustrated': {
-                'actions': [
-                    "Take a short break",
-                    "Express your feelings in writing",
-                    "Do physical exercise",
-                    "Practice problem-solving techniques",
-                    "Use stress-relief tools"
-                ],
-                'chatbot_responses': [
-                    "I can hear your frustration. Would you like to talk about what's bothering you?",
-                    "Sometimes things don't go as planned. How can I help you work through this?",
-                    "Let's take a step back and look at this from a different angle."
-                ],
-                'intensity_based_recommendations': {
-                    'high': [
-                        "Step away from the situation",
-                        "Do intense physical exercise",
-                        "Practice anger management techniques"
-                    ],
-                    'medium': [
-                        "Break the problem into smaller parts",
-                        "Try alternative approaches",
-                        "Talk to someone for perspective"
-                    ],
-                    'low': [
-                        "Take deep breaths",
-                        "List possible solutions",
-                        "Focus on what you can control"
-                    ]
-                }
-            }
-        }
+    def __init__(self, catalog_path: str = CATALOG_PATH):
+        self.loader = get_loader(catalog_path)
+
+    @property
+    def mood_categories(self) -> Dict:
+        return self.loader.tables().mood_categories
+
+    @property
+    def catalog_version(self) -> Tuple:
+        return self.loader.signature()
 
     def get_intensity_level(self, intensity: int) -> str:
         if intensity >= 8:
@@ -261,19 +193,17 @@ class MoodRecommendationEngine:
         else:
             return 'low'
 
+    def _bundle_key(self, tables: RecommendationTables, mood: str, intensity: int) -> Tuple:
+        if mood not in tables.mood_categories:
+            mood = None
+        return mood, self.get_intensity_level(intensity)
+
+    # Shared read-only bundle with 'actions', 'chatbot_response' and 'intensity_specific'
     def get_recommendations(self, mood: str, intensity: int) -> Dict:
-        if mood not in self.mood_categories:
-            return {
-                'actions': ["Take some time to reflect on your feelings"],
-                'chatbot_response': "I'm here to listen. Would you like to talk about how you're feeling?",
-                'intensity_specific': ["Practice self-awareness"]
-            }
-
-        intensity_level = self.get_intensity_level(intensity)
-        mood_data = self.mood_categories[mood]
-
-        return {
-            'actions': mood_data['actions'],
-            'chatbot_response': mood_data['chatbot_responses'][0],  # Get first response for now
-            'intensity_specific': mood_data['intensity_based_recommendations'][intensity_level]
-        }
\ No newline at end of file
+        tables = self.loader.tables()
+        return tables.bundles[self._bundle_key(tables, mood, intensity)]
+
+    # Same bundle, already serialized as the recommendation fields of an analysis
+    def get_recommendations_json(self, mood: str, intensity: int) -> bytes:
+        tables = self.loader.tables()
+        return tables.bundles_json[self._bundle_key(tables, mood, intensity)]
@@ -0,0 +1,266 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Token buckets of the auth endpoints as "<requests>/<seconds>": bursts of up
+# to <requests>, refilled at <requests> per <seconds>. "0" disables a rule.
+RATE_RULES = {
+    'ip': os.getenv('AUTH_RATE_LIMIT_IP', '30/60'),
+    'email': os.getenv('AUTH_RATE_LIMIT_EMAIL', '5/60')
+}
+
+# Shared buckets across workers and instances, local buckets when unset
+REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+
+# Proxies in front of the app that append to X-Forwarded-For (1 on Render),
+# 0 uses the peer address
+PROXY_HOPS = int(os.getenv('RATE_LIMIT_PROXY_HOPS', 0))
+
+# Distinct sign-in and registration calls in flight per worker before new
+# ones are shed with 429
+MAX_IN_FLIGHT = int(os.getenv('AUTH_MAX_IN_FLIGHT', 32))
+
+
+class RateLimited(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    # Retry-After header, whole seconds
+    def headers(self) -> Dict[str, str]:
+        return {'Retry-After': str(max(1, math.ceil(self.retry_after)))}
+
+
+# (capacity, tokens per second) or None when the rule is disabled
+def parse_rate(value: str) -> Optional[Tuple[float, float]]:
+    requests, _, seconds = value.partition('/')
+    requests = float(requests)
+    if requests <= 0:
+        return None
+    return requests, requests / float(seconds or 1)
+
+
+def client_ip(access_route: List[str], remote_addr: Optional[str], hops: int = PROXY_HOPS) -> str:
+    if hops > 0 and len(access_route) >= hops:
+        return access_route[-hops]
+    return remote_addr or ''
+
+
+# Token buckets kept in this process, also the stand-in for the shared
+# backend. Bounded by evicting the least recently used bucket; an idle
+# bucket is full again after capacity / rate seconds, so only buckets of
+# very recent clients are worth keeping.
+class LocalBuckets:
+    shared = False
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Takes one token, returns 0 or the seconds until one is available
+    def take(self, key: str, capacity: float, rate: float, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Refills and takes atomically on the Redis server, on its clock. Buckets
+# expire once they would be full again.
+REDIS_TAKE = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return tostring(wait)
+"""
+
+
+# Token buckets shared through Redis by every worker and instance. Falls
+# back to the local buckets while Redis is unreachable. The redis package
+# is optional, only needed with RATE_LIMIT_REDIS_URL.
+class RedisBuckets:
+    shared = True
+
+    def __init__(self, url: str, prefix: str = 'moodmate:ratelimit:'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('RATE_LIMIT_REDIS_URL is set but the redis package is not installed '
+                              '(pip install redis)') from None
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.script = self.client.register_script(REDIS_TAKE)
+        self.prefix = prefix
+        self.fallback = LocalBuckets()
+        self.errors = 0
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        try:
+            return float(self.script(keys=[self.prefix + key], args=[capacity, rate]))
+        except Exception:
+            self.errors += 1
+            logger.exception('Rate limit backend failed, using local buckets')
+            return self.fallback.take(key, capacity, rate)
+
+
+# Applies one token bucket per rule to the request's key for that rule (the
+# client IP, the email). Keys are hashed, emails are never stored.
+class RateLimiter:
+    def __init__(self, buckets, rules: Dict[str, str] = RATE_RULES):
+        self.buckets = buckets
+        self.rules = {name: parse_rate(rate) for name, rate in rules.items()}
+        self.allowed = 0
+        self.limited = 0
+
+    def check(self, **keys: Optional[str]):
+        for name, value in keys.items():
+            rule = self.rules.get(name)
+            if rule is None or not value:
+                continue
+            digest = hashlib.sha256(value.strip().lower().encode('utf-8')).hexdigest()[:32]
+            wait = self.buckets.take('{0}:{1}'.format(name, digest), *rule)
+            if wait > 0:
+                self.limited += 1
+                raise RateLimited('Too many attempts, retry later', wait)
+        self.allowed += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'backend_errors': getattr(self.buckets, 'errors', 0)
+        }
+
+
+def create_limiter() -> RateLimiter:
+    return RateLimiter(RedisBuckets(REDIS_URL) if REDIS_URL else LocalBuckets())
+
+
+# Key identifying identical attempts, without keeping the password around
+def flight_key(*parts: str) -> str:
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Single-flight for upstream auth calls: concurrent calls with the same key
+# wait for the first one and share its result or exception. At most
+# max_in_flight distinct calls run at once, others are shed with
+# RateLimited instead of queueing on the worker threads.
+class SingleFlight:
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+        self.shed = 0
+
+    def do(self, key: str, fn: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if not leader:
+                self.shared += 1
+            elif len(self._calls) >= self.max_in_flight:
+                self.shed += 1
+                raise RateLimited('Too many sign-in attempts in progress, retry later', 1)
+            else:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {'calls': self.calls, 'shared': self.shared, 'shed': self.shed, 'in_flight': len(self._calls)}
+
+
+# SingleFlight for coroutines, used from one event loop
+class AsyncSingleFlight:
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+        self.shed = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+        if len(self._calls) >= self.max_in_flight:
+            self.shed += 1
+            raise RateLimited('Too many sign-in attempts in progress, retry later', 1)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Marks it retrieved when nobody else waited on it
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {'calls': self.calls, 'shared': self.shared, 'shed': self.shed, 'in_flight': len(self._calls)}
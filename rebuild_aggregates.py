@@ -0,0 +1,26 @@
+"""Recompute the per-user emotion aggregates from the raw entries.
+
+Usage:
+    python rebuild_aggregates.py [--user UID ...]
+
+Rebuilds every user when no user id is given. Safe to re-run, the
+aggregates of each user are replaced as a whole.
+"""
+import argparse
+
+import aggregates
+from main import emotion_store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild emotion aggregates from raw entries')
+    parser.add_argument('--user', action='append', dest='users', help='User id to rebuild (repeatable)')
+    args = parser.parse_args()
+
+    users = args.users
+    if not users:
+        users = emotion_store.list_users()
+
+    for user_id in users:
+        result = aggregates.rebuild_user(emotion_store, user_id)
+        print('{0}: {1} entries'.format(user_id, result['meta']['count']))
@@ -0,0 +1,34 @@
+import hashlib
+import os
+from typing import Dict, Optional
+
+from cache import ByteLRUCache
+
+# Upper bound for the serialized responses kept per worker
+MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+
+# Serialized read responses keyed by their ETag. The ETag is derived from
+# everything the body depends on: the user's data version, the endpoint and
+# its arguments, the current day (windows are day-aligned) and the
+# recommendation catalog, so a cached body can never be served once any of
+# them changes and entries never need to be invalidated explicitly.
+class ResponseCache:
+    def __init__(self, maxbytes: int = MAX_BYTES):
+        self.bodies = ByteLRUCache(maxbytes)
+        self.not_modified = 0
+
+    def etag(self, user_id: str, version: int, *parts) -> str:
+        key = '\x1f'.join(str(part) for part in (user_id, version) + parts)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def get(self, etag: str) -> Optional[bytes]:
+        return self.bodies.get(etag)
+
+    def set(self, etag: str, body: bytes):
+        self.bodies.set(etag, body)
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.bodies.stats()
+        stats['not_modified'] = self.not_modified
+        return stats
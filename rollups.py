@@ -0,0 +1,324 @@
+import logging
+import os
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import aggregates
+from storage import local_datetime
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the rollup layout changes, older rollups are ignored
+# (version 2 added intensity_sq_sum)
+ROLLUPS_VERSION = 2
+
+# A day is compacted once it ended this long ago, so that writes still in
+# flight at midnight land before it is read
+GRACE = timedelta(seconds=int(os.getenv('ROLLUP_GRACE_SECONDS', 3600)))
+
+# Users read or written in this process, compacted by the in-process job
+active_users = set()
+
+
+# Immutable per-day and per-week summaries of closed periods, written under
+# users/$uid/rollups by compact_user():
+#   daily/2024-05-01 and weekly/2024-W18: count, intensity_sum,
+#   intensity_sq_sum, intensity_min, intensity_max, note_count and
+#   emotions/$emotion with count and intensity_sum
+#   meta: version, through (last compacted day) and dirty/$day for days
+#   that received entries after they were compacted
+# The layout is readable by aggregates.summarize().
+def _empty() -> Dict:
+    return {'count': 0, 'intensity_sum': 0, 'intensity_sq_sum': 0, 'intensity_min': None,
+            'intensity_max': None, 'note_count': 0, 'emotions': {}}
+
+
+def _add_entry(doc: Dict, entry: Dict):
+    intensity = int(entry['intensity'])
+    doc['count'] += 1
+    doc['intensity_sum'] += intensity
+    doc['intensity_sq_sum'] += intensity * intensity
+    if doc['intensity_min'] is None or intensity < doc['intensity_min']:
+        doc['intensity_min'] = intensity
+    if doc['intensity_max'] is None or intensity > doc['intensity_max']:
+        doc['intensity_max'] = intensity
+    if entry.get('note'):
+        doc['note_count'] += 1
+    emotion = doc['emotions'].setdefault(aggregates.encode_key(entry['emotion']),
+                                         {'count': 0, 'intensity_sum': 0})
+    emotion['count'] += 1
+    emotion['intensity_sum'] += intensity
+
+
+def merge(docs: Iterable[Dict]) -> Dict:
+    result = _empty()
+    for doc in docs:
+        result['count'] += doc['count']
+        result['intensity_sum'] += doc['intensity_sum']
+        result['intensity_sq_sum'] += doc.get('intensity_sq_sum', 0)
+        for field, pick in (('intensity_min', min), ('intensity_max', max)):
+            if result[field] is None:
+                result[field] = doc[field]
+            elif doc[field] is not None:
+                result[field] = pick(result[field], doc[field])
+        result['note_count'] += doc.get('note_count', 0)
+        for key, data in doc.get('emotions', {}).items():
+            emotion = result['emotions'].setdefault(key, {'count': 0, 'intensity_sum': 0})
+            emotion['count'] += data['count']
+            emotion['intensity_sum'] += data['intensity_sum']
+    return result
+
+
+# Daily rollups keyed by date for the given entries, only for the given
+# day keys when set
+def build_daily(entries: Iterable[Dict], only: Optional[Set[str]] = None) -> Dict[str, Dict]:
+    days = {}
+    for entry in entries:
+        day = aggregates.day_key(local_datetime(entry))
+        if only is not None and day not in only:
+            continue
+        doc = days.get(day)
+        if doc is None:
+            doc = days[day] = _empty()
+        _add_entry(doc, entry)
+    return days
+
+
+def _days(start_day: date, end_day: date) -> List[date]:
+    return [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+
+
+def _parse_day(key: str) -> date:
+    return datetime.strptime(key, '%Y-%m-%d').date()
+
+
+def _week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+# Last day that is closed and past the grace period
+def last_closed_day(now: Optional[datetime] = None) -> date:
+    return ((now or datetime.now()) - GRACE).date() - timedelta(days=1)
+
+
+def is_current(meta: Optional[Dict]) -> bool:
+    return bool(meta) and meta.get('version') == ROLLUPS_VERSION and bool(meta.get('through'))
+
+
+# Days from start_day..end_day that the rollups cannot answer for: after
+# the last compacted day, or marked dirty by a late write
+def _open_days(meta: Optional[Dict], start_day: date, end_day: date) -> List[date]:
+    if not is_current(meta):
+        return _days(start_day, end_day)
+    through = _parse_day(meta['through'])
+    dirty = {_parse_day(key) for key in (meta.get('dirty') or {})}
+    return [day for day in _days(start_day, end_day) if day > through or day in dirty]
+
+
+# Ranges of consecutive days, queried one range at a time
+def _spans(days: List[date]) -> List[List[date]]:
+    spans = []
+    for day in days:
+        if spans and day == spans[-1][-1] + timedelta(days=1):
+            spans[-1].append(day)
+        else:
+            spans.append([day])
+    return spans
+
+
+def _day_bounds(span: List[date]) -> Tuple[datetime, datetime]:
+    return datetime.combine(span[0], datetime.min.time()), datetime.combine(span[-1], datetime.max.time())
+
+
+# What to read for start_day..end_day: 'raw' entry ranges for open and
+# dirty days, 'weeks' whose weekly rollup covers them (weekly=True only,
+# weeks inside the range without open days) and 'daily' key ranges for the
+# remaining compacted days
+def read_plan(meta: Optional[Dict], start_day: date, end_day: date, weekly: bool = False) -> Dict:
+    open_days = set(_open_days(meta, start_day, end_day))
+    weeks = []
+    covered = set()
+    if weekly:
+        week = _week_start(start_day)
+        if week < start_day:
+            week += timedelta(days=7)
+        while week + timedelta(days=6) <= end_day:
+            days = _days(week, week + timedelta(days=6))
+            if not open_days.intersection(days):
+                weeks.append(aggregates.week_key(week))
+                covered.update(days)
+            week += timedelta(days=7)
+    compacted = [day for day in _days(start_day, end_day) if day not in open_days and day not in covered]
+    return {
+        'raw': [_day_bounds(span) for span in _spans(sorted(open_days))],
+        'weeks': weeks,
+        'daily': [(aggregates.day_key(span[0]), aggregates.day_key(span[-1])) for span in _spans(compacted)]
+    }
+
+
+# Daily buckets of the raw days of a plan, built from the stored entries of
+# the whole range that the caller read already
+def raw_buckets(plan: Dict, rows: Iterable[Tuple[str, Dict]]) -> Dict[str, Dict]:
+    days = {aggregates.day_key(day) for start_date, end_date in plan['raw']
+            for day in _days(start_date.date(), end_date.date())}
+    if not days:
+        return {}
+    return build_daily((data for _, data in rows), days)
+
+
+# Buckets covering start_day..end_day, keyed by day (or by week, for the
+# closed weeks inside the range when weekly=True). Compacted days come from
+# the rollups, open and dirty days from the raw entries: from rows when the
+# caller already read every entry of the range, queried otherwise.
+def buckets(store, user_id: str, start_day: date, end_day: date, weekly: bool = False,
+            rows: Optional[List[Tuple[str, Dict]]] = None) -> Dict[str, Dict]:
+    active_users.add(user_id)
+    plan = read_plan(store.get_rollups_meta(user_id), start_day, end_day, weekly)
+    if rows is not None:
+        result = raw_buckets(plan, rows)
+    else:
+        result = {}
+        for start_date, end_date in plan['raw']:
+            result.update(build_daily(data for _, data in store.query_emotions(user_id, start_date, end_date)))
+    if plan['weeks']:
+        docs = store.get_rollups(user_id, 'weekly', plan['weeks'][0], plan['weeks'][-1])
+        result.update((key, doc) for key, doc in docs.items() if key in plan['weeks'])
+    for start_key, end_key in plan['daily']:
+        result.update(store.get_rollups(user_id, 'daily', start_key, end_key))
+    return result
+
+
+# Marks days that were already closed when their entries were written, so
+# that the next compaction redoes them. Called after entries are written.
+def record_entries(store, user_id: str, entries: List[Dict]):
+    aggregates.record_entries(store, user_id, entries)
+    active_users.add(user_id)
+    updates = late_entry_marks(entries)
+    if updates:
+        try:
+            store.update_rollups(user_id, updates)
+        except Exception:
+            logger.exception('Failed to mark rollups dirty for %s', user_id)
+
+
+def late_entry_marks(entries: List[Dict], today: Optional[date] = None) -> Dict:
+    today = today or date.today()
+    marks = {}
+    for entry in entries:
+        day = local_datetime(entry).date()
+        if day < today:
+            marks['meta/dirty/' + aggregates.day_key(day)] = True
+    return marks
+
+
+# Writes the rollups of every closed day not compacted yet (and of dirty
+# days) from the raw entries, then advances meta/through. Safe to re-run,
+# documents are replaced as a whole. full=True recomputes every day.
+def compact_user(store, user_id: str, now: Optional[datetime] = None, full: bool = False) -> Dict:
+    last_closed = last_closed_day(now)
+    meta = None if full else store.get_rollups_meta(user_id)
+    if is_current(meta):
+        start_day = _parse_day(meta['through']) + timedelta(days=1)
+        dirty = sorted(_parse_day(key) for key in (meta.get('dirty') or {}))
+    else:
+        # First compaction or an older layout, start over
+        start_day, dirty, full = date.min, [], True
+
+    # Days to recompute: dirty days, then everything after the last compaction
+    spans = _spans([day for day in dirty if day < start_day])
+    if start_day <= last_closed:
+        spans.append([start_day, last_closed])
+
+    updates = {}
+    days = set()
+    for span in spans:
+        start_date, end_date = _day_bounds(span)
+        daily = build_daily(data for _, data in store.iter_emotions(user_id, start_date, end_date))
+        for key, doc in daily.items():
+            updates['daily/' + key] = doc
+        # Days that lost every entry have no document anymore
+        if span[0] != date.min:
+            for day in _days(span[0], span[-1]):
+                days.add(day)
+                if aggregates.day_key(day) not in daily:
+                    updates['daily/' + aggregates.day_key(day)] = None
+        else:
+            days.update(_parse_day(key) for key in daily)
+
+    # Weekly documents for the closed weeks that changed
+    for week in sorted({_week_start(day) for day in days}):
+        if week + timedelta(days=6) > last_closed:
+            continue
+        stored = {} if full else store.get_rollups(user_id, 'daily', aggregates.day_key(week),
+                                                   aggregates.day_key(week + timedelta(days=6)))
+        week_docs = []
+        for day in _days(week, week + timedelta(days=6)):
+            key = 'daily/' + aggregates.day_key(day)
+            doc = updates[key] if key in updates else stored.get(aggregates.day_key(day))
+            if doc:
+                week_docs.append(doc)
+        updates['weekly/' + aggregates.week_key(week)] = merge(week_docs) if week_docs else None
+
+    if full:
+        # Drops rollups of days that have no entries anymore
+        store.update_rollups(user_id, {'daily': None, 'weekly': None, 'meta': None})
+        updates = {path: doc for path, doc in updates.items() if doc is not None}
+    for day in dirty:
+        updates['meta/dirty/' + aggregates.day_key(day)] = None
+    updates['meta/version'] = ROLLUPS_VERSION
+    updates['meta/through'] = aggregates.day_key(
+        last_closed if start_day <= last_closed else start_day - timedelta(days=1))
+    updates['meta/compacted_at'] = datetime.now().isoformat()
+    store.update_rollups(user_id, updates)
+    return updates
+
+
+# Compacts the users active in this process every `interval` seconds.
+# Started once per process, after a fork the new process starts its own.
+class Compactor:
+    def __init__(self, store, interval: float):
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rollup-compactor', daemon=True)
+        self.runs = 0
+        self.failures = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def compact_once(self):
+        last_closed = aggregates.day_key(last_closed_day())
+        for user_id in list(active_users):
+            active_users.discard(user_id)
+            try:
+                meta = self.store.get_rollups_meta(user_id)
+                if not is_current(meta) or meta['through'] < last_closed or meta.get('dirty'):
+                    compact_user(self.store, user_id)
+            except Exception:
+                self.failures += 1
+                active_users.add(user_id)
+                logger.exception('Failed to compact rollups for %s', user_id)
+        self.runs += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.compact_once()
+
+    def stats(self) -> Dict:
+        return {'runs': self.runs, 'failures': self.failures, 'active_users': len(active_users)}
+
+
+# In-process compaction every ROLLUP_INTERVAL seconds (300 by default), 0
+# turns it off for deployments that run compact_rollups.py instead
+def create_compactor(store) -> Optional[Compactor]:
+    interval = float(os.getenv('ROLLUP_INTERVAL', 300))
+    if interval <= 0:
+        return None
+    compactor = Compactor(store, interval)
+    compactor.start()
+    return compactor
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import threading
+from datetime import date
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the snapshot bodies change shape or meaning, older ones
+# are stale
+SNAPSHOTS_VERSION = 4
+
+
+# Serialized results of one user, stored under users/$uid/snapshots/$name
+# with the version they were built for. The version covers everything the
+# body depends on besides the entries of its window: the user's data
+# version, the current day (windows are day-aligned) and the recommendation
+# catalog, like the response ETags. A snapshot whose version differs from
+# the current one is stale and never served.
+def version(data_version: int, day: date, catalog_version) -> str:
+    catalog = hashlib.sha256(repr(catalog_version).encode('utf-8')).hexdigest()[:12]
+    return '{0}:{1}:{2}:{3}'.format(SNAPSHOTS_VERSION, data_version, day.isoformat(), catalog)
+
+
+def snapshot(current_version: str, body: bytes) -> Dict:
+    return {'version': current_version, 'body': body.decode('utf-8')}
+
+
+# Rebuilds the snapshots of users in a background thread after their
+# entries change. build(user_id) returns the snapshots to store, keyed by
+# name. Users scheduled again while waiting are refreshed once. The thread
+# is started on first use in each process.
+class Refresher:
+    def __init__(self, store: Callable, build: Callable[[str], Dict[str, Dict]]):
+        self.store = store
+        self.build = build
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self.refreshed = 0
+        self.failures = 0
+        self.hits = 0
+        self.stale = 0
+
+    # The stored body if the snapshot is current, None otherwise
+    def fresh_body(self, stored: Optional[Dict], current_version: str) -> Optional[bytes]:
+        if stored and stored.get('version') == current_version:
+            self.hits += 1
+            return stored['body'].encode('utf-8')
+        self.stale += 1
+        return None
+
+    def schedule(self, user_id: str):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending.clear()
+                threading.Thread(target=self._run, name='snapshot-refresher', daemon=True).start()
+            self._pending.add(user_id)
+        self._wakeup.set()
+
+    def refresh(self, user_id: str):
+        snapshots = self.build(user_id)
+        if snapshots:
+            self.store().set_snapshots(user_id, snapshots)
+        self.refreshed += 1
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    user_id = self._pending.pop()
+                try:
+                    self.refresh(user_id)
+                except Exception:
+                    self.failures += 1
+                    logger.exception('Failed to refresh snapshots for %s', user_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'stale': self.stale,
+            'refreshed': self.refreshed,
+            'failures': self.failures,
+            'pending': len(self._pending)
+        }
@@ -0,0 +1,700 @@
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from random import randrange
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# Timestamps are always written with microsecond precision so that the
+# lexicographic order of the 'timestamp' child matches chronological order.
+# The Realtime Database index compares strings, so range queries rely on it.
+def format_timestamp(value: datetime) -> str:
+    return value.isoformat(timespec='microseconds')
+
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+# Largest millisecond time a key can hold
+MAX_KEY_TIME = 64 ** 8 - 1
+
+
+def _time_chars(ms: int) -> str:
+    chars = []
+    for _ in range(8):
+        chars.append(PUSH_CHARS[ms % 64])
+        ms //= 64
+    return ''.join(reversed(chars))
+
+
+# Firebase style push ids: 8 characters of millisecond time followed by 12
+# random characters, incremented within the same millisecond so that keys
+# generated by one process for the same time always sort in creation order.
+# The time is the current one unless given.
+class PushKeyGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_time = 0
+        self._last_rand = []
+
+    def generate(self, ms: Optional[int] = None) -> str:
+        with self._lock:
+            if ms is None:
+                ms = int(time.time() * 1000)
+            if ms == self._last_time:
+                for i in reversed(range(12)):
+                    if self._last_rand[i] != 63:
+                        self._last_rand[i] += 1
+                        break
+                    self._last_rand[i] = 0
+            else:
+                self._last_time = ms
+                self._last_rand = [randrange(64) for _ in range(12)]
+            rand = list(self._last_rand)
+
+        return _time_chars(ms) + ''.join(PUSH_CHARS[i] for i in rand)
+
+
+push_keys = PushKeyGenerator()
+
+
+# Stored entries come in two formats:
+#   legacy (no 'v'): 'timestamp' is a naive ISO string in server local time
+#   and the key is a push id of the time the entry was written
+#   2: 'ts' is UTC milliseconds since the epoch and the key is a push id of
+#   that time, so key order is time order. Range scans go by key, they need
+#   no index and no timestamp parsing.
+# Both carry 'emotion', 'intensity', 'note' and 'user_id'. Readers accept
+# both, writers produce ENTRY_FORMAT. Read paths still bucket by server
+# local time, like the legacy timestamps.
+ENTRY_FORMAT = 2
+
+# Legacy entries are read alongside format 2 ones until every user has been
+# migrated with migrate_entry_format.py, then set EMOTION_LEGACY_READS=0
+LEGACY_READS = os.getenv('EMOTION_LEGACY_READS', '1') == '1'
+
+EPOCH = datetime(1970, 1, 1)
+
+# Server local time is usually UTC, with no lookup per entry then
+_FIXED_OFFSET = None if time.daylight else -time.timezone
+
+
+# Seconds server local time is ahead of UTC at the given UTC epoch seconds
+def _local_offset(seconds: float) -> int:
+    if _FIXED_OFFSET is not None:
+        return _FIXED_OFFSET
+    return time.localtime(seconds).tm_gmtoff
+
+
+# Milliseconds since the epoch of a time, naive ones are server local time.
+# Clamped to the times a key can hold.
+def timestamp_ms(value: datetime) -> int:
+    if value <= EPOCH + timedelta(days=1):
+        return 0
+    if value.year >= 9999:
+        return MAX_KEY_TIME
+    return int(value.replace(microsecond=0).timestamp()) * 1000 + value.microsecond // 1000
+
+
+def is_legacy(data: Dict) -> bool:
+    return 'ts' not in data
+
+
+def entry_ms(data: Dict) -> int:
+    if 'ts' in data:
+        return data['ts']
+    return timestamp_ms(datetime.fromisoformat(data['timestamp']))
+
+
+# Seconds since 1970-01-01 of the entry's time in server local time
+def local_seconds(data: Dict) -> float:
+    ts = data.get('ts')
+    if ts is None:
+        return (datetime.fromisoformat(data['timestamp']) - EPOCH).total_seconds()
+    seconds = ts / 1000
+    return seconds + _local_offset(seconds)
+
+
+def local_datetime(data: Dict) -> datetime:
+    ts = data.get('ts')
+    if ts is None:
+        return datetime.fromisoformat(data['timestamp'])
+    return local_time(ts)
+
+
+# Server local time of UTC milliseconds since the epoch
+def local_time(ms: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=ms + _local_offset(ms / 1000) * 1000)
+
+
+# The entry's time as the API shows it, canonical ISO in server local time
+def entry_timestamp(data: Dict) -> str:
+    if 'ts' not in data:
+        return data['timestamp']
+    return format_timestamp(local_datetime(data))
+
+
+# API shape of a stored entry, legacy entries already have it
+def entry_json(data: Dict) -> Dict:
+    if 'ts' not in data:
+        return data
+    return {
+        'emotion': data['emotion'],
+        'intensity': data['intensity'],
+        'note': data.get('note', ''),
+        'timestamp': entry_timestamp(data),
+        'user_id': data.get('user_id')
+    }
+
+
+# Entry in the current format for a time in server local time
+def build_entry(emotion: str, intensity: int, note: str, timestamp: datetime, user_id: str) -> Dict:
+    return {
+        'v': ENTRY_FORMAT,
+        'emotion': emotion,
+        'intensity': intensity,
+        'note': note,
+        'ts': timestamp_ms(timestamp),
+        'user_id': user_id
+    }
+
+
+# Key and data of a legacy entry in the current format. The key's random
+# part is derived from the old key, so an interrupted migration that runs
+# again writes the same keys.
+def upgrade_entry(key: str, data: Dict) -> Tuple[str, Dict]:
+    ms = entry_ms(data)
+    digest = hashlib.sha256(key.encode('utf-8')).digest()
+    upgraded = {name: value for name, value in data.items() if name != 'timestamp'}
+    upgraded.update(v=ENTRY_FORMAT, ts=ms)
+    return _time_chars(ms) + ''.join(PUSH_CHARS[byte % 64] for byte in digest[:12]), upgraded
+
+
+# Lowest key of the format 2 entries of a millisecond
+def key_floor(ms: int) -> str:
+    return _time_chars(ms) + PUSH_CHARS[0] * 12
+
+
+# Inclusive key range holding the format 2 entries between two times
+def key_range(start_date: datetime, end_date: datetime) -> Tuple[str, str]:
+    return key_floor(timestamp_ms(start_date)), _time_chars(timestamp_ms(end_date)) + PUSH_CHARS[-1] * 12
+
+
+# Order of entries within a range and position of pagination cursors:
+# (UTC milliseconds, key). Format 2 entries are in this order by key
+# already. Legacy local times are converted, so both formats share one order
+# and local times repeated when DST ends keep their UTC order. A legacy
+# time inside the repeated hour is taken as its first occurrence.
+def position(row: Tuple[str, Dict]) -> Tuple[int, str]:
+    return entry_ms(row[1]), row[0]
+
+
+# Lowest legacy 'timestamp' of an entry at or after UTC milliseconds `ms`
+def legacy_floor(ms: int) -> str:
+    return format_timestamp(local_time(ms))
+
+
+# Rows of both formats in position order, each list being in that order
+def merge_rows(rows: List[Tuple[str, Dict]], legacy: List[Tuple[str, Dict]]) -> List[Tuple[str, Dict]]:
+    if not legacy:
+        return rows
+    if not rows:
+        return legacy
+    return list(heapq.merge(rows, legacy, key=position))
+
+
+# Storage for emotion entries and their aggregates. Entries are plain dicts
+# in either format above. Aggregates are a small document (see
+# aggregates.py) updated through flat 'a/b' paths whose values are either
+# plain values or {'.sv': {'increment': n}}.
+class EmotionStore(ABC):
+    # Key of an entry for its time in milliseconds, the current time if None
+    def new_key(self, ms: Optional[int] = None) -> str:
+        return push_keys.generate(ms)
+
+    def add_emotion(self, user_id: str, emotion_data: Dict) -> str:
+        key = self.new_key(entry_ms(emotion_data))
+        self.put_emotions(user_id, {key: emotion_data})
+        return key
+
+    # Keys are generated locally and returned in the order of the entries
+    def add_emotions(self, user_id: str, entries: List[Dict]) -> List[str]:
+        keys = [self.new_key(entry_ms(entry)) for entry in entries]
+        self.put_emotions(user_id, dict(zip(keys, entries)))
+        return keys
+
+    # Batch write. Writing an entry under a known key is idempotent.
+    @abstractmethod
+    def put_emotions(self, user_id: str, entries: Dict[str, Dict]):
+        pass
+
+    # Writes entries and removes the entries under `removed` in one atomic
+    # update, used to move entries to new keys
+    @abstractmethod
+    def replace_emotions(self, user_id: str, entries: Dict[str, Dict], removed: List[str]):
+        pass
+
+    # Entries between start_date and end_date (inclusive), in position order
+    @abstractmethod
+    def query_emotions(self, user_id: str, start_date: datetime,
+                       end_date: datetime) -> List[Tuple[str, Dict]]:
+        pass
+
+    # Up to `limit` entries between start_date and end_date (inclusive), in
+    # position order and strictly after the position `after`
+    @abstractmethod
+    def page_emotions(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                      after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        pass
+
+    # Same entries as query_emotions, fetched one page at a time
+    def iter_emotions(self, user_id: str, start_date: datetime, end_date: datetime,
+                      page_size: int = 500) -> Iterator[Tuple[str, Dict]]:
+        after = None
+        while True:
+            page = self.page_emotions(user_id, start_date, end_date, page_size, after)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = position(page[-1])
+
+    @abstractmethod
+    def all_emotions(self, user_id: str) -> List[Tuple[str, Dict]]:
+        pass
+
+    @abstractmethod
+    def list_users(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def increment_aggregates(self, user_id: str, increments: Dict):
+        pass
+
+    @abstractmethod
+    def set_aggregates(self, user_id: str, aggregates: Dict):
+        pass
+
+    @abstractmethod
+    def get_aggregates_meta(self, user_id: str) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    def clear_aggregates_meta(self, user_id: str):
+        pass
+
+    # Rollups (see rollups.py) are updated through flat 'a/b' paths, each
+    # value replaces the node at its path and None removes it
+    @abstractmethod
+    def update_rollups(self, user_id: str, updates: Dict):
+        pass
+
+    @abstractmethod
+    def get_rollups_meta(self, user_id: str) -> Optional[Dict]:
+        pass
+
+    # Rollups of one kind ('daily', 'weekly') keyed start_key..end_key inclusive
+    @abstractmethod
+    def get_rollups(self, user_id: str, kind: str, start_key: str, end_key: str) -> Dict[str, Dict]:
+        pass
+
+    # Precomputed response bodies ({'version': ..., 'body': ...}) keyed by
+    # name, see snapshots.py. Only the given snapshots are replaced.
+    @abstractmethod
+    def set_snapshots(self, user_id: str, snapshots: Dict[str, Dict]):
+        pass
+
+    @abstractmethod
+    def get_snapshot(self, user_id: str, name: str) -> Optional[Dict]:
+        pass
+
+    # Names of the user's stored snapshots, without their bodies
+    @abstractmethod
+    def snapshot_names(self, user_id: str) -> List[str]:
+        pass
+
+
+class FirebaseEmotionStore(EmotionStore):
+    def __init__(self, firebase):
+        self.firebase = firebase
+
+    def _emotions(self, user_id: str):
+        return self.firebase.database().child('users').child(user_id).child('emotions')
+
+    def _aggregates(self, user_id: str):
+        return self.firebase.database().child('users').child(user_id).child('aggregates')
+
+    def _rollups(self, user_id: str):
+        return self.firebase.database().child('users').child(user_id).child('rollups')
+
+    def _snapshots(self, user_id: str):
+        return self.firebase.database().child('users').child(user_id).child('snapshots')
+
+    def put_emotions(self, user_id: str, entries: Dict[str, Dict]):
+        self._emotions(user_id).update(entries)
+
+    def replace_emotions(self, user_id: str, entries: Dict[str, Dict], removed: List[str]):
+        updates = dict.fromkeys(removed)
+        updates.update(entries)
+        self._emotions(user_id).update(updates)
+
+    # Format 2 entries between two keys, in key order. Legacy entries whose
+    # push id falls in the range are dropped, the timestamp index finds them.
+    # Also returns whether the range held fewer than `limit` entries.
+    def _key_range(self, user_id: str, start_key: str, end_key: str,
+                   limit: Optional[int] = None) -> Tuple[List[Tuple[str, Dict]], bool]:
+        query = self._emotions(user_id).order_by_key().start_at(start_key).end_at(end_key)
+        if limit is not None:
+            query = query.limit_to_first(limit)
+        rows = [(emotion.key(), emotion.val()) for emotion in query.get().each() or []]
+        return [row for row in rows if 'ts' in row[1]], limit is None or len(rows) < limit
+
+    # Entries logged between start_date and end_date (inclusive), in position
+    # order: one key range scan, plus the legacy entries while they are read
+    def query_emotions(self, user_id: str, start_date: datetime,
+                       end_date: datetime) -> List[Tuple[str, Dict]]:
+        rows, _ = self._key_range(user_id, *key_range(start_date, end_date))
+        if LEGACY_READS:
+            rows = merge_rows(rows, self._legacy_query(user_id, start_date, end_date))
+        return rows
+
+    def page_emotions(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                      after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        rows = self._page_keys(user_id, start_date, end_date, limit, after)
+        if LEGACY_READS:
+            rows = merge_rows(rows, self._legacy_page(user_id, start_date, end_date, limit, after))[:limit]
+        return rows
+
+    # Entries sharing the cursor's millisecond are checked locally, fetching
+    # more when the ones before the cursor fill the page
+    def _page_keys(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                   after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        start_key, end_key = key_range(start_date, end_date)
+        if after is not None:
+            start_key = max(start_key, key_floor(after[0]))
+        fetch = limit + 1
+        while True:
+            rows, complete = self._key_range(user_id, start_key, end_key, fetch)
+            if after is not None:
+                rows = [row for row in rows if position(row) > after]
+            if len(rows) >= limit or complete:
+                return rows[:limit]
+            fetch *= 2
+
+    # Legacy entries logged between start_date and end_date (inclusive),
+    # ordered by timestamp, using the '.indexOn: timestamp' database rule.
+    # Format 2 entries have no 'timestamp' child and never match.
+    def _legacy_query(self, user_id: str, start_date: datetime,
+                      end_date: datetime) -> List[Tuple[str, Dict]]:
+        from requests.exceptions import HTTPError
+
+        try:
+            emotions = self._emotions(user_id) \
+                .order_by_child('timestamp') \
+                .start_at(format_timestamp(start_date)) \
+                .end_at(format_timestamp(end_date)) \
+                .get()
+        except HTTPError as e:
+            # The index has not been deployed yet (see migrate_emotions.py),
+            # fall back to downloading the whole node and filtering locally.
+            if 'Index not defined' not in str(e):
+                raise
+            return self._scan_emotions(user_id, start_date, end_date)
+
+        return sorted(((emotion.key(), emotion.val()) for emotion in emotions.each() or []), key=position)
+
+    # The index orders by local timestamp only, so entries up to the cursor's
+    # position are skipped locally, fetching more when they fill the page.
+    def _legacy_page(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                     after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        from requests.exceptions import HTTPError
+
+        start = format_timestamp(start_date)
+        if after is not None:
+            start = max(start, legacy_floor(after[0]))
+        fetch = limit + 1
+        while True:
+            try:
+                emotions = self._emotions(user_id) \
+                    .order_by_child('timestamp') \
+                    .start_at(start) \
+                    .end_at(format_timestamp(end_date)) \
+                    .limit_to_first(fetch) \
+                    .get()
+                rows = [(emotion.key(), emotion.val()) for emotion in emotions.each() or []]
+                complete = len(rows) < fetch
+            except HTTPError as e:
+                if 'Index not defined' not in str(e):
+                    raise
+                rows = self._scan_emotions(user_id, start_date, end_date)
+                complete = True
+
+            rows.sort(key=position)
+            if after is not None:
+                rows = [row for row in rows if position(row) > after]
+            if len(rows) >= limit or complete:
+                return rows[:limit]
+            fetch *= 2
+
+    def all_emotions(self, user_id: str) -> List[Tuple[str, Dict]]:
+        emotions = self._emotions(user_id).get()
+        return [(emotion.key(), emotion.val()) for emotion in emotions.each() or []]
+
+    def _scan_emotions(self, user_id: str, start_date: datetime,
+                       end_date: datetime) -> List[Tuple[str, Dict]]:
+        result = []
+        for key, data in self.all_emotions(user_id):
+            if is_legacy(data) and start_date <= datetime.fromisoformat(data['timestamp']) <= end_date:
+                result.append((key, data))
+        result.sort(key=position)
+        return result
+
+    def list_users(self) -> List[str]:
+        return list(self.firebase.database().child('users').shallow().get().val() or [])
+
+    def increment_aggregates(self, user_id: str, increments: Dict):
+        self._aggregates(user_id).update(increments)
+
+    def set_aggregates(self, user_id: str, aggregates: Dict):
+        self._aggregates(user_id).set(aggregates)
+
+    def get_aggregates_meta(self, user_id: str) -> Optional[Dict]:
+        return self._aggregates(user_id).child('meta').get().val()
+
+    def clear_aggregates_meta(self, user_id: str):
+        self._aggregates(user_id).child('meta').remove()
+
+    def update_rollups(self, user_id: str, updates: Dict):
+        self._rollups(user_id).update(updates)
+
+    def get_rollups_meta(self, user_id: str) -> Optional[Dict]:
+        return self._rollups(user_id).child('meta').get().val()
+
+    def get_rollups(self, user_id: str, kind: str, start_key: str, end_key: str) -> Dict[str, Dict]:
+        rollups = self._rollups(user_id).child(kind) \
+            .order_by_key() \
+            .start_at(start_key) \
+            .end_at(end_key) \
+            .get()
+        return {rollup.key(): rollup.val() for rollup in rollups.each() or []}
+
+    def set_snapshots(self, user_id: str, snapshots: Dict[str, Dict]):
+        self._snapshots(user_id).update(snapshots)
+
+    def get_snapshot(self, user_id: str, name: str) -> Optional[Dict]:
+        return self._snapshots(user_id).child(name).get().val()
+
+    def snapshot_names(self, user_id: str) -> List[str]:
+        return list(self._snapshots(user_id).shallow().get().val() or [])
+
+
+def _flatten(document: Dict, prefix: str = '') -> List[Tuple[str, object]]:
+    leaves = []
+    for key, value in document.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            leaves.extend(_flatten(value, path + '/'))
+        else:
+            leaves.append((path, value))
+    return leaves
+
+
+def _unflatten(leaves, strip: int = 0) -> Dict:
+    document = {}
+    for path, value in leaves:
+        parts = path.split('/')[strip:]
+        node = document
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return document
+
+
+def _is_increment(value) -> bool:
+    return isinstance(value, dict) and '.sv' in value
+
+
+# Local backend for offline runs and benchmarks. Entries are indexed on
+# (user_id, ts, key), ts holding the entry's position milliseconds in
+# either format; aggregates and rollups are stored as one row per leaf
+# path so that an increment is a single upsert per counter.
+class SQLiteEmotionStore(EmotionStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        # Files from before positions were in UTC have a local 'timestamp'
+        # column, their entries are copied to the current table
+        if 'timestamp' in [row[1] for row in conn.execute('PRAGMA table_info(emotions)')]:
+            conn.execute('ALTER TABLE emotions RENAME TO emotions_v1')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS emotions (
+                user_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (user_id, key)
+            );
+            CREATE INDEX IF NOT EXISTS emotions_user_ts ON emotions (user_id, ts, key);
+            CREATE TABLE IF NOT EXISTS aggregates (
+                user_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                value NOT NULL,
+                PRIMARY KEY (user_id, path)
+            );
+            CREATE TABLE IF NOT EXISTS rollups (
+                user_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                value NOT NULL,
+                PRIMARY KEY (user_id, path)
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                version TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (user_id, name)
+            );
+        ''')
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'emotions_v1'").fetchone():
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO emotions (user_id, key, ts, data) VALUES (?, ?, ?, ?)',
+                    [(user_id, key, entry_ms(json.loads(data)), data) for user_id, key, data
+                     in conn.execute('SELECT user_id, key, data FROM emotions_v1').fetchall()])
+                conn.execute('DROP TABLE emotions_v1')
+
+    # One connection per thread, and again after a fork
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put_emotions(self, user_id: str, entries: Dict[str, Dict]):
+        with self._connection() as conn:
+            self._insert(conn, user_id, entries)
+
+    def _insert(self, conn: sqlite3.Connection, user_id: str, entries: Dict[str, Dict]):
+        conn.executemany(
+            'INSERT OR REPLACE INTO emotions (user_id, key, ts, data) VALUES (?, ?, ?, ?)',
+            [(user_id, key, entry_ms(entry), json.dumps(entry)) for key, entry in entries.items()])
+
+    def replace_emotions(self, user_id: str, entries: Dict[str, Dict], removed: List[str]):
+        with self._connection() as conn:
+            conn.executemany('DELETE FROM emotions WHERE user_id = ? AND key = ?',
+                             [(user_id, key) for key in removed])
+            self._insert(conn, user_id, entries)
+
+    def query_emotions(self, user_id: str, start_date: datetime,
+                       end_date: datetime) -> List[Tuple[str, Dict]]:
+        rows = self._connection().execute(
+            'SELECT key, data FROM emotions WHERE user_id = ? AND ts BETWEEN ? AND ? ORDER BY ts, key',
+            (user_id, timestamp_ms(start_date), timestamp_ms(end_date)))
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def page_emotions(self, user_id: str, start_date: datetime, end_date: datetime, limit: int,
+                      after: Optional[Tuple[int, str]] = None) -> List[Tuple[str, Dict]]:
+        after_ms, after_key = after or (-1, '')
+        rows = self._connection().execute(
+            'SELECT key, data FROM emotions WHERE user_id = ? AND ts BETWEEN ? AND ? '
+            'AND (ts, key) > (?, ?) ORDER BY ts, key LIMIT ?',
+            (user_id, timestamp_ms(start_date), timestamp_ms(end_date), after_ms, after_key, limit))
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def all_emotions(self, user_id: str) -> List[Tuple[str, Dict]]:
+        rows = self._connection().execute(
+            'SELECT key, data FROM emotions WHERE user_id = ? ORDER BY key', (user_id,))
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def list_users(self) -> List[str]:
+        rows = self._connection().execute('SELECT DISTINCT user_id FROM emotions ORDER BY user_id')
+        return [row[0] for row in rows]
+
+    def increment_aggregates(self, user_id: str, increments: Dict):
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT INTO aggregates (user_id, path, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id, path) DO UPDATE SET value = value + excluded.value',
+                [(user_id, path, value['.sv']['increment'])
+                 for path, value in increments.items() if _is_increment(value)])
+            conn.executemany(
+                'INSERT OR REPLACE INTO aggregates (user_id, path, value) VALUES (?, ?, ?)',
+                [(user_id, path, value) for path, value in _flatten(
+                    {path: value for path, value in increments.items() if not _is_increment(value)})])
+
+    def set_aggregates(self, user_id: str, aggregates: Dict):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM aggregates WHERE user_id = ?', (user_id,))
+            conn.executemany(
+                'INSERT INTO aggregates (user_id, path, value) VALUES (?, ?, ?)',
+                [(user_id, path, value) for path, value in _flatten(aggregates)])
+
+    # Leaves whose path is in [low, high), '0' being the character after '/'
+    def _get_leaves(self, user_id: str, low: str, high: str, table: str = 'aggregates'):
+        return self._connection().execute(
+            'SELECT path, value FROM {0} WHERE user_id = ? AND path >= ? AND path < ? ORDER BY path'.format(table),
+            (user_id, low, high)).fetchall()
+
+    def get_aggregates_meta(self, user_id: str) -> Optional[Dict]:
+        return _unflatten(self._get_leaves(user_id, 'meta/', 'meta0'), strip=1) or None
+
+    def clear_aggregates_meta(self, user_id: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM aggregates WHERE user_id = ? AND path >= 'meta/' AND path < 'meta0'",
+                         (user_id,))
+
+    def update_rollups(self, user_id: str, updates: Dict):
+        with self._connection() as conn:
+            conn.executemany(
+                "DELETE FROM rollups WHERE user_id = ? AND (path = ? OR (path >= ? || '/' AND path < ? || '0'))",
+                [(user_id, path, path, path) for path in updates])
+            conn.executemany(
+                'INSERT INTO rollups (user_id, path, value) VALUES (?, ?, ?)',
+                [(user_id, path, value) for path, value in _flatten(
+                    {path: value for path, value in updates.items() if value is not None}) if value is not None])
+
+    def get_rollups_meta(self, user_id: str) -> Optional[Dict]:
+        return _unflatten(self._get_leaves(user_id, 'meta/', 'meta0', 'rollups'), strip=1) or None
+
+    def get_rollups(self, user_id: str, kind: str, start_key: str, end_key: str) -> Dict[str, Dict]:
+        leaves = self._get_leaves(user_id, '{0}/{1}/'.format(kind, start_key), '{0}/{1}0'.format(kind, end_key),
+                                  'rollups')
+        return _unflatten(leaves, strip=1)
+
+    def set_snapshots(self, user_id: str, snapshots: Dict[str, Dict]):
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO snapshots (user_id, name, version, body) VALUES (?, ?, ?, ?)',
+                [(user_id, name, snapshot['version'], snapshot['body']) for name, snapshot in snapshots.items()])
+
+    def get_snapshot(self, user_id: str, name: str) -> Optional[Dict]:
+        row = self._connection().execute(
+            'SELECT version, body FROM snapshots WHERE user_id = ? AND name = ?', (user_id, name)).fetchone()
+        return {'version': row[0], 'body': row[1]} if row else None
+
+    def snapshot_names(self, user_id: str) -> List[str]:
+        rows = self._connection().execute('SELECT name FROM snapshots WHERE user_id = ?', (user_id,))
+        return [row[0] for row in rows]
+
+
+# Backend selected with MOODMATE_STORAGE=firebase (default) or sqlite
+def create_store(db_pool=None) -> EmotionStore:
+    backend = os.getenv('MOODMATE_STORAGE', 'firebase')
+    if backend == 'sqlite':
+        return SQLiteEmotionStore(os.getenv('MOODMATE_SQLITE_PATH', 'var/moodmate.db'))
+    if backend == 'firebase':
+        # A callable is only called here, so other backends never connect
+        return FirebaseEmotionStore(db_pool() if callable(db_pool) else db_pool)
+    raise ValueError('Unknown storage backend: ' + backend)
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clients  # noqa: E402
+import main  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+
+
+# Accepts any bearer token, the token is the user id
+class StaticVerifier:
+    def verify(self, token):
+        return {'uid': token}
+
+
+# The app on a fresh SQLite store, with snapshots refreshed inline
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('MOODMATE_STORAGE', 'sqlite')
+    monkeypatch.setenv('MOODMATE_SQLITE_PATH', str(tmp_path / 'moodmate.db'))
+    monkeypatch.delenv('EMOTION_WRITE_BEHIND', raising=False)
+    monkeypatch.setenv('ROLLUP_INTERVAL', '0')
+    monkeypatch.setattr(clients, '_clients', {'token_verifier': (os.getpid(), StaticVerifier())})
+    monkeypatch.setattr(main, 'response_cache', ResponseCache())
+    monkeypatch.setattr(main.snapshot_refresher, 'schedule', main.snapshot_refresher.refresh)
+    return main.create_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def store(app):
+    return clients.emotion_store()
+
+
+def auth(user_id='user-1'):
+    return {'Authorization': 'Bearer ' + user_id}
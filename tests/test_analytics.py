@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+import emotion_entries
+import main
+from conftest import auth
+from storage import build_entry
+
+
+def _rows(intensities, now):
+    return [('k{0}'.format(i), build_entry('happy', intensity, '', now - timedelta(hours=i), 'user-1'))
+            for i, intensity in enumerate(intensities)]
+
+
+def test_columns_keep_values_outside_int8():
+    now = datetime.now()
+    columns = analytics.load_columns(_rows([40000, 3, -200], now))
+    assert columns.intensities.dtype.itemsize == 8
+    assert sorted(columns.intensities.tolist()) == [-200, 3, 40000]
+
+    entries = emotion_entries.from_rows(_rows([2 ** 40, 5], now))
+    assert sorted(analytics.load_entries(entries).intensities.tolist()) == [5, 2 ** 40]
+
+
+def test_columns_are_int8_on_the_scale():
+    columns = analytics.load_columns(_rows([1, 10, 7], datetime.now()))
+    assert columns.intensities.dtype.itemsize == 1
+
+
+# Entries stored before writes were validated can hold any intensity
+@pytest.mark.parametrize('period', ['week', 'month', 'year'])
+def test_analysis_with_stored_intensity_outside_scale(client, store, period):
+    now = datetime.now()
+    store.add_emotions('user-1', [build_entry('happy', 40000, '', now - timedelta(hours=1), 'user-1'),
+                                  build_entry('sad', 4, '', now - timedelta(hours=2), 'user-1')])
+
+    response = client.get('/api/emotions/analysis?period=' + period, headers=auth())
+    assert response.status_code == 200
+    trends = response.get_json()['analysis']['trends']
+    assert trends['total_entries'] == 2
+    assert trends['average_intensity'] == 20002.0
+
+    # The background refresh rebuilds the same body for the requested period
+    snapshots = main.analysis_snapshots('user-1')
+    assert list(snapshots) == ['analysis_' + period]
+    assert snapshots['analysis_' + period]['body'].encode('utf-8') == response.data
+
+
+# The rollup analysis and the trends flag mood swings the same way, by the
+# standard deviation (one outlier in a steady day is no swing)
+@pytest.mark.parametrize('intensities, swings', [
+    ([1] * 9 + [7], False),
+    ([2, 9, 2, 9], True),
+    ([3, 8, 3, 8], False)
+])
+def test_mood_swings_agree(client, store, intensities, swings):
+    now = datetime.now().replace(hour=12, minute=0)
+    store.add_emotions('user-1', [build_entry('happy', intensity, '', now - timedelta(minutes=i), 'user-1')
+                                  for i, intensity in enumerate(intensities)])
+
+    analysis = client.get('/api/emotions/analysis', headers=auth()).get_json()['analysis']
+    assert analysis['mood_swings'] is swings
+    assert analysis['trends']['mood_swings'] is swings
+    assert analysis['trends']['volatile_days'] == ([now.date().isoformat()] if swings else [])
@@ -0,0 +1,76 @@
+import functools
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import cohort
+from conftest import auth
+from storage import SQLiteEmotionStore, build_entry
+
+
+# Three users over the last three days: a steady one, a volatile one and
+# one with nothing in the period
+@pytest.fixture
+def saved(store):
+    end = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    days = {
+        'steady': [('happy', 6, 0), ('happy', 7, 1), ('calm', 5, 2)],
+        'volatile': [('sad', 1, 0), ('angry', 10, 0), ('sad', 1, 1), ('happy', 10, 2)],
+        'idle': [('happy', 5, 30)]
+    }
+    for user_id, rows in days.items():
+        entries = [build_entry(emotion, intensity, '', end - timedelta(days=ago), user_id)
+                   for emotion, intensity, ago in rows]
+        store.put_emotions(user_id, {store.new_key(entry['ts']): entry for entry in entries})
+    return end.date() - timedelta(days=2), end.date()
+
+
+def _store_factory():
+    return functools.partial(SQLiteEmotionStore, os.environ['MOODMATE_SQLITE_PATH'])
+
+
+def test_report(saved):
+    start_day, end_day = saved
+    report = cohort.report(cohort.run(_store_factory(), ['steady', 'volatile', 'idle'], start_day, end_day,
+                                      workers=1), start_day, end_day)
+    assert report['users'] == 3
+    assert report['active_users'] == 2
+    assert report['total_entries'] == 7
+    assert report['average_intensity'] == round(40 / 7, 2)
+    assert report['dominant_emotions'] == {'happy': {'users': 1, 'percentage': 50.0},
+                                           'sad': {'users': 1, 'percentage': 50.0}}
+    assert report['mood_swings'] == {'users': 1, 'percentage': 50.0}
+    assert report['emotion_frequency'] == {'happy': 3, 'sad': 2, 'angry': 1, 'calm': 1}
+    assert [day['date'] for day in report['intensity_trend']] == [
+        (start_day + timedelta(days=i)).isoformat() for i in range(3)]
+    assert [day['users'] for day in report['intensity_trend']] == [2, 2, 2]
+    assert report['intensity_trend'][-1]['average_intensity'] == round(17 / 3, 2)
+
+
+# Every user is flagged like the analysis endpoint flags them
+def test_same_analysis_as_the_endpoint(client, saved):
+    start_day, end_day = saved
+    partial = cohort.run(_store_factory(), ['steady', 'volatile'], start_day, end_day, workers=1)
+    flagged = [client.get('/api/emotions/analysis?period=week', headers=auth(user_id)).get_json()
+               ['analysis']['mood_swings'] for user_id in ('steady', 'volatile')]
+    assert flagged == [False, True]
+    assert partial['mood_swings'] == 1
+
+
+# Chunks merged from worker processes add up to the single process run
+def test_workers(saved):
+    start_day, end_day = saved
+    user_ids = ['steady', 'volatile', 'idle', 'nobody']
+    single = cohort.run(_store_factory(), user_ids, start_day, end_day, workers=1)
+    assert cohort.run(_store_factory(), iter(user_ids), start_day, end_day, workers=2, chunk_size=1) == single
+    assert single['users'] == 4
+
+
+def test_no_users(saved):
+    start_day, end_day = saved
+    report = cohort.report(cohort.run(_store_factory(), [], start_day, end_day, workers=1), start_day, end_day)
+    assert report['active_users'] == 0
+    assert report['mood_swings'] == {'users': 0, 'percentage': 0}
+    assert report['intensity_trend'][0] == {'date': start_day.isoformat(), 'entries': 0, 'users': 0,
+                                            'average_intensity': None}
@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import auth
+
+
+@pytest.mark.parametrize('intensity', ['1', '10', '"7"'])
+def test_save_accepts_intensity_scale(client, intensity):
+    response = client.post('/api/emotions', data='{"emotion": "happy", "intensity": %s}' % intensity,
+                           content_type='application/json', headers=auth())
+    assert response.status_code == 201
+
+
+@pytest.mark.parametrize('intensity', ['11', '-3', '40000', str(2 ** 70), 'Infinity', '"abc"', '[5]'])
+def test_save_rejects_intensity_outside_scale(client, store, intensity):
+    response = client.post('/api/emotions', data='{"emotion": "happy", "intensity": %s}' % intensity,
+                           content_type='application/json', headers=auth())
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Intensity must be')
+    assert store.all_emotions('user-1') == []
+
+
+def test_batch_reports_out_of_range_intensity(client):
+    response = client.post('/api/emotions/batch', json=[
+        {'emotion': 'happy', 'intensity': 5},
+        {'emotion': 'sad', 'intensity': 99}
+    ], headers=auth())
+    assert response.status_code == 207
+    results = response.get_json()['results']
+    assert results[0]['status'] == 'created'
+    assert results[1] == {'index': 1, 'status': 'error', 'error': 'Intensity must be between 1 and 10'}
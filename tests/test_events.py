@@ -0,0 +1,188 @@
+import asyncio
+import json
+import queue
+import sys
+import time
+import types
+from datetime import datetime
+
+import pytest
+
+import events
+from events import AsyncSubscription, Hub, LocalBroker, RedisBroker, Subscription
+from storage import build_entry
+
+
+def _entry(emotion='happy', intensity=5):
+    return build_entry(emotion, intensity, '', datetime.now(), 'user-1')
+
+
+def test_subscription_lags_once_full():
+    subscription = Subscription('user-1', maxsize=3)
+    subscription.push(['a', 'b'])
+    assert subscription.wait(0) == ['a', 'b']
+
+    subscription.push(['c', 'd'])
+    subscription.push(['e', 'f'])
+    # The queue is dropped, later frames are ignored
+    assert subscription.lagged
+    assert subscription.wait(0) == []
+    subscription.push(['g'])
+    assert subscription.drain() == []
+
+
+def test_hub_limits_streams():
+    hub = Hub(max_per_user=2, max_streams=3)
+    first, second = Subscription('user-1'), Subscription('user-1')
+    assert hub.subscribe(first) and hub.subscribe(second)
+    assert not hub.subscribe(Subscription('user-1'))
+    assert hub.subscribe(Subscription('user-2'))
+    assert not hub.subscribe(Subscription('user-3'))
+    assert not hub.has_subscribers('user-3')
+
+    hub.unsubscribe(first)
+    hub.unsubscribe(first)
+    assert hub.stats() == {'open': 2, 'refused': 2, 'delivered': 0, 'lagged': 0}
+
+
+# A slow stream is cut off without holding up the others
+def test_slow_subscriber_is_reset(monkeypatch):
+    hub = Hub()
+    monkeypatch.setattr(events, 'hub', hub)
+    slow, fast = Subscription('user-1', maxsize=4), Subscription('user-1', maxsize=4)
+    hub.subscribe(slow)
+    hub.subscribe(fast)
+    frames = events.stream(slow, heartbeat=0)
+    assert next(frames) == events.RETRY_FRAME
+
+    hub.deliver('user-1', ['one', 'two'])
+    assert fast.wait(0) == ['one', 'two']
+    hub.deliver('user-1', ['three', 'four'])
+    assert fast.wait(0) == ['three', 'four']
+    hub.deliver('user-1', ['five'])
+    assert fast.wait(0) == ['five']
+
+    # The slow stream still held four frames and gets the reset instead
+    assert next(frames) == events.RESET_FRAME
+    with pytest.raises(StopIteration):
+        next(frames)
+    assert hub.stats() == {'open': 1, 'refused': 0, 'delivered': 5, 'lagged': 1}
+
+
+def test_stream_heartbeat_and_frames(monkeypatch):
+    hub = Hub()
+    monkeypatch.setattr(events, 'hub', hub)
+    subscription = Subscription('user-1')
+    hub.subscribe(subscription)
+    frames = events.stream(subscription, heartbeat=0)
+    next(frames)
+    assert next(frames) == events.HEARTBEAT_FRAME
+
+    LocalBroker(hub).publish('user-1', ['-key'], [_entry()])
+    chunk = next(frames)
+    assert chunk.startswith('event: entry\ndata: {"id":"-key"')
+    assert '\nevent: stats\n' in chunk
+    frames.close()
+    assert not hub.has_subscribers('user-1')
+
+
+def test_async_subscription(monkeypatch):
+    hub = Hub()
+    monkeypatch.setattr(events, 'hub', hub)
+
+    async def run():
+        slow = AsyncSubscription('user-1', maxsize=1)
+        hub.subscribe(slow)
+        frames = events.astream(slow, heartbeat=0.01)
+        assert await frames.__anext__() == events.RETRY_FRAME
+        assert await frames.__anext__() == events.HEARTBEAT_FRAME
+
+        # Published from another thread, like a flush of the write-behind queue
+        await asyncio.to_thread(hub.deliver, 'user-1', ['one'])
+        assert await frames.__anext__() == 'one'
+        await asyncio.to_thread(hub.deliver, 'user-1', ['two', 'three'])
+        assert await frames.__anext__() == events.RESET_FRAME
+        with pytest.raises(StopAsyncIteration):
+            await frames.__anext__()
+
+    asyncio.run(run())
+    assert hub.stats()['open'] == 0
+
+
+# Stands in for a Redis server: records publishes, serves pub/sub
+# messages from a queue, fails publishes while down
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+        self.messages = queue.Queue()
+        self.down = False
+
+    def from_url(self, url, **kwargs):
+        return self
+
+    def publish(self, channel, message):
+        if self.down:
+            raise ConnectionError('Redis is down')
+        self.published.append((channel, message))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return self
+
+    def psubscribe(self, pattern):
+        self.pattern = pattern
+
+    # The listener thread (a daemon) stays blocked here after the test
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+    def send(self, user_id, origin, frames):
+        self.messages.put({'type': 'pmessage', 'channel': ('moodmate:events:' + user_id).encode('utf-8'),
+                           'data': json.dumps({'origin': origin, 'frames': frames}).encode('utf-8')})
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    server = FakeRedis()
+    monkeypatch.setitem(sys.modules, 'redis', types.SimpleNamespace(Redis=server))
+    return server
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_redis_broker(redis_server):
+    hub = Hub()
+    broker = RedisBroker(hub, 'redis://localhost:6379/0')
+    subscription = Subscription('user-1')
+    hub.subscribe(subscription)
+
+    broker.publish('user-1', ['-key'], [_entry()])
+    assert len(subscription.drain()) == 2
+    channel, message = redis_server.published[0]
+    assert channel == 'moodmate:events:user-1'
+    assert json.loads(message)['origin'] == broker.origin
+
+    # Frames of other workers are delivered, this worker's own are not
+    # delivered twice, users without streams here are skipped
+    redis_server.send('user-1', broker.origin, ['own'])
+    redis_server.send('user-2', 'other-worker', ['nobody'])
+    redis_server.send('user-1', 'other-worker', ['remote'])
+    _wait_for(lambda: hub.delivered == 2)
+    assert subscription.drain() == ['remote']
+
+    # Local streams keep working while Redis is down
+    redis_server.down = True
+    broker.publish('user-1', ['-key2'], [_entry('sad', 2)])
+    assert len(subscription.drain()) == 2
+    assert broker.errors == 1
+
+
+def test_redis_package_is_optional(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'redis', None)
+    with pytest.raises(ImportError, match='EVENTS_REDIS_URL'):
+        RedisBroker(Hub(), 'redis://localhost:6379/0')
@@ -0,0 +1,75 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import auth
+from storage import build_entry, entry_timestamp
+
+
+# Entries of the last days and an old one, saved out of order, with a
+# note that needs CSV quoting
+@pytest.fixture
+def saved(store):
+    now = datetime.now().replace(microsecond=0)
+    entries = [build_entry('sad', 3, 'rainy, "grey" day', now - timedelta(days=2), 'user-1'),
+               build_entry('happy', 8, '', now - timedelta(days=400), 'user-1'),
+               build_entry('calm', 5, 'tea\nand a book', now, 'user-1')]
+    keys = [store.new_key(entry['ts']) for entry in entries]
+    store.put_emotions('user-1', dict(zip(keys, entries)))
+    return sorted(zip(keys, entries), key=lambda row: row[1]['ts'])
+
+
+def _expected(rows):
+    return [{'id': key, 'emotion': data['emotion'], 'intensity': data['intensity'], 'note': data['note'],
+             'timestamp': entry_timestamp(data)} for key, data in rows]
+
+
+def test_ndjson(client, saved):
+    response = client.get('/api/emotions/export', headers=auth())
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=emotions.ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == _expected(saved)
+
+
+def test_csv_period(client, saved):
+    response = client.get('/api/emotions/export?format=csv&period=week', headers=auth())
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True), newline='')))
+    assert rows[0] == ['id', 'emotion', 'intensity', 'note', 'timestamp']
+    assert [dict(zip(rows[0], row)) for row in rows[1:]] == [
+        dict(row, intensity=str(row['intensity'])) for row in _expected(saved[1:])]
+
+
+# Histories longer than a page are streamed page by page
+def test_every_page(client, store):
+    now = datetime.now()
+    entries = [build_entry('happy', 1 + i % 10, '', now - timedelta(minutes=i), 'user-1') for i in range(1200)]
+    store.put_emotions('user-1', {store.new_key(entry['ts']): entry for entry in entries})
+    lines = client.get('/api/emotions/export', headers=auth()).get_data(as_text=True).splitlines()
+    assert len(lines) == 1200
+    timestamps = [json.loads(line)['timestamp'] for line in lines]
+    assert timestamps == sorted(timestamps)
+
+
+def test_empty_export(client):
+    response = client.get('/api/emotions/export?format=csv', headers=auth())
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'id,emotion,intensity,note,timestamp\r\n'
+    assert client.get('/api/emotions/export', headers=auth()).data == b''
+
+
+@pytest.mark.parametrize('query, error', [('format=xml', 'Invalid format'), ('period=decade', 'Invalid period')])
+def test_invalid_arguments(client, query, error):
+    response = client.get('/api/emotions/export?' + query, headers=auth())
+    assert response.status_code == 400
+    assert response.get_json() == {'error': error}
+
+
+def test_requires_auth(client):
+    assert client.get('/api/emotions/export').status_code == 401
@@ -0,0 +1,143 @@
+import json
+import os
+
+import pytest
+
+import mood_recommendations
+from conftest import auth
+from mood_recommendations import CatalogError, CatalogLoader, MoodRecommendationEngine, get_loader, validate_catalog
+
+
+@pytest.fixture
+def engine():
+    return MoodRecommendationEngine()
+
+
+@pytest.mark.parametrize('mood, intensity', [('happy', 9), ('sad', 6), ('calm', 2), ('unknown', 5)])
+def test_serialized_bundles(engine, mood, intensity):
+    bundle = engine.get_recommendations(mood, intensity)
+    fragment = json.loads(b'{' + engine.get_recommendations_json(mood, intensity) + b'}')
+    assert fragment == {
+        'recommendations': list(bundle['actions']),
+        'chatbot_suggestion': bundle['chatbot_response'],
+        'specific_recommendations': list(bundle['intensity_specific'])
+    }
+    assert engine.get_recommendations_json(mood, intensity) is engine.get_recommendations_json(mood, intensity)
+
+
+def test_analysis_recommendations(client, engine):
+    client.post('/api/emotions/batch', json=[{'emotion': 'sad', 'intensity': 8}, {'emotion': 'sad', 'intensity': 9}],
+                headers=auth())
+    analysis = client.get('/api/emotions/analysis', headers=auth()).get_json()['analysis']
+    bundle = engine.get_recommendations('sad', 8.5)
+    assert analysis['recommendations'] == list(bundle['actions'])
+    assert analysis['chatbot_suggestion'] == bundle['chatbot_response']
+    assert analysis['specific_recommendations'] == list(bundle['intensity_specific'])
+    assert list(analysis)[-4:] == ['recommendations', 'chatbot_suggestion', 'specific_recommendations', 'trends']
+
+    empty = client.get('/api/emotions/analysis', headers=auth('user-2')).get_json()['analysis']
+    assert empty['recommendations'] == []
+    assert 'chatbot_suggestion' not in empty
+
+
+def _catalog(action):
+    with open(mood_recommendations.CATALOG_PATH, encoding='utf-8') as catalog_file:
+        catalog = json.load(catalog_file)
+    catalog['moods']['happy']['actions'] = [action]
+    return catalog
+
+
+# Writes the catalog with a distinct mtime, as if edited a while later
+def _write(path, catalog, mtime):
+    path.write_text(catalog if isinstance(catalog, str) else json.dumps(catalog), encoding='utf-8')
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def catalog_path(tmp_path):
+    path = tmp_path / 'mood_catalog.json'
+    _write(path, _catalog('Dance'), 1_000_000_000)
+    return path
+
+
+def _actions(loader):
+    return loader.tables().bundles[('happy', 'high')]['actions']
+
+
+def test_catalog_reload(catalog_path, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(mood_recommendations.time, 'monotonic', lambda: clock[0])
+    loader = CatalogLoader(str(catalog_path), check_interval=5)
+    assert _actions(loader) == ('Dance',)
+    version = loader.signature()
+
+    # Changes are picked up on the first check after check_interval
+    _write(catalog_path, _catalog('Sing'), 2_000_000_000)
+    clock[0] += 1
+    assert _actions(loader) == ('Dance',)
+    clock[0] += 5
+    assert _actions(loader) == ('Sing',)
+    assert loader.signature() != version
+    assert loader.reloads == 2
+
+    # Unchanged files are not parsed again
+    clock[0] += 5
+    loader.tables()
+    assert loader.reloads == 2
+
+
+@pytest.mark.parametrize('content', ['{"moods": ', json.dumps({'moods': {'happy': {'actions': []}}})])
+def test_invalid_catalog_keeps_the_previous_one(catalog_path, monkeypatch, content):
+    clock = [100.0]
+    monkeypatch.setattr(mood_recommendations.time, 'monotonic', lambda: clock[0])
+    loader = CatalogLoader(str(catalog_path), check_interval=5)
+    loader.tables()
+
+    _write(catalog_path, content, 2_000_000_000)
+    clock[0] += 5
+    assert _actions(loader) == ('Dance',)
+    assert loader.failures == 1
+    # Skipped until the file changes again
+    clock[0] += 5
+    loader.tables()
+    assert loader.failures == 1
+
+    _write(catalog_path, _catalog('Sing'), 3_000_000_000)
+    clock[0] += 5
+    assert _actions(loader) == ('Sing',)
+
+
+# A broken catalog at startup is an error, a removed one later is not
+def test_first_load_errors(tmp_path, catalog_path, monkeypatch):
+    broken = tmp_path / 'broken.json'
+    _write(broken, '[]', 1_000_000_000)
+    with pytest.raises(CatalogError):
+        CatalogLoader(str(broken)).tables()
+    with pytest.raises(OSError):
+        CatalogLoader(str(tmp_path / 'missing.json')).tables()
+
+    clock = [100.0]
+    monkeypatch.setattr(mood_recommendations.time, 'monotonic', lambda: clock[0])
+    loader = CatalogLoader(str(catalog_path), check_interval=5)
+    loader.tables()
+    catalog_path.unlink()
+    clock[0] += 5
+    assert _actions(loader) == ('Dance',)
+
+
+def test_validate_catalog():
+    catalog = _catalog('Dance')
+    assert validate_catalog(catalog) is catalog
+    del catalog['moods']['sad']['intensity_based_recommendations']['low']
+    with pytest.raises(CatalogError, match='moods.sad.intensity_based_recommendations.low'):
+        validate_catalog(catalog)
+
+
+# Every engine of a process shares the loader of its catalog path
+def test_loader_per_path(catalog_path):
+    engine = MoodRecommendationEngine(str(catalog_path))
+    assert MoodRecommendationEngine(str(catalog_path)).loader is engine.loader
+    assert get_loader(str(catalog_path)) is engine.loader
+    assert engine.get_recommendations('happy', 9)['actions'] == ('Dance',)
+    with pytest.raises(TypeError):
+        engine.get_recommendations('happy', 9)['actions'] = ()
@@ -0,0 +1,201 @@
+import asyncio
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import ratelimit
+from ratelimit import (AsyncSingleFlight, LocalBuckets, RateLimited, RateLimiter, RedisBuckets, SingleFlight,
+                       client_ip, parse_rate)
+
+
+def test_parse_rate():
+    assert parse_rate('30/60') == (30, 0.5)
+    assert parse_rate('5') == (5, 5)
+    assert parse_rate('0') is None
+
+
+def test_client_ip():
+    assert client_ip(['10.0.0.1', '203.0.113.7'], '10.0.0.2', hops=1) == '203.0.113.7'
+    assert client_ip(['10.0.0.1'], '10.0.0.2', hops=0) == '10.0.0.2'
+    assert client_ip([], None, hops=2) == ''
+
+
+def test_local_buckets_refill():
+    buckets = LocalBuckets()
+    # Bursts of 2, one token every 10 seconds
+    assert buckets.take('ip:a', 2, 0.1, now=100) == 0
+    assert buckets.take('ip:a', 2, 0.1, now=100) == 0
+    assert buckets.take('ip:a', 2, 0.1, now=100) == pytest.approx(10)
+    assert buckets.take('ip:a', 2, 0.1, now=104) == pytest.approx(6)
+    assert buckets.take('ip:a', 2, 0.1, now=110) == 0
+    # Never more than the capacity, however long the bucket was idle
+    assert [buckets.take('ip:a', 2, 0.1, now=1000) for _ in range(3)][-1] > 0
+
+    # Other keys have their own bucket
+    assert buckets.take('ip:b', 2, 0.1, now=110) == 0
+
+
+def test_local_buckets_evict_least_recently_used():
+    buckets = LocalBuckets(maxsize=2)
+    for key in ('a', 'b', 'a', 'c'):
+        buckets.take(key, 1, 0.001, now=0)
+    # 'a' is still empty, 'b' was evicted and starts full again
+    assert buckets.take('a', 1, 0.001, now=0) > 0
+    assert buckets.take('b', 1, 0.001, now=0) == 0
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(LocalBuckets(), {'ip': '2/60', 'email': '0'})
+    for _ in range(2):
+        limiter.check(ip='203.0.113.7', email='someone@example.com')
+    with pytest.raises(RateLimited) as raised:
+        limiter.check(ip='203.0.113.7', email='someone@example.com')
+    assert raised.value.headers() == {'Retry-After': '30'}
+
+    # Disabled rules, missing keys and other clients are not limited
+    limiter.check(ip='203.0.113.8', email='someone@example.com')
+    limiter.check(ip=None)
+    assert limiter.stats() == {'allowed': 4, 'limited': 1, 'backend_errors': 0}
+
+
+def test_rate_limiter_hashes_keys():
+    buckets = LocalBuckets()
+    limiter = RateLimiter(buckets, {'email': '1/60'})
+    limiter.check(email='Someone@Example.com ')
+    with pytest.raises(RateLimited):
+        limiter.check(email='someone@example.com')
+    assert not any('example' in key for key in buckets._buckets)
+
+
+# A client whose scripts always fail, like an unreachable server
+class UnreachableRedis:
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls()
+
+    def register_script(self, script):
+        def run(keys, args):
+            raise ConnectionError('Redis is down')
+        return run
+
+
+def test_redis_buckets_fall_back(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'redis', types.SimpleNamespace(Redis=UnreachableRedis))
+    limiter = RateLimiter(RedisBuckets('redis://localhost:6379/0'), {'ip': '1/60'})
+    limiter.check(ip='203.0.113.7')
+    with pytest.raises(RateLimited):
+        limiter.check(ip='203.0.113.7')
+    assert limiter.stats()['backend_errors'] == 2
+
+
+def test_redis_package_is_optional(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'redis', None)
+    with pytest.raises(ImportError, match='RATE_LIMIT_REDIS_URL'):
+        RedisBuckets('redis://localhost:6379/0')
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+# Runs do(key, fn) on n threads while fn blocks, returns what each got
+def _concurrent(flight, fn, n=5):
+    release = threading.Event()
+    results = [None] * n
+
+    def blocked():
+        release.wait(5)
+        return fn()
+
+    def run(i):
+        try:
+            results[i] = flight.do('key', blocked)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: flight.shared == n - 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_single_flight_shares_the_result():
+    flight = SingleFlight()
+    calls = []
+    results = _concurrent(flight, lambda: calls.append(1) or {'uid': 'user-1'})
+    assert calls == [1]
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == {'calls': 1, 'shared': 4, 'shed': 0, 'in_flight': 0}
+
+    # Done calls are not shared
+    assert flight.do('key', lambda: 'again') == 'again'
+
+
+def test_single_flight_shares_the_exception():
+    flight = SingleFlight()
+    error = ValueError('INVALID_PASSWORD')
+
+    def fail():
+        raise error
+
+    assert all(result is error for result in _concurrent(flight, fail))
+    assert flight.stats()['calls'] == 1
+
+
+def test_single_flight_sheds_calls():
+    flight = SingleFlight(max_in_flight=1)
+    release = threading.Event()
+    thread = threading.Thread(target=flight.do, args=('first', lambda: release.wait(5)))
+    thread.start()
+    _wait_for(lambda: flight.stats()['in_flight'] == 1)
+    with pytest.raises(RateLimited):
+        flight.do('second', lambda: None)
+    release.set()
+    thread.join(5)
+    assert flight.stats()['shed'] == 1
+    assert flight.do('second', lambda: 'done') == 'done'
+
+
+def test_async_single_flight():
+    flight = AsyncSingleFlight(max_in_flight=2)
+    calls = []
+
+    async def sign_in():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'uid': 'user-1'}
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('INVALID_PASSWORD')
+
+    async def run():
+        results = await asyncio.gather(*[flight.do('key', sign_in) for _ in range(5)])
+        assert calls == [1]
+        assert all(result is results[0] for result in results)
+
+        errors = await asyncio.gather(*[flight.do('bad', fail) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(error, ValueError) and error is errors[0] for error in errors)
+
+        # Two distinct calls in flight, a third one is shed
+        results = await asyncio.gather(flight.do('a', sign_in), flight.do('b', sign_in), flight.do('c', sign_in),
+                                       return_exceptions=True)
+        assert isinstance(results[2], RateLimited)
+
+    asyncio.run(run())
+    assert flight.stats() == {'calls': 4, 'shared': 6, 'shed': 1, 'in_flight': 0}
+
+
+def test_limiter_from_environment(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'REDIS_URL', None)
+    assert isinstance(ratelimit.create_limiter().buckets, LocalBuckets)
@@ -0,0 +1,80 @@
+import pytest
+
+import aggregates
+import main
+from conftest import auth
+
+ENDPOINTS = ['/api/emotions/history?period=week', '/api/emotions/analysis?period=week']
+
+
+def _get(client, url, etag=None, user_id='user-1'):
+    headers = auth(user_id)
+    if etag:
+        headers['If-None-Match'] = etag
+    return client.get(url, headers=headers)
+
+
+@pytest.mark.parametrize('url', ENDPOINTS)
+def test_not_modified(client, url):
+    client.post('/api/emotions', json={'emotion': 'happy', 'intensity': 7}, headers=auth())
+    first = _get(client, url)
+    etag = first.headers['ETag']
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    revalidated = _get(client, url, etag)
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == etag
+    assert revalidated.data == b''
+    assert main.response_cache.stats()['not_modified'] == 1
+
+    # Served from the cache without an If-None-Match
+    hits = main.response_cache.stats()['hits']
+    again = _get(client, url)
+    assert main.response_cache.stats()['hits'] == hits + 1
+    assert again.data == first.data
+    assert again.headers['ETag'] == etag
+
+    # Another user or other arguments never match
+    assert _get(client, url, etag, 'user-2').status_code == 200
+    assert _get(client, url.replace('week', 'month'), etag).status_code == 200
+
+
+@pytest.mark.parametrize('url', ENDPOINTS)
+def test_etag_changes_after_a_save(client, url):
+    client.post('/api/emotions', json={'emotion': 'happy', 'intensity': 7}, headers=auth())
+    etag = _get(client, url).headers['ETag']
+
+    client.post('/api/emotions/batch', json=[{'emotion': 'sad', 'intensity': 3}], headers=auth())
+    changed = _get(client, url, etag)
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    body = changed.get_json()
+    total = body['statistics']['total_entries'] if 'statistics' in body else body['analysis']['total_entries']
+    assert total == 2
+
+
+# Missing or outdated aggregates are rebuilt from the entries, with the
+# same data version, so ETags issued before stay valid
+def test_missing_meta_is_rebuilt(client, store):
+    client.post('/api/emotions/batch', json=[{'emotion': 'happy', 'intensity': 7},
+                                             {'emotion': 'calm', 'intensity': 4}], headers=auth())
+    etag = _get(client, ENDPOINTS[0]).headers['ETag']
+
+    store.clear_aggregates_meta('user-1')
+    assert aggregates.data_version(store, 'user-1') is None
+    assert _get(client, ENDPOINTS[0], etag).status_code == 304
+    meta = store.get_aggregates_meta('user-1')
+    assert meta['count'] == 2
+    assert meta['version'] == aggregates.AGGREGATES_VERSION
+
+    store.set_aggregates('user-1', {'meta': {'version': aggregates.AGGREGATES_VERSION - 1, 'count': 99}})
+    assert _get(client, ENDPOINTS[0], etag).status_code == 304
+    assert aggregates.data_version(store, 'user-1') == 2
+
+
+def test_errors_are_not_cached(client):
+    response = _get(client, '/api/emotions/history?period=decade')
+    assert response.status_code == 400
+    assert 'ETag' not in response.headers
+    assert main.response_cache.stats()['entries'] == 0
@@ -0,0 +1,112 @@
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+import aggregates
+import rollups
+from storage import build_entry
+
+TODAY = date.today()
+START_DAY = TODAY - timedelta(days=13)
+
+
+def _save(store, entries, user_id='user-1'):
+    store.put_emotions(user_id, {store.new_key(entry['ts']): entry for entry in entries})
+    rollups.record_entries(store, user_id, entries)
+
+
+def _entry(emotion, intensity, day, hour=12):
+    return build_entry(emotion, intensity, 'note' if intensity > 5 else '',
+                       datetime.combine(day, time(hour)), 'user-1')
+
+
+def _analysis(store, user_id='user-1'):
+    return aggregates.analyze_buckets(rollups.buckets(store, user_id, START_DAY, TODAY))
+
+
+# Two weeks of entries, 'sad' first on every day and tied with 'happy'
+@pytest.fixture
+def entries(store):
+    saved = []
+    for offset in range(0, 14, 2):
+        day = START_DAY + timedelta(days=offset)
+        saved += [_entry('sad', 2 + offset % 7, day, 9), _entry('happy', 8 - offset % 5, day, 18)]
+    _save(store, saved)
+    return saved
+
+
+def test_compaction_keeps_the_analysis(store, entries):
+    before = _analysis(store)
+    assert before['total_entries'] == len(entries)
+    assert before['dominant_emotion'] == 'happy'
+
+    rollups.compact_user(store, 'user-1')
+    assert rollups.is_current(store.get_rollups_meta('user-1'))
+    after = _analysis(store)
+    assert after == before
+    assert list(after['emotion_distribution']) == list(before['emotion_distribution']) == ['happy', 'sad']
+
+    # Read with weekly rollups too, and after a full recompute
+    weekly = rollups.buckets(store, 'user-1', START_DAY, TODAY, weekly=True)
+    assert any('-W' in key for key in weekly)
+    assert aggregates.summarize(weekly.values()) == aggregates.summarize(
+        rollups.buckets(store, 'user-1', START_DAY, TODAY).values())
+    rollups.compact_user(store, 'user-1', full=True)
+    assert _analysis(store) == before
+
+
+def test_late_entries(store, entries):
+    rollups.compact_user(store, 'user-1')
+    late_day = START_DAY + timedelta(days=1)
+    late = [_entry('calm', 4, late_day), _entry('calm', 6, late_day, 20)]
+    _save(store, late)
+
+    # Marked dirty, read from the raw entries until compacted again
+    meta = store.get_rollups_meta('user-1')
+    assert list(meta['dirty']) == [aggregates.day_key(late_day)]
+    assert _analysis(store)['emotion_distribution']['calm']['frequency'] == 2
+
+    rollups.compact_user(store, 'user-1')
+    meta = store.get_rollups_meta('user-1')
+    assert not meta.get('dirty')
+    day_key = aggregates.day_key(late_day)
+    assert store.get_rollups('user-1', 'daily', day_key, day_key)[day_key]['count'] == 2
+    analysis = _analysis(store)
+    assert analysis['total_entries'] == len(entries) + 2
+    assert analysis['emotion_distribution']['calm']['average_intensity'] == 5
+
+
+def test_late_entry_marks():
+    today = date(2024, 5, 10)
+    entries = [_entry('happy', 5, date(2024, 5, 8)), _entry('sad', 5, date(2024, 5, 8)),
+               _entry('calm', 5, today)]
+    assert rollups.late_entry_marks(entries, today) == {'meta/dirty/2024-05-08': True}
+    assert rollups.late_entry_marks(entries[2:], today) == {}
+
+
+# The in-process job compacts users that were active, and only when needed
+def test_compactor(store, entries):
+    compactor = rollups.Compactor(store, interval=60)
+    compactor.compact_once()
+    assert rollups.is_current(store.get_rollups_meta('user-1'))
+    assert 'user-1' not in rollups.active_users
+
+    compacted_at = store.get_rollups_meta('user-1')['compacted_at']
+    rollups.active_users.add('user-1')
+    compactor.compact_once()
+    assert store.get_rollups_meta('user-1')['compacted_at'] == compacted_at
+
+    _save(store, [_entry('calm', 4, START_DAY)])
+    compactor.compact_once()
+    assert not store.get_rollups_meta('user-1').get('dirty')
+    assert compactor.stats() == {'runs': 3, 'failures': 0, 'active_users': 0}
+
+
+def test_compactor_runs_by_default(store, monkeypatch):
+    monkeypatch.delenv('ROLLUP_INTERVAL')
+    compactor = rollups.create_compactor(store)
+    compactor.stop()
+    assert compactor.interval == 300
+
+    monkeypatch.setenv('ROLLUP_INTERVAL', '0')
+    assert rollups.create_compactor(store) is None
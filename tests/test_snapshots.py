@@ -0,0 +1,75 @@
+import json
+
+import clients
+import main
+from conftest import auth
+from write_queue import WriteBehindQueue
+
+ENTRIES = [{'emotion': 'happy', 'intensity': 3}, {'emotion': 'sad', 'intensity': 9},
+           {'emotion': 'happy', 'intensity': 5}]
+
+
+def _body(store, period, user_id='user-1'):
+    return store.get_snapshot(user_id, 'analysis_' + period)['body'].encode('utf-8')
+
+
+# Only periods requested before are rebuilt after a save
+def test_snapshots_of_requested_periods(client, store):
+    client.post('/api/emotions/batch', json=ENTRIES, headers=auth())
+    assert store.snapshot_names('user-1') == []
+
+    first = client.get('/api/emotions/analysis?period=month', headers=auth())
+    assert store.snapshot_names('user-1') == ['analysis_month']
+    assert _body(store, 'month') == first.data
+
+    client.post('/api/emotions', json={'emotion': 'calm', 'intensity': 6}, headers=auth())
+    assert store.snapshot_names('user-1') == ['analysis_month']
+    stored = json.loads(_body(store, 'month'))
+    assert stored['period'] == 'month'
+    assert len(stored['weekly_data']) == 4
+    assert stored['analysis']['total_entries'] == 4
+
+
+# A current snapshot is the whole response, no entries are read
+def test_snapshot_response_matches_computed_one(client, store, monkeypatch):
+    client.get('/api/emotions/analysis?period=month', headers=auth())
+    client.post('/api/emotions/batch', json=ENTRIES, headers=auth())
+
+    def no_query(*args, **kwargs):
+        raise AssertionError('entries read')
+
+    hits = main.snapshot_refresher.hits
+    with monkeypatch.context() as patched:
+        patched.setattr(store, 'query_emotions', no_query)
+        served = client.get('/api/emotions/analysis?period=month', headers=auth())
+    assert main.snapshot_refresher.hits == hits + 1
+
+    store.set_snapshots('user-1', {'analysis_month': {'version': 'stale', 'body': '{}'}})
+    computed = client.get('/api/emotions/analysis?period=month&fresh=1', headers=auth())
+    assert served.status_code == computed.status_code == 200
+    assert served.data == computed.data
+    assert len(served.get_json()['weekly_data']) == 3
+
+
+# Write-behind entries refresh the snapshots once they are flushed
+def test_refresh_after_flush(client, store, tmp_path):
+    client.get('/api/emotions/analysis?period=week', headers=auth())
+    queue = WriteBehindQueue(store, str(tmp_path / 'queue.db'), publish=clients._publish_entries)
+    queue._ensure_started = lambda: None
+    for item in ENTRIES:
+        entry = main.build_emotion_entry(item, 'user-1', main.datetime.now())
+        queue.enqueue('user-1', store.new_key(entry['ts']), entry)
+    assert queue.flush_once() == 3
+
+    hits = main.snapshot_refresher.hits
+    response = client.get('/api/emotions/analysis?period=week', headers=auth())
+    assert main.snapshot_refresher.hits == hits + 1
+    assert response.get_json()['analysis']['total_entries'] == 3
+
+
+def test_analysis_on_a_second_app(app, store):
+    client = main.create_app().test_client()
+    client.post('/api/emotions', json={'emotion': 'calm', 'intensity': 6}, headers=auth())
+    response = client.get('/api/emotions/analysis?period=week', headers=auth())
+    assert response.status_code == 200
+    assert response.get_json()['analysis']['dominant_emotion'] == 'calm'
@@ -0,0 +1,64 @@
+import time
+from datetime import datetime
+
+import pytest
+
+import main
+import storage
+from storage import build_entry, position
+
+
+# Server local time in a zone with DST, 2026-11-01 01:00-01:59 happens twice
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    monkeypatch.setattr(storage, '_FIXED_OFFSET', None)
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _legacy(timestamp):
+    return {'emotion': 'calm', 'intensity': 3, 'note': '', 'timestamp': timestamp, 'user_id': 'user-1'}
+
+
+# Both formats around the end of DST, in UTC order
+@pytest.fixture
+def mixed_rows(store, new_york):
+    first = build_entry('happy', 5, '', datetime(2026, 11, 1, 1, 30), 'user-1')
+    second = dict(first, ts=first['ts'] + 3600 * 1000)
+    rows = [
+        ('-legacy-a', _legacy('2026-11-01T01:10:00.000000')),
+        (storage.push_keys.generate(first['ts']), first),
+        ('-legacy-b', _legacy('2026-11-01T01:45:00.000000')),
+        (storage.push_keys.generate(second['ts']), second),
+        ('-legacy-c', _legacy('2026-11-01T02:15:00.000000'))
+    ]
+    store.put_emotions('user-1', dict(rows))
+    return rows
+
+
+def test_positions_are_utc(mixed_rows):
+    assert [row[1]['ts'] for row in mixed_rows if 'ts' in row[1]] == [1793511000000, 1793514600000]
+    assert sorted(mixed_rows, key=position) == mixed_rows
+
+
+def test_pages_across_formats_and_dst(store, mixed_rows):
+    start_date, end_date = datetime(2026, 11, 1), datetime(2026, 11, 1, 23, 59, 59, 999999)
+    assert store.query_emotions('user-1', start_date, end_date) == mixed_rows
+    for size in (1, 2, 3):
+        assert list(store.iter_emotions('user-1', start_date, end_date, page_size=size)) == mixed_rows
+
+    # Through API cursors, including one issued before positions were in UTC
+    page = store.page_emotions('user-1', start_date, end_date, 2)
+    after = main.decode_cursor(main.encode_cursor(*page[-1]))
+    assert store.page_emotions('user-1', start_date, end_date, 5, after) == mixed_rows[2:]
+    old_cursor = main.base64.urlsafe_b64encode(b'["2026-11-01T01:10:00.000000","-legacy-a"]').decode('ascii')
+    assert store.page_emotions('user-1', start_date, end_date, 5, main.decode_cursor(old_cursor)) == mixed_rows[1:]
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', 'WzEsMl0=', 'WyJub3QgYSB0aW1lIiwiayJd', 'W3RydWUsImsiXQ=='])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        main.decode_cursor(cursor)
@@ -0,0 +1,165 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+import token_verifier
+from token_verifier import FirebaseTokenVerifier
+
+PROJECT_ID = 'moodmate-test'
+
+
+# Private key and matching certificate, freshly generated
+def make_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, PROJECT_ID)])
+    now = datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    return private_pem, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+@pytest.fixture(scope='module')
+def key():
+    return make_key()
+
+
+@pytest.fixture(scope='module')
+def other_key():
+    return make_key()
+
+
+def signer(key, key_id):
+    return crypt.RSASigner.from_string(key[0], key_id=key_id)
+
+
+def make_token(signer, user_id='user-1', **claims):
+    now = int(time.time())
+    payload = {
+        'iss': 'https://securetoken.google.com/' + PROJECT_ID,
+        'aud': PROJECT_ID,
+        'sub': user_id,
+        'iat': now,
+        'auth_time': now,
+        'exp': now + 3600
+    }
+    payload.update(claims)
+    return jwt.encode(signer, payload).decode()
+
+
+# Serves the given certificates and counts the fetches
+class KeyServer:
+    def __init__(self, certs, max_age=3600):
+        self.certs = certs
+        self.max_age = max_age
+        self.fetches = 0
+
+    def __call__(self):
+        self.fetches += 1
+        return dict(self.certs), self.max_age
+
+
+def test_verify(key):
+    keys = KeyServer({'key-1': key[1]})
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=keys)
+    token = make_token(signer(key, 'key-1'))
+
+    claims = verifier.verify(token)
+    assert claims['uid'] == 'user-1'
+    assert claims['aud'] == PROJECT_ID
+
+    # Served from the cache the second time, callers get their own copy
+    claims['uid'] = 'someone-else'
+    assert verifier.verify(token)['uid'] == 'user-1'
+    assert keys.fetches == 1
+    assert verifier.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('claims, message', [
+    ({'exp': int(time.time()) - 60}, 'expired'),
+    ({'aud': 'another-project'}, 'audience'),
+    ({'iss': 'https://securetoken.google.com/another-project'}, 'issuer'),
+    ({'sub': ''}, 'subject'),
+    ({'auth_time': int(time.time()) + 3600}, 'authentication time')
+])
+def test_rejects_invalid_claims(key, claims, message):
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=KeyServer({'key-1': key[1]}))
+    with pytest.raises(ValueError, match=message):
+        verifier.verify(make_token(signer(key, 'key-1'), **claims))
+
+
+# Signed by another key under a known key id
+def test_rejects_wrong_signature(key, other_key):
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=KeyServer({'key-1': key[1]}))
+    with pytest.raises(ValueError, match='signature'):
+        verifier.verify(make_token(signer(other_key, 'key-1')))
+
+
+def test_rejects_other_algorithms(key):
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=KeyServer({'key-1': key[1]}))
+    payload = make_token(signer(key, 'key-1')).split('.')[1]
+    # {"alg":"none","kid":"key-1"}
+    forged = 'eyJhbGciOiJub25lIiwia2lkIjoia2V5LTEifQ.' + payload + '.'
+    with pytest.raises(ValueError, match='algorithm'):
+        verifier.verify(forged)
+
+
+# Unknown key ids force a refresh at most once per MIN_FORCED_REFRESH_INTERVAL
+def test_unknown_key_id(key, other_key):
+    keys = KeyServer({'key-1': key[1]})
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=keys)
+    verifier.verify(make_token(signer(key, 'key-1')))
+
+    # The keys were fetched just now, forged key ids do not fetch them again
+    for _ in range(3):
+        with pytest.raises(ValueError, match='key-2'):
+            verifier.verify(make_token(signer(other_key, 'key-2')))
+    assert keys.fetches == 1
+
+
+def test_key_rotation(key, other_key, monkeypatch):
+    keys = KeyServer({'key-1': key[1]})
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=keys)
+    old_token = make_token(signer(key, 'key-1'))
+    verifier.verify(old_token)
+
+    # Firebase publishes the new key next to the old one, then signs with it
+    keys.certs = {'key-1': key[1], 'key-2': other_key[1]}
+    monkeypatch.setattr(token_verifier, 'MIN_FORCED_REFRESH_INTERVAL', 0)
+    assert verifier.verify(make_token(signer(other_key, 'key-2'), 'user-2'))['uid'] == 'user-2'
+    assert verifier.verify(make_token(signer(key, 'key-1'), 'user-3'))['uid'] == 'user-3'
+    assert keys.fetches == 2
+
+    # Once the old key is retired and the cached keys expire, new tokens
+    # signed with it are rejected, those verified already stay cached
+    keys.certs = {'key-2': other_key[1]}
+    verifier.keys._expires_at = 0
+    with pytest.raises(ValueError, match='key-1'):
+        verifier.verify(make_token(signer(key, 'key-1'), 'user-4'))
+    assert verifier.verify(old_token)['uid'] == 'user-1'
+    assert keys.fetches == 3
+
+
+# Stale keys are served while a refresh fails, only a first fetch fails the request
+def test_failed_key_refresh(key):
+    def fail():
+        raise OSError('certificate fetch failed')
+
+    verifier = FirebaseTokenVerifier(PROJECT_ID, fetch_keys=KeyServer({'key-1': key[1]}))
+    verifier.verify(make_token(signer(key, 'key-1')))
+    verifier.keys._fetch_keys = fail
+    verifier.keys._expires_at = 0
+    assert verifier.verify(make_token(signer(key, 'key-1'), 'user-2'))['uid'] == 'user-2'
+    assert verifier.stats()['key_refresh_failures'] == 1
+
+    with pytest.raises(OSError):
+        FirebaseTokenVerifier(PROJECT_ID, fetch_keys=fail).verify(make_token(signer(key, 'key-1')))
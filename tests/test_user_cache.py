@@ -0,0 +1,102 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from conftest import auth
+from user_cache import UserCache
+
+
+# Stands in for firebase_admin.auth, counting the calls that reach it
+class FakeAuth:
+    def __init__(self):
+        self.users = {}
+        self.calls = []
+
+    def _record(self, uid):
+        return SimpleNamespace(uid=uid, email=uid + '@example.com', photo_url=None, email_verified=True,
+                               display_name=self.users.get(uid, 'User ' + uid))
+
+    def get_user(self, uid):
+        self.calls.append(('get_user', uid))
+        return self._record(uid)
+
+    def update_user(self, uid, **params):
+        self.calls.append(('update_user', uid))
+        self.users[uid] = params.get('display_name', self.users.get(uid))
+        return self._record(uid)
+
+
+@pytest.fixture
+def fake_auth():
+    return FakeAuth()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_records_expire(fake_auth, clock):
+    users = UserCache(ttl=60, auth=lambda: fake_auth)
+    assert users.get_user('a')['display_name'] == 'User a'
+    clock[0] += 59
+    users.get_user('a')
+    assert fake_auth.calls == [('get_user', 'a')]
+
+    clock[0] += 1
+    users.get_user('a')
+    assert fake_auth.calls == [('get_user', 'a')] * 2
+
+
+def test_records_are_bounded(fake_auth, clock):
+    users = UserCache(maxsize=2, auth=lambda: fake_auth)
+    for uid in ('a', 'b', 'a', 'c'):
+        users.get_user(uid)
+    # 'b' was the least recently used one
+    users.get_user('a')
+    users.get_user('b')
+    assert [uid for _, uid in fake_auth.calls] == ['a', 'b', 'c', 'b']
+    assert users.stats()['evictions'] == 2
+
+
+def test_update_writes_through(fake_auth, clock):
+    users = UserCache(auth=lambda: fake_auth)
+    users.get_user('a')
+    profile = users.update_user('a', display_name='Ada')
+    assert profile['display_name'] == 'Ada'
+    assert users.get_user('a') == profile
+    assert fake_auth.calls == [('get_user', 'a'), ('update_user', 'a')]
+
+
+def test_profile_from_claims(fake_auth, clock):
+    users = UserCache(claims_max_age=300, auth=lambda: fake_auth)
+    claims = {'uid': 'a', 'email': 'a@example.com', 'name': 'From token', 'iat': clock[0] - 10}
+    assert users.get_profile(claims)['display_name'] == 'From token'
+    assert fake_auth.calls == []
+    assert users.stats()['claims_hits'] == 1
+
+    # Stale tokens fall back to the record
+    assert users.get_profile(dict(claims, iat=clock[0] - 301))['display_name'] == 'User a'
+
+    # Tokens issued before an update are no longer trusted
+    users.invalidate('a')
+    clock[0] += 1
+    users.update_user('a', display_name='Ada')
+    users.invalidate('a')
+    assert users.get_profile(claims)['display_name'] == 'Ada'
+    users.invalidate('a')
+    assert users.get_profile(dict(claims, iat=clock[0] + 1))['display_name'] == 'From token'
+
+
+def test_profile_routes(client, fake_auth, monkeypatch):
+    monkeypatch.setattr(main, 'user_cache', UserCache(auth=lambda: fake_auth))
+    assert client.get('/user/profile/', headers=auth()).get_json()['name'] == 'User user-1'
+
+    response = client.put('/user/profile/', json={'display_name': 'Ada'}, headers=auth())
+    assert response.get_json()['name'] == 'Ada'
+    assert client.get('/user/profile/', headers=auth()).get_json()['name'] == 'Ada'
+    assert fake_auth.calls == [('get_user', 'user-1'), ('update_user', 'user-1')]
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import pytest
+
+from storage import build_entry
+from write_queue import QueueFull, WriteBehindQueue
+
+
+def _queue(store, tmp_path, **kwargs):
+    queue = WriteBehindQueue(store, str(tmp_path / 'queue.db'), **kwargs)
+    # Flushed by the test, not by the background thread
+    queue._ensure_started = lambda: None
+    return queue
+
+
+# Streams get queued entries only once they are stored
+def test_publishes_after_flush(store, tmp_path):
+    published = []
+
+    def publish(user_id, keys, entries):
+        stored = dict(store.all_emotions(user_id))
+        published.append((user_id, keys, [key in stored for key in keys]))
+
+    queue = _queue(store, tmp_path, publish=publish)
+    entry = build_entry('happy', 5, '', datetime.now(), 'user-1')
+    key = store.new_key(entry['ts'])
+    queue.enqueue('user-1', key, entry)
+    assert published == []
+
+    assert queue.flush_once() == 1
+    assert published == [('user-1', [key], [True])]
+
+
+# The limit holds for every worker sharing the queue file
+def test_max_pending(store, tmp_path):
+    queue = _queue(store, tmp_path, max_pending=2)
+    other = _queue(store, tmp_path, max_pending=2)
+    entries = [build_entry('happy', 5, '', datetime.now(), 'user-1') for _ in range(3)]
+    queue.enqueue('user-1', store.new_key(entries[0]['ts']), entries[0])
+    other.enqueue('user-2', store.new_key(entries[1]['ts']), entries[1])
+    for worker in (queue, other):
+        with pytest.raises(QueueFull):
+            worker.enqueue('user-1', store.new_key(entries[2]['ts']), entries[2])
+    assert queue.pending() == other.pending() == 2
+
+    # Room again once flushed, by either worker
+    assert other.flush_once() == 2
+    queue.enqueue('user-1', store.new_key(entries[2]['ts']), entries[2])
+    assert other.pending() == 1
+    assert len(store.all_emotions('user-1')) == 1
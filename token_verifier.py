@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+from google.auth import jwt
+
+import metrics
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Public keys used by Firebase Auth to sign ID tokens, overridable to point
+# load tests at a local stand-in
+PUBLIC_KEYS_URL = os.getenv(
+    'FIREBASE_PUBLIC_KEYS_URL',
+    'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com')
+
+# Used when the key response has no usable Cache-Control header
+DEFAULT_KEYS_MAX_AGE = 3600
+
+# Minimum delay between two forced refreshes (unknown key id in a token)
+MIN_FORCED_REFRESH_INTERVAL = 60
+
+# Retry delay after a failed key fetch while stale keys are still served
+FAILED_FETCH_RETRY_INTERVAL = 30
+
+_MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+
+# Fetch the signing certificates and how long they may be cached for
+def fetch_public_keys(session=None, url: str = PUBLIC_KEYS_URL) -> Tuple[Dict[str, str], int]:
+    with metrics.upstream('auth', 'public_keys'):
+        response = (session or requests).get(url, timeout=10)
+        response.raise_for_status()
+
+    max_age = DEFAULT_KEYS_MAX_AGE
+    match = _MAX_AGE_PATTERN.search(response.headers.get('Cache-Control', ''))
+    if match:
+        max_age = int(match.group(1))
+    return response.json(), max_age
+
+
+class PublicKeyStore:
+    def __init__(self, fetch_keys: Callable[[], Tuple[Dict[str, str], int]]):
+        self._fetch_keys = fetch_keys
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = 0
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def get_keys(self, key_id: Optional[str] = None) -> Dict[str, str]:
+        now = time.time()
+        keys = self._keys
+        if now < self._expires_at and (key_id is None or key_id in keys):
+            return keys
+
+        with self._lock:
+            # Another thread may have refreshed the keys while we waited
+            keys = self._keys
+            if now < self._expires_at and (key_id is None or key_id in keys):
+                return keys
+            # Unknown key ids only trigger a refresh once in a while, so that
+            # forged tokens cannot turn every request into a key fetch.
+            if now < self._expires_at and now - self._last_fetch < MIN_FORCED_REFRESH_INTERVAL:
+                return keys
+            self._refresh(now)
+            return self._keys
+
+    def _refresh(self, now: float):
+        self._last_fetch = now
+        try:
+            keys, max_age = self._fetch_keys()
+        except Exception:
+            self.refresh_failures += 1
+            if not self._keys:
+                raise
+            # Keep serving the previous keys while the network is flaky
+            logger.warning('Failed to refresh token signing keys, using cached keys', exc_info=True)
+            self._expires_at = now + FAILED_FETCH_RETRY_INTERVAL
+            return
+        self.refreshes += 1
+        self._keys = keys
+        self._expires_at = now + max_age
+
+
+# Verifies Firebase ID tokens locally against cached signing keys. Tokens
+# that were verified before are served from an LRU (keyed by a hash of the
+# token) until their 'exp' claim passes.
+class FirebaseTokenVerifier:
+    def __init__(self, project_id: str, fetch_keys: Optional[Callable] = None,
+                 cache_size: int = 10000, clock_skew_seconds: int = 0):
+        if not project_id:
+            raise ValueError('A project id is required to verify ID tokens')
+        self.project_id = project_id
+        self.issuer = 'https://securetoken.google.com/' + project_id
+        self.clock_skew_seconds = clock_skew_seconds
+        self.keys = PublicKeyStore(fetch_keys or fetch_public_keys)
+        self.tokens = TTLCache(cache_size)
+
+    def verify(self, token: str) -> Dict:
+        if not token:
+            raise ValueError('ID token must be a non-empty string')
+
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        claims = self.tokens.get(token_hash)
+        if claims is None:
+            claims = self._verify(token)
+            self.tokens.set(token_hash, claims, expires_at=claims['exp'] + self.clock_skew_seconds)
+        # Callers get their own copy of the claims
+        return dict(claims)
+
+    def _verify(self, token: str) -> Dict:
+        header = jwt.decode_header(token)
+        if header.get('alg') != 'RS256':
+            raise ValueError('ID token has incorrect algorithm, expected RS256')
+        if not header.get('kid'):
+            raise ValueError('ID token has no "kid" claim')
+
+        keys = self.keys.get_keys(header['kid'])
+        claims = jwt.decode(token, certs=keys, audience=self.project_id,
+                            clock_skew_in_seconds=self.clock_skew_seconds)
+
+        if claims.get('iss') != self.issuer:
+            raise ValueError('ID token has incorrect issuer, expected ' + self.issuer)
+        subject = claims.get('sub')
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise ValueError('ID token has an invalid subject')
+        if claims.get('auth_time', 0) > time.time() + self.clock_skew_seconds:
+            raise ValueError('ID token has an authentication time in the future')
+
+        claims['uid'] = subject
+        return claims
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.tokens.stats()
+        stats['key_refreshes'] = self.keys.refreshes
+        stats['key_refresh_failures'] = self.keys.refresh_failures
+        return stats
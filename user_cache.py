@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import metrics
+from cache import TTLCache
+
+
+# firebase_admin is imported on first use, it is slow to import
+def _admin_auth():
+    from firebase_admin import auth
+    return auth
+
+
+def _record_to_profile(user) -> Dict:
+    return {
+        'uid': user.uid,
+        'email': user.email,
+        'display_name': user.display_name,
+        'photo_url': user.photo_url,
+        'email_verified': user.email_verified
+    }
+
+
+# TTL+LRU cache of Firebase user records keyed by uid. Profiles can also be
+# taken from the claims of a freshly issued ID token, unless the user was
+# updated through this process after the token was issued. Other workers see
+# updates once their cached record or the token claims age out. auth
+# returns the firebase_admin.auth module (or a stand-in).
+class UserCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, claims_max_age: float = 300,
+                 auth: Optional[Callable] = None):
+        self.auth = auth or _admin_auth
+        self.records = TTLCache(maxsize, ttl)
+        self.claims_max_age = claims_max_age
+        self._updated_at = {}
+        self._lock = threading.Lock()
+        self.claims_hits = 0
+
+    def get_user(self, uid: str) -> Dict:
+        profile = self.records.get(uid)
+        if profile is None:
+            with metrics.upstream('auth', 'get_user'):
+                record = self.auth().get_user(uid)
+            profile = _record_to_profile(record)
+            self.records.set(uid, profile)
+        return profile
+
+    # Profile for the authenticated user, from token claims when fresh enough
+    def get_profile(self, claims: Dict) -> Dict:
+        profile = self.records.get(claims['uid'])
+        if profile is not None:
+            return profile
+
+        issued_at = claims.get('iat', 0)
+        updated_at = self._updated_at.get(claims['uid'], 0)
+        if time.time() - issued_at <= self.claims_max_age and issued_at > updated_at:
+            self.claims_hits += 1
+            return {
+                'uid': claims['uid'],
+                'email': claims.get('email'),
+                'display_name': claims.get('name'),
+                'photo_url': claims.get('picture'),
+                'email_verified': claims.get('email_verified', False)
+            }
+        return self.get_user(claims['uid'])
+
+    # Write-through update, token claims issued before now are no longer trusted
+    def update_user(self, uid: str, **params) -> Dict:
+        with self._lock:
+            self._updated_at[uid] = time.time()
+        self.records.pop(uid)
+        with metrics.upstream('auth', 'update_user'):
+            record = self.auth().update_user(uid, **params)
+        profile = _record_to_profile(record)
+        self.records.set(uid, profile)
+        return profile
+
+    def invalidate(self, uid: str):
+        self.records.pop(uid)
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.records.stats()
+        stats['claims_hits'] = self.claims_hits
+        return stats
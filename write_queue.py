@@ -0,0 +1,229 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import rollups
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+# Durable write-behind queue for emotion entries. Entries are appended to a
+# SQLite database in WAL mode and a background thread writes them to the
+# store in batches. Workers of the same host can share one queue file: rows
+# are claimed with a lease before they are flushed, and entries are written
+# under their pre-assigned key, so a replayed row never creates a duplicate.
+# A worker dying between the write and the delete can count a replayed row
+# twice in the aggregates, rebuild_aggregates.py repairs that. Entries are
+# passed to publish(user_id, keys, entries) once they are stored. The
+# max_pending limit covers every worker sharing the file: triggers keep the
+# row count in emotion_queue_size, read and checked in the transaction that
+# inserts the row.
+class WriteBehindQueue:
+    def __init__(self, store, path: str, max_pending: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 0.5, max_backoff: float = 60, lease_seconds: float = 30,
+                 publish: Optional[Callable] = None):
+        self.store = store
+        self.publish = publish
+        self.path = path
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushed = 0
+        self.failures = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # In one transaction, so that the count starts from every row
+            # already queued by older versions or other workers
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS emotion_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    entry TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    claimed_by INTEGER,
+                    claimed_until REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS emotion_queue_next ON emotion_queue (next_attempt)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS emotion_queue_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    size INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('INSERT OR IGNORE INTO emotion_queue_size (id, size) '
+                         'SELECT 0, COUNT(*) FROM emotion_queue')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS emotion_queue_added AFTER INSERT ON emotion_queue
+                BEGIN UPDATE emotion_queue_size SET size = size + 1; END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS emotion_queue_removed AFTER DELETE ON emotion_queue
+                BEGIN UPDATE emotion_queue_size SET size = size - 1; END
+            ''')
+            conn.execute('COMMIT')
+            self._conn = conn
+            self._pid = os.getpid()
+            self._thread = None
+        return self._conn
+
+    def _count(self, conn: sqlite3.Connection) -> int:
+        return conn.execute('SELECT size FROM emotion_queue_size').fetchone()[0]
+
+    # Started lazily in every process, threads do not survive a fork
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='emotion-write-behind', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, user_id: str, key: str, entry: Dict):
+        with self._lock:
+            conn = self._connection()
+            self._ensure_started()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self._count(conn) >= self.max_pending:
+                    raise QueueFull('Too many pending writes, retry later')
+                conn.execute('INSERT INTO emotion_queue (user_id, key, entry) VALUES (?, ?, ?)',
+                             (user_id, key, json.dumps(entry)))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._count(self._connection())
+
+    def _claim(self, now: float) -> List[tuple]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT id, user_id, key, entry, attempts FROM emotion_queue '
+                    'WHERE next_attempt <= ? AND claimed_until <= ? ORDER BY id LIMIT ?',
+                    (now, now, self.batch_size)).fetchall()
+                if rows:
+                    conn.executemany(
+                        'UPDATE emotion_queue SET claimed_by = ?, claimed_until = ? WHERE id = ?',
+                        [(os.getpid(), now + self.lease_seconds, row[0]) for row in rows])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return rows
+
+    # Write one batch, returns the number of rows that were flushed
+    def flush_once(self) -> int:
+        now = time.time()
+        rows = self._claim(now)
+
+        by_user = {}
+        for row_id, user_id, key, entry, attempts in rows:
+            by_user.setdefault(user_id, []).append((row_id, key, json.loads(entry), attempts))
+
+        flushed = 0
+        for user_id, items in by_user.items():
+            try:
+                self.store.put_emotions(user_id, {key: entry for _, key, entry, _ in items})
+            except Exception:
+                self.failures += 1
+                logger.warning('Write-behind flush failed for %s', user_id, exc_info=True)
+                self._retry_later(items, now)
+                continue
+            entries = [entry for _, _, entry, _ in items]
+            rollups.record_entries(self.store, user_id, entries)
+            with self._lock:
+                self._connection().executemany('DELETE FROM emotion_queue WHERE id = ?',
+                                               [(row_id,) for row_id, _, _, _ in items])
+            flushed += len(items)
+            if self.publish is not None:
+                try:
+                    self.publish(user_id, [key for _, key, _, _ in items], entries)
+                except Exception:
+                    logger.exception('Failed to publish flushed entries of %s', user_id)
+
+        self.flushed += flushed
+        return flushed
+
+    # Exponential backoff per row, capped at max_backoff
+    def _retry_later(self, items, now: float):
+        updates = []
+        for row_id, _, _, attempts in items:
+            delay = min(self.max_backoff, 0.5 * 2 ** attempts)
+            updates.append((attempts + 1, now + delay, row_id))
+        with self._lock:
+            self._connection().executemany(
+                'UPDATE emotion_queue SET attempts = ?, next_attempt = ?, claimed_until = 0 WHERE id = ?',
+                updates)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.flush_once() >= self.batch_size:
+                    continue
+            except Exception:
+                logger.exception('Write-behind flusher error')
+            self._stop.wait(self.flush_interval)
+
+    # Stop the flusher and write whatever is still due, used on shutdown
+    def close(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if not self.flush_once():
+                    break
+            except Exception:
+                logger.exception('Write-behind flush on shutdown failed')
+                break
+
+    def stats(self) -> Dict:
+        return {
+            'pending': self.pending(),
+            'max_pending': self.max_pending,
+            'flushed': self.flushed,
+            'failures': self.failures
+        }
+
+
+def create_queue(store, publish: Optional[Callable] = None) -> WriteBehindQueue:
+    queue = WriteBehindQueue(
+        store,
+        os.getenv('EMOTION_QUEUE_PATH', 'var/emotion_queue.db'),
+        max_pending=int(os.getenv('EMOTION_QUEUE_MAX_PENDING', 10000)),
+        batch_size=int(os.getenv('EMOTION_QUEUE_BATCH_SIZE', 200)),
+        publish=publish
+    )
+    atexit.register(queue.close)
+    return queue